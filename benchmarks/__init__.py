@@ -0,0 +1,13 @@
+"""
+Benchmarks for FastEx.
+
+Synthetic JSONL datasets are generated (and cached) by `benchmarks.generate`, and the scenarios
+in `benchmarks.scenarios` time starting commands, opening datasets, rendering, queries, saves
+and a local server. Run them with:
+
+    python -m benchmarks.run --size 10k -o results.json
+
+and compare the results of two commits with:
+
+    python -m benchmarks.compare before.json after.json
+"""
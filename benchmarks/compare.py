@@ -0,0 +1,53 @@
+"""
+Compares two benchmark results saved by `benchmarks.run`.
+"""
+import argparse
+import json
+import sys
+
+
+def compare(before: dict, after: dict, stat: str = "median", threshold: float = 0.1) -> bool:
+    """
+    Prints the ratio of `after` to `before` for every metric that both have.
+
+    Returns:
+        True iff some metric regressed by more than `threshold` (e.g. 0.1 for 10%).
+    """
+    for name in ["size", "python", "json_backend"]:
+        if before["meta"].get(name) != after["meta"].get(name):
+            print(f"Warning: the runs differ in {name} ({before['meta'].get(name)} vs "
+                  f"{after['meta'].get(name)})", file=sys.stderr)
+
+    regressed = False
+    print(f"{'metric':<40} {'before':>12} {'after':>12} {'ratio':>8}")
+    for metric in sorted(set(before["results"]) & set(after["results"])):
+        old, new = before["results"][metric][stat], after["results"][metric][stat]
+        ratio = new / old if old else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            flag, regressed = " !", True
+        print(f"{metric:<40} {old:>12.6f} {new:>12.6f} {ratio:>8.2f}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('before', help="Results of the baseline")
+    parser.add_argument('after', help="Results to compare to the baseline")
+    parser.add_argument('--stat', default="median", choices=["min", "mean", "median", "p95", "max"])
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Relative slowdown reported as a regression")
+    parser.add_argument('--fail-on-regression', action="store_true",
+                        help="Exit with an error if any metric regressed")
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    if compare(before, after, args.stat, args.threshold) and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
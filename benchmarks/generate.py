@@ -0,0 +1,142 @@
+"""
+Generates synthetic JSONL datasets for the benchmarks.
+
+Records look like chat transcripts (as in `example/data.jsonl`) with some metadata, and nest
+between 1 and `max_depth` levels deep depending on their index so that templates and queries
+see a mix of shapes. The same size and seed always produce the same file: records are encoded
+with the standard library's `json` rather than `fastex.codec`, whose output (e.g. how floats are
+formatted) depends on the JSON library it uses.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+from typing import Any, Dict, List
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+#: Named dataset sizes.
+SIZES = {
+    "10k": 10_000,
+    "1m": 1_000_000,
+    "10m": 10_000_000,
+}
+
+_WORDS = ("the quick brown fox jumps over lazy dog help need please thanks order refund "
+          "account password reset ship deliver late broken works fine great terrible").split()
+_USERS = ["A", "B", "C", "agent", "bot"]
+_LABELS = ["greeting", "complaint", "question", "other"]
+
+#: A `QuerySchema` definition for generated records.
+SEARCH_SCHEMA = {
+    "fields": [
+        {"name": "id", "type": "int"},
+        {"name": "title", "type": "text"},
+        {"name": "label", "type": "category"},
+        {"name": "score", "type": "float"},
+        {"name": "tags", "type": "category"},
+        {"name": "messages", "type": "message"},
+    ],
+    "types": [
+        {"name": "message", "fields": [
+            {"name": "user", "type": "category"},
+            {"name": "msg", "type": "text"},
+        ]},
+    ],
+}
+
+
+def _sentence(rng: random.Random, length: int) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(length))
+
+
+def _nested(rng: random.Random, depth: int) -> Dict[str, Any]:
+    if depth == 0:
+        return {"value": rng.randint(0, 1000), "note": _sentence(rng, 3)}
+    return {"level": depth, "items": [_nested(rng, depth - 1) for _ in range(rng.randint(1, 2))]}
+
+
+def make_record(rng: random.Random, idx: int, max_depth: int = 3) -> Dict[str, Any]:
+    """
+    Returns:
+        Synthetic record number `idx`.
+    """
+    messages: List[Dict[str, Any]] = [
+        {"user": rng.choice(_USERS), "msg": _sentence(rng, rng.randint(3, 20))}
+        for _ in range(rng.randint(1, 8))
+    ]
+    return {
+        "id": idx,
+        "title": _sentence(rng, rng.randint(2, 6)),
+        "label": rng.choice(_LABELS),
+        "score": round(rng.random(), 4),
+        "tags": rng.sample(_WORDS, rng.randint(0, 3)),
+        "messages": messages,
+        "meta": _nested(rng, idx % (max_depth + 1)),
+    }
+
+
+def generate(fname: str, count: int, max_depth: int = 3, seed: int = 0):
+    """
+    Writes `count` synthetic records to `fname`.
+    """
+    rng = random.Random(seed)
+    tmp = fname + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for idx in range(count):
+            f.write(json.dumps(make_record(rng, idx, max_depth), separators=(",", ":")))
+            f.write("\n")
+    os.replace(tmp, fname)
+
+
+def dataset(data_dir: str, size: str, seed: int = 0) -> str:
+    """
+    Returns:
+        The path to the dataset of the given size, generating it if it doesn't exist yet.
+    """
+    count = SIZES[size] if size in SIZES else int(size)
+    os.makedirs(data_dir, exist_ok=True)
+    fname = os.path.join(data_dir, f"synthetic-{size}-{seed}.jsonl")
+    if not os.path.exists(fname):
+        logger.info(f"Generating {count} records in {fname}")
+        generate(fname, count, seed=seed)
+    return fname
+
+
+def write_config(directory: str):
+    """
+    Writes a `fex.yaml` that uses the default template and a small annotation schema, and a
+    search schema (`search.json`) for generated records to `directory`.
+    """
+    with open(os.path.join(os.path.dirname(__file__), "..", "fastex", "templates",
+                           "fex.yaml")) as f:
+        template = yaml.safe_load(f)["template"]
+    cfg = {
+        "template": template,
+        "schema": {
+            "intent": {"type": "classification",
+                       "values": [{"name": label} for label in _LABELS]},
+            "notes": {"type": "text"},
+        },
+    }
+    with open(os.path.join(directory, "fex.yaml"), "w") as f:
+        yaml.safe_dump(cfg, f)
+    with open(os.path.join(directory, "search.json"), "w") as f:
+        json.dump(SEARCH_SCHEMA, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates a synthetic JSONL dataset")
+    parser.add_argument('size', help=f"One of {', '.join(SIZES)} or a number of records")
+    parser.add_argument('-o', '--output', type=str, required=True, help="Where to save it")
+    parser.add_argument('--max-depth', type=int, default=3, help="Maximum nesting of 'meta'")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+    generate(args.output, SIZES.get(args.size) or int(args.size), args.max_depth, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Runs benchmark scenarios.
+
+Results are saved as JSON: a `meta` object that describes the run (commit, Python version,
+JSON backend, dataset) and a `results` object that maps `<scenario>.<metric>` to summary
+statistics (in seconds), so that two runs can be compared with `benchmarks.compare`.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Sequence
+
+from fastex import codec
+
+from .generate import SIZES, dataset, write_config
+from .scenarios import SCENARIOS
+
+logger = logging.getLogger(__name__)
+
+#: Bumped whenever the layout of the results changes.
+RESULTS_VERSION = 1
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """
+    Returns:
+        Summary statistics of a list of timings.
+    """
+    samples = sorted(samples)
+    return {
+        "n": len(samples),
+        "min": samples[0],
+        "mean": statistics.mean(samples),
+        "median": statistics.median(samples),
+        "p95": samples[min(len(samples) - 1, int(0.95 * len(samples)))],
+        "max": samples[-1],
+    }
+
+
+def _git(*args: str) -> str:
+    try:
+        return subprocess.run(["git"] + list(args), cwd=os.path.dirname(__file__),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def run(size: str, scenarios: List[str], data_dir: str, repeat: int = 3, seed: int = 0,
+        server_args: Sequence[str] = ()) -> dict:
+    """
+    Runs `scenarios` on the synthetic dataset of the given size.
+
+    Returns:
+        The results, as saved by `main`.
+    """
+    fname = dataset(data_dir, size, seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        write_config(workdir)
+        for name in scenarios:
+            logger.info(f"Running {name} on {fname}")
+            kwargs = {"server_args": server_args} if name == "server" else {}
+            for metric, samples in SCENARIOS[name](fname, workdir, repeat, **kwargs).items():
+                results[f"{name}.{metric}"] = summarize(samples)
+                logger.info(f"{name}.{metric}: {results[f'{name}.{metric}']['median']:.6f}s")
+    return {
+        "version": RESULTS_VERSION,
+        "meta": {
+            "commit": _git("rev-parse", "HEAD"),
+            "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "json_backend": codec.backend_name,
+            "size": size,
+            "seed": seed,
+            "repeat": repeat,
+            "server_args": list(server_args),
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--log-level', choices=["debug", "info", "warn", "error"], default="info",
+                        help="The granularity of logs to report")
+    parser.add_argument('--size', default="10k",
+                        help=f"One of {', '.join(SIZES)} or a number of records")
+    parser.add_argument('-s', '--scenario', action="append", choices=list(SCENARIOS),
+                        help="Scenarios to run (default: all)")
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help="Number of times to repeat each measurement")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed of the data")
+    parser.add_argument('--data-dir', default=os.path.join(os.path.dirname(__file__), "data"),
+                        help="Where generated datasets are cached")
+    parser.add_argument('--server-arg', action="append", default=[],
+                        help="Extra arguments for 'fex run' in the server scenario, e.g. "
+                             "--server-arg=--journal")
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help="Save results to this file (default: print them)")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper())
+
+    results = run(args.size, args.scenario or list(SCENARIOS), args.data_dir, args.repeat,
+                  args.seed, args.server_arg)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
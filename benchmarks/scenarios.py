@@ -0,0 +1,296 @@
+"""
+Benchmark scenarios.
+
+Each scenario takes the path to a dataset (and a working directory it may write to) and returns
+a dictionary from metric names to lists of samples (in seconds), which `benchmarks.run`
+summarizes.
+"""
+import itertools
+import logging
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from fastex import codec
+from fastex.config import Config
+from fastex.index import INDEX_SUFFIX
+from fastex.search import QuerySchema, SearchIndex, iter_record_indices
+from fastex.util import FileBackedJsonList, load_jsonl
+
+from .generate import SEARCH_SCHEMA
+
+logger = logging.getLogger(__name__)
+
+Samples = Dict[str, List[float]]
+
+#: Queries timed by the query scenarios, covering free text, exact fields and negation.
+QUERIES = [
+    "refund",
+    "label:complaint",
+    "messages.user:agent",
+    "!label:other password",
+    '"please help"',
+]
+#: The number of results in a page of search results (as in `/search/`).
+PAGE_SIZE = 50
+
+
+def timeit(fn: Callable[[], object], repeat: int) -> List[float]:
+    """
+    Returns:
+        The wall-clock time of `repeat` calls to `fn`.
+    """
+    ret = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        ret.append(time.perf_counter() - start)
+    return ret
+
+
+def startup(fname: str, workdir: str, repeat: int = 3) -> Samples:
+    """
+    Times opening a dataset: lazily with and without a saved line index, and eagerly.
+    """
+    def open_cold():
+        if os.path.exists(fname + INDEX_SUFFIX):
+            os.remove(fname + INDEX_SUFFIX)
+        FileBackedJsonList(fname, auto_save=False, lazy=True)
+
+    samples = {
+        "open_lazy_cold": timeit(open_cold, repeat),
+        "open_lazy_warm": timeit(lambda: FileBackedJsonList(fname, auto_save=False, lazy=True),
+                                 repeat),
+    }
+    samples["load_jsonl"] = timeit(lambda: load_jsonl(fname), 1)
+    return samples
+
+
+def imports(fname: str, workdir: str, repeat: int = 3, count: int = 10) -> Samples:
+    """
+    Times commands in fresh interpreters: starting Python itself (for reference), importing
+    `fastex.main`, `fex --help` and exporting the first `count` records of the dataset with
+    `fex export`, as scripted batch jobs do.
+    """
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+    small = os.path.join(workdir, "imports.jsonl")
+    with open(fname) as src, open(small, "w") as dst:
+        dst.writelines(itertools.islice(src, count))
+
+    def command(*args):
+        return lambda: subprocess.run([sys.executable] + list(args), cwd=workdir, env=env,
+                                      check=True, stdout=subprocess.DEVNULL)
+
+    fex = ["-m", "fastex.main", "--log-level", "warn"]
+    try:
+        return {
+            "python": timeit(command("-c", "pass"), repeat),
+            "import_main": timeit(command("-c", "import fastex.main"), repeat),
+            "cli_help": timeit(command(*fex, "--help"), repeat),
+            "export_small": timeit(command(*fex, "export", "-j", "1", "-o",
+                                           os.path.join(workdir, "imports"), small), repeat),
+        }
+    finally:
+        shutil.rmtree(os.path.join(workdir, "imports"), ignore_errors=True)
+        os.remove(small)
+
+
+def render(fname: str, workdir: str, repeat: int = 3, count: int = 1000) -> Samples:
+    """
+    Times rendering records with the default template, per record.
+    """
+    config = Config.load(os.path.join(workdir, "fex.yaml"))
+    data = FileBackedJsonList(fname, auto_save=False, lazy=True)
+    objs = data[0: min(count, len(data))]
+    template = config.template
+
+    samples = []
+    for _ in range(repeat):
+        for obj in objs:
+            start = time.perf_counter()
+            template.render(obj=obj)
+            samples.append(time.perf_counter() - start)
+    return {"template_render": samples}
+
+
+def query(fname: str, workdir: str, repeat: int = 3) -> Samples:
+    """
+    Times fetching the first page of results of each query in `QUERIES`, with and without a
+    search index, and building the index.
+    """
+    schema = QuerySchema(SEARCH_SCHEMA)
+    data = FileBackedJsonList(fname, auto_save=False, lazy=True)
+
+    def first_page(index=None):
+        for q in QUERIES:
+            list(itertools.islice(iter_record_indices(data, q, schema, index), PAGE_SIZE))
+
+    samples = {"scan_first_page": timeit(first_page, repeat)}
+    start = time.perf_counter()
+    index = SearchIndex.build(data, schema)
+    samples["index_build"] = [time.perf_counter() - start]
+    samples["indexed_first_page"] = timeit(lambda: first_page(index), repeat)
+    return samples
+
+
+def save(fname: str, workdir: str, repeat: int = 3) -> Samples:
+    """
+    Times updating a record and saving it, eagerly, lazily and through a journal.
+    """
+    copy = os.path.join(workdir, "save.jsonl")
+    shutil.copy(fname, copy)
+    samples = {}
+    variants: List[Tuple[str, Dict[str, Any]]] = [
+        ("eager", {"lazy": False}), ("lazy", {"lazy": True}),
+        ("journal", {"lazy": True, "journal": True, "sync_every": 1})]
+    try:
+        for name, kwargs in variants:
+            data = FileBackedJsonList(copy, auto_save=True, **kwargs)
+            rng = random.Random(0)
+
+            def update():
+                idx = rng.randrange(len(data))
+                data[idx] = dict(data[idx], _fex={"intent": "other"})
+
+            samples[f"update_{name}"] = timeit(update, repeat)
+            if kwargs.get("journal"):
+                data.compact()
+    finally:
+        for suffix in ["", INDEX_SUFFIX, ".fexlog"]:
+            if os.path.exists(copy + suffix):
+                os.remove(copy + suffix)
+    return samples
+
+
+class LocalServer:
+    """
+    Runs `fex run` on a copy of a dataset in a subprocess.
+    """
+    def __init__(self, fname: str, workdir: str, args: Sequence[str] = ()):
+        self.fname = os.path.join(workdir, "server.jsonl")
+        shutil.copy(fname, self.fname)
+        self.workdir = workdir
+        self.args = list(args)
+        with socket.socket() as s:
+            s.bind(("localhost", 0))
+            self.port = s.getsockname()[1]
+        self.process: Optional[subprocess.Popen] = None
+
+    def url(self, path: str) -> str:
+        return f"http://localhost:{self.port}{path}"
+
+    def start(self, timeout: float = 600) -> float:
+        """
+        Returns:
+            The time until the server answered its first request.
+        """
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+        start = time.perf_counter()
+        self.process = process = subprocess.Popen(
+            [sys.executable, "-m", "fastex.main", "--log-level", "warn", "run", "-p",
+             str(self.port), "--workers", "4", "--search-schema", "search.json"] + self.args +
+            [self.fname], cwd=self.workdir, env=env)
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"The server exited with code {process.returncode}")
+            try:
+                self.get("/count/")
+                return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.05)
+        raise RuntimeError("The server did not start in time")
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+        for suffix in ["", INDEX_SUFFIX, ".fexlog"]:
+            if os.path.exists(self.fname + suffix):
+                os.remove(self.fname + suffix)
+
+    def get(self, path: str):
+        with urllib.request.urlopen(self.url(path)) as response:
+            return codec.loads(response.read())
+
+    def post(self, path: str, obj):
+        request = urllib.request.Request(self.url(path), data=codec.dumps(obj).encode("utf-8"),
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request) as response:
+            return codec.loads(response.read())
+
+
+def server(fname: str, workdir: str, repeat: int = 3, requests: int = 200,
+           server_args: Sequence[str] = ()) -> Samples:
+    """
+    Times a local server: startup, `/render/` (uncached and cached), `/search/` and updates
+    (one at a time and in batches).
+    """
+    server_ = LocalServer(fname, workdir, server_args)
+    samples: Samples = {"startup": []}
+    try:
+        samples["startup"].append(server_.start())
+        count = server_.get("/count/")["value"]
+        rng = random.Random(0)
+        starts = [rng.randrange(max(1, count - 10)) for _ in range(requests)]
+
+        samples["render_page"] = timeit(
+            lambda: server_.get(f"/render/?start={starts.pop()}&count=10"), requests)
+        samples["render_page_cached"] = timeit(lambda: server_.get("/render/?start=0&count=10"),
+                                               requests)
+        for q in QUERIES:
+            server_.get("/search/?" + urllib.parse.urlencode({"q": q}))
+        samples["search_page"] = timeit(lambda: [
+            server_.get("/search/?" + urllib.parse.urlencode({"q": q, "limit": PAGE_SIZE}))
+            for q in QUERIES], repeat)
+
+        def objs(n):
+            ret = []
+            for _ in range(n):
+                idx = rng.randrange(count)
+                obj = server_.get(f"/render/?start={idx}&count=1&obj=true")["obj"][0]
+                obj["_fex"] = {"intent": "question"}
+                ret.append((idx, obj))
+            return ret
+
+        updates = objs(requests)
+        batches = [objs(50) for _ in range(repeat)]
+
+        def update():
+            idx, obj = updates.pop()
+            server_.post(f"/update/{idx}/", obj)
+
+        def update_batch():
+            server_.post("/update/batch/", {
+                "updates": [{"idx": idx, "obj": obj} for idx, obj in batches.pop()]})
+
+        samples["update"] = timeit(update, requests)
+        samples["update_batch_50"] = timeit(update_batch, repeat)
+    finally:
+        server_.stop()
+    return samples
+
+
+#: Scenarios by name, in the order they are run.
+SCENARIOS: Dict[str, Callable[..., Samples]] = {
+    "imports": imports,
+    "startup": startup,
+    "render": render,
+    "query": query,
+    "save": save,
+    "server": server,
+}
+
+__all__ = ['SCENARIOS', 'LocalServer', 'timeit']
@@ -0,0 +1,301 @@
+"""
+An asyncio serving engine for FastEx (`fex run --engine asyncio`), built on aiohttp.
+
+Connections are handled on an event loop, so that many idle annotators (e.g. waiting on
+keep-alive connections or on the `/events/` stream) cost no threads. Requests are answered by
+the same Bottle application as with the threaded engine: its handlers, which read records and
+render templates, run on thread pools (one for `/render/` and one for everything else).
+
+The engine also serves `/events/`, a stream of server-sent events that tells clients about
+updates as they happen, e.g. `event: update` with
+`data: {"idx": 3, "version": "9c1e...", "client": ...}`, where `client` is the `client` query
+parameter of the request that made the update.
+"""
+import asyncio
+import io
+import logging
+import os
+import sys
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional, Set
+
+import bottle
+
+from fastex import codec
+
+if TYPE_CHECKING:
+    from aiohttp import web
+else:
+    try:
+        from aiohttp import web
+    except ImportError:
+        web = None
+
+logger = logging.getLogger(__name__)
+
+#: Headers that only apply to a single connection and are managed by aiohttp.
+HOP_BY_HOP_HEADERS = frozenset(["connection", "keep-alive", "transfer-encoding", "upgrade"])
+#: Requests (e.g. batches of updates) may be at most this large.
+MAX_REQUEST_SIZE = 64 << 20
+
+
+class AsyncioServer(bottle.ServerAdapter):
+    """
+    Serves a WSGI application on aiohttp, calling it on a pool of `workers` threads (and
+    rendering on a pool of `render_workers` threads).
+
+    Events published with `publish` (from any thread) are sent to every client connected to
+    `/events/`, or dropped for clients that have fallen more than `max_queued_events` behind.
+    """
+    #: Seconds between comments sent to keep idle event streams open.
+    keepalive = 15.0
+    max_queued_events = 1024
+
+    def __init__(self, host='127.0.0.1', port=8080, **options):
+        if web is None:
+            raise ImportError("The asyncio engine requires aiohttp: pip install fastex[async]")
+        super().__init__(host, port, **options)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._subscribers: Set[asyncio.Queue] = set()
+
+    def publish(self, event: str, data):
+        """
+        Sends an event to the clients of `/events/`. This may be called from any thread.
+        """
+        loop = self._loop
+        if loop is None or not self._subscribers:
+            return
+        message = f"event: {event}\ndata: {codec.dumps(data)}\n\n".encode("utf-8")
+        try:
+            loop.call_soon_threadsafe(self._broadcast, message)
+        except RuntimeError:
+            # The loop has been closed.
+            pass
+
+    def _broadcast(self, message: Optional[bytes]):
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                logger.debug("Dropped an event for a slow client")
+
+    def run(self, handler):
+        workers = self.options.get("workers") or 32
+        pool = ThreadPoolExecutor(workers, thread_name_prefix="fex-io")
+        render_pool = ThreadPoolExecutor(self.options.get("render_workers") or os.cpu_count(),
+                                         thread_name_prefix="fex-render")
+        try:
+            web.run_app(self._app(handler, pool, render_pool), host=self.host, port=self.port,
+                        print=None, access_log=None if self.quiet else logger)
+        finally:
+            self._loop = None
+            pool.shutdown(wait=False)
+            render_pool.shutdown(wait=False)
+
+    def _app(self, handler, pool: ThreadPoolExecutor,
+             render_pool: ThreadPoolExecutor) -> 'web.Application':
+        """
+        Returns:
+            An aiohttp application that serves `/events/` and passes every other request to
+            the WSGI application `handler`.
+        """
+        async def events(request):
+            response = web.StreamResponse(headers={
+                "Content-Type": "text/event-stream",
+                "Cache-Control": "no-cache",
+            })
+            await response.prepare(request)
+            queue: asyncio.Queue = asyncio.Queue(self.max_queued_events)
+            self._subscribers.add(queue)
+            try:
+                await response.write(b": connected\n\n")
+                while True:
+                    try:
+                        message = await asyncio.wait_for(queue.get(), self.keepalive)
+                    except asyncio.TimeoutError:
+                        message = b": keepalive\n\n"
+                    if message is None:
+                        break
+                    await response.write(message)
+            except ConnectionResetError:
+                pass
+            finally:
+                self._subscribers.discard(queue)
+            return response
+
+        async def call_wsgi(request):
+            loop = asyncio.get_running_loop()
+            executor = render_pool if request.path.startswith("/render/") else pool
+            environ = self._environ(request, await request.read())
+            started = {}
+            #: The chunks of the response body available when the handler returns, then any
+            #: streamed chunks, then None (or an exception).
+            chunks: asyncio.Queue = asyncio.Queue(16)
+            cancelled = threading.Event()
+
+            def put(item):
+                asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+            def start_response(status, headers, exc_info=None):
+                if exc_info and started:
+                    raise exc_info[1].with_traceback(exc_info[2])
+                started["status"], started["headers"] = status, headers
+                return lambda data: put([data])
+
+            def call():
+                # Bottle keeps the request in thread-locals, so a streamed response must be
+                # iterated on the thread that handled it.
+                try:
+                    result = handler(environ, start_response)
+                    if isinstance(result, (list, tuple)):
+                        put(list(result))
+                    else:
+                        put([])
+                        try:
+                            for chunk in result:
+                                if cancelled.is_set():
+                                    break
+                                put([chunk])
+                        finally:
+                            close = getattr(result, "close", None)
+                            if close is not None:
+                                close()
+                    put(None)
+                except Exception as e:
+                    put(e)
+
+            loop.run_in_executor(executor, call)
+            response = None
+            try:
+                while True:
+                    item = await chunks.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    if response is None:
+                        response = web.StreamResponse(
+                            status=int(started["status"].split(" ", 1)[0]))
+                        for name, value in started["headers"]:
+                            if name.lower() not in HOP_BY_HOP_HEADERS:
+                                response.headers.add(name, value)
+                        await response.prepare(request)
+                    for chunk in item:
+                        await response.write(chunk)
+            finally:
+                # Unblocks the handler if the client went away.
+                cancelled.set()
+                while not chunks.empty():
+                    chunks.get_nowait()
+            await response.write_eof()
+            return response
+
+        async def on_startup(_):
+            self._loop = asyncio.get_running_loop()
+
+        async def on_shutdown(_):
+            # Ends event streams, which would otherwise keep the server from stopping.
+            self._broadcast(None)
+
+        app = web.Application(client_max_size=MAX_REQUEST_SIZE)
+        app.on_startup.append(on_startup)
+        app.on_shutdown.append(on_shutdown)
+        app.router.add_get("/events/", events)
+        app.router.add_route("*", "/{path:.*}", call_wsgi)
+        return app
+
+    def _environ(self, request, body: bytes) -> dict:
+        """
+        Returns:
+            The WSGI environment of an aiohttp request.
+        """
+        path = request.raw_path.split("?", 1)[0]
+        environ = {
+            "REQUEST_METHOD": request.method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": urllib.parse.unquote_to_bytes(path).decode("latin-1"),
+            "QUERY_STRING": request.query_string,
+            "CONTENT_TYPE": request.headers.get("Content-Type", ""),
+            "CONTENT_LENGTH": str(len(body)),
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": f"HTTP/{request.version.major}.{request.version.minor}",
+            "REMOTE_ADDR": request.remote or "",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": request.scheme,
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in request.headers.items():
+            key = "HTTP_" + name.upper().replace("-", "_")
+            if key in ("HTTP_CONTENT_TYPE", "HTTP_CONTENT_LENGTH"):
+                continue
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+
+def test_asyncio_server():
+    import pytest
+    test_utils = pytest.importorskip("aiohttp.test_utils")
+
+    app = bottle.Bottle()
+
+    @app.get('/hello/')
+    def hello():
+        return {"name": bottle.request.query.get("name")}
+
+    @app.post('/echo/<name>')
+    def echo(name):
+        bottle.response.set_header("X-Name", name)
+        return bottle.request.body.read()
+
+    @app.get('/stream/')
+    def stream():
+        # Bottle's request is thread-local, so this checks that we iterate on its thread.
+        return (f"{bottle.request.query.get('n')}:{i}\n" for i in range(3))
+
+    @app.get('/missing/')
+    def missing():
+        bottle.abort(404, "Not here")
+
+    server = AsyncioServer(port=0)
+    pool = ThreadPoolExecutor(2)
+
+    async def run():
+        client = test_utils.TestClient(test_utils.TestServer(server._app(app, pool, pool)))
+        async with client:
+            response = await client.get("/hello/?name=f%C3%A9x")
+            assert response.status == 200 and await response.json() == {"name": "féx"}
+
+            body = os.urandom(1 << 20)
+            response = await client.post("/echo/a%20b", data=body)
+            assert response.headers["X-Name"] == "a b" and await response.read() == body
+
+            response = await client.get("/stream/?n=7")
+            assert await response.text() == "7:0\n7:1\n7:2\n"
+
+            response = await client.get("/missing/")
+            assert response.status == 404 and "Not here" in await response.text()
+
+            response = await client.get("/events/")
+            assert await response.content.readline() == b": connected\n"
+            await response.content.readline()
+            # Events may be published from any thread.
+            await asyncio.get_running_loop().run_in_executor(
+                None, server.publish, "update", {"idx": 3})
+            assert await response.content.readline() == b"event: update\n"
+            assert await response.content.readline() == b'data: {"idx":3}\n'
+            response.close()
+
+    try:
+        asyncio.run(run())
+    finally:
+        pool.shutdown()
+
+
+__all__ = ['AsyncioServer']
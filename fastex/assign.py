@@ -0,0 +1,197 @@
+"""
+Assigns unlabeled records to annotators.
+
+Annotators that page through the data on their own end up labeling the same records. A
+`Scheduler` instead hands each session (e.g. a browser tab) a batch of unlabeled records that
+it leases for a while: other sessions don't get those records until the lease expires (e.g.
+because the annotator left) or the session releases them.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """
+    Leases batches of unlabeled records to sessions, for `lease_time` seconds at a time.
+
+    Records are handed out in order: those whose lease expired or was released come first, then
+    those after the furthest record handed out so far. A session's leases are renewed whenever
+    it asks for more records, and a record's lease ends when it is labeled (see `complete`).
+    `unlabeled` and `is_labeled` may read records, so they are called without holding the lock
+    that guards the leases.
+
+    Args:
+        unlabeled: Yields (in order) the indices of unlabeled records from a given index on.
+        is_labeled: Returns whether a record has been labeled since it was handed out.
+    """
+    def __init__(self, unlabeled: Callable[[int], Iterator[int]],
+                 is_labeled: Callable[[int], bool], lease_time: float = 600.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.unlabeled = unlabeled
+        self.is_labeled = is_labeled
+        self.lease_time = lease_time
+        self.clock = clock
+        self._lock = threading.Lock()
+        #: Records before this one have all been handed out at least once.
+        self._cursor = 0
+        #: A min-heap of records to hand out again.
+        self._released: List[int] = []
+        #: Maps each leased record to its session and when its lease expires.
+        self._leases: Dict[int, Tuple[str, float]] = {}
+        self._sessions: Dict[str, Set[int]] = {}
+
+    def acquire(self, session: str, count: int) -> List[int]:
+        """
+        Leases (at most) `count` more records to `session` and renews the leases it holds.
+
+        Returns:
+            The indices of the newly leased records, in order; an empty list once every
+            record is either labeled or leased.
+        """
+        with self._lock:
+            now = self.clock()
+            self._expire(now)
+            expires = now + self.lease_time
+            for idx in self._sessions.get(session, ()):
+                self._leases[idx] = (session, expires)
+            released = [heapq.heappop(self._released)
+                        for _ in range(min(count, len(self._released)))]
+
+        ret = self._lease(session, [idx for idx in released if not self.is_labeled(idx)],
+                          count, expires)
+        while len(ret) < count:
+            with self._lock:
+                cursor = self._cursor
+            candidates = list(itertools.islice(self.unlabeled(cursor), count - len(ret)))
+            if not candidates:
+                break
+            with self._lock:
+                # Other sessions may have leased some of these records in the meantime.
+                self._cursor = max(self._cursor, candidates[-1] + 1)
+            ret += self._lease(session, candidates, count - len(ret), expires)
+        return ret
+
+    def _lease(self, session: str, candidates: List[int], count: int,
+               expires: float) -> List[int]:
+        """
+        Leases (at most) `count` of `candidates` that no one holds to `session`.
+        """
+        with self._lock:
+            ret = [idx for idx in candidates if idx not in self._leases][:count]
+            if ret:
+                held = self._sessions.setdefault(session, set())
+                for idx in ret:
+                    self._leases[idx] = (session, expires)
+                    held.add(idx)
+            return ret
+
+    def complete(self, idx: int):
+        """
+        Ends the lease (if any) of a record that has been labeled.
+        """
+        with self._lock:
+            lease = self._leases.pop(idx, None)
+            if lease is not None:
+                held = self._sessions[lease[0]]
+                held.discard(idx)
+                if not held:
+                    del self._sessions[lease[0]]
+
+    def release(self, session: str, indices: Optional[Iterable[int]] = None):
+        """
+        Hands records leased to `session` (by default, all of them) back to other sessions.
+        """
+        with self._lock:
+            held = self._sessions.get(session, set())
+            for idx in list(held) if indices is None else indices:
+                if idx in held:
+                    held.discard(idx)
+                    del self._leases[idx]
+                    heapq.heappush(self._released, idx)
+            if not held:
+                self._sessions.pop(session, None)
+
+    def leased(self, session: str) -> List[int]:
+        """
+        Returns:
+            The indices of the records leased to `session`, in order.
+        """
+        with self._lock:
+            self._expire(self.clock())
+            return sorted(self._sessions.get(session, ()))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            self._expire(self.clock())
+            return {"leased": len(self._leases), "sessions": len(self._sessions)}
+
+    def _expire(self, now: float):
+        expired = [idx for idx, (_, expires) in self._leases.items() if expires <= now]
+        for idx in expired:
+            session, _ = self._leases.pop(idx)
+            held = self._sessions[session]
+            held.discard(idx)
+            if not held:
+                del self._sessions[session]
+            heapq.heappush(self._released, idx)
+        if expired:
+            logger.debug(f"Leases of {len(expired)} records expired")
+
+
+def test_scheduler():
+    labeled = {1, 4}
+    now = [0.0]
+    scheduler = Scheduler(lambda start: (i for i in range(start, 10) if i not in labeled),
+                          labeled.__contains__, lease_time=10, clock=lambda: now[0])
+
+    assert scheduler.acquire("a", 2) == [0, 2]
+    assert scheduler.acquire("b", 2) == [3, 5]
+    labeled.add(0)
+    scheduler.complete(0)
+    assert scheduler.leased("a") == [2]
+    scheduler.release("b", [5])
+    assert scheduler.acquire("c", 2) == [5, 6]
+
+    # b's lease expires (a and c renew theirs), and 3 is labeled before it is handed out again.
+    now[0] = 5
+    assert scheduler.acquire("a", 0) == [] and scheduler.acquire("c", 0) == []
+    now[0] = 12
+    assert scheduler.leased("b") == []
+    labeled.add(3)
+    assert scheduler.acquire("d", 3) == [7, 8, 9]
+    assert scheduler.acquire("d", 3) == []
+    assert scheduler.stats() == {"leased": 6, "sessions": 3}
+
+
+def test_scheduler_concurrency():
+    def unlabeled(start):
+        for idx in range(start, 500):
+            time.sleep(0.0001)
+            yield idx
+
+    scheduler = Scheduler(unlabeled, lambda idx: False)
+    leased: Dict[str, List[int]] = {}
+
+    def work(session):
+        leased[session] = []
+        while True:
+            indices = scheduler.acquire(session, 7)
+            if not indices:
+                break
+            leased[session] += indices
+
+    threads = [threading.Thread(target=work, args=(str(i),)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(sum(leased.values(), [])) == list(range(500))
+
+
+__all__ = ['Scheduler']
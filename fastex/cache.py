@@ -0,0 +1,144 @@
+"""
+Caches rendered HTML fragments.
+"""
+import hashlib
+import logging
+import os
+import threading
+from typing import Optional
+
+from jinja2 import Template
+
+from .codec import dumps
+from .util import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class RenderCache:
+    """
+    A bounded LRU cache of rendered records keyed by `(idx, version, template_hash)`.
+
+    Records are versioned by the caller, which bumps a record's version whenever it changes and
+    must read the version before reading the record that is rendered: a fragment is then never
+    stored under a newer version than that of the record it shows. `invalidate()` frees the
+    fragments of a record that changed, and `retain()` drops fragments rendered with a template
+    that has since been replaced. If `cache_dir` is provided, fragments are also saved to disk,
+    keyed by a digest of the record's contents and the template, so that they survive restarts.
+    """
+    def __init__(self, maxsize: int = 4096, cache_dir: Optional[str] = None):
+        self.cache_dir = cache_dir
+        self._cache = LRUCache(maxsize)
+        #: The number of lookups that were (not) answered from memory or disk, which requests
+        #: served on different threads update under `_lock`.
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+
+    def render(self, template: Template, template_hash: str, idx: int, version: int,
+               obj) -> str:
+        """
+        Returns:
+            `obj` (version `version` of record `idx`) rendered with `template`.
+        """
+        key = (idx, version, template_hash)
+        html = self._cache.get(key)
+        if html is not None:
+            self._count(hit=True)
+            return html
+
+        path = self._path(self.cache_dir, template_hash, obj) if self.cache_dir else None
+        if path and os.path.exists(path):
+            self._count(hit=True)
+            with open(path) as f:
+                html = f.read()
+        else:
+            self._count(hit=False)
+            html = template.render(obj=obj)
+            if path:
+                self._save(path, html)
+        self._cache.put(key, html)
+        return html
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def invalidate(self, idx: int):
+        """
+        Drops the fragments of record `idx` after it has changed (and its version was bumped).
+        """
+        for key in self._cache.keys():
+            if key[0] == idx:
+                self._cache.pop(key)
+
+    def retain(self, template_hash: str):
+        """
+        Drops every fragment that was not rendered with the template `template_hash`.
+        """
+        for key in self._cache.keys():
+            if key[2] != template_hash:
+                self._cache.pop(key)
+
+    @staticmethod
+    def _path(cache_dir: str, template_hash: str, obj) -> str:
+        digest = hashlib.sha1(dumps(obj).encode("utf-8")).hexdigest()
+        return os.path.join(cache_dir, template_hash[:16], digest[:2], digest + ".html")
+
+    @staticmethod
+    def _save(path: str, html: str):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "w") as f:
+                f.write(html)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning(f"Could not cache rendered HTML in {path}: {e}")
+
+
+def test_render_cache(tmp_path):
+    template = Template("{{ obj.text }}")
+    cache = RenderCache(maxsize=8)
+    assert cache.render(template, "t1", 0, 0, {"text": "a"}) == "a"
+    assert cache.render(template, "t1", 0, 0, {"text": "a"}) == "a"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # A new version is rendered again, and invalidate() drops the old one.
+    assert cache.render(template, "t1", 0, 1, {"text": "b"}) == "b"
+    assert cache.render(template, "t1", 1, 0, {"text": "c"}) == "c"
+    cache.invalidate(0)
+    assert list(cache._cache.keys()) == [(1, 0, "t1")]
+
+    # retain() only keeps fragments rendered with the current template.
+    assert cache.render(Template("<b>{{ obj.text }}</b>"), "t2", 1, 0, {"text": "c"}) == "<b>c</b>"
+    cache.retain("t2")
+    assert list(cache._cache.keys()) == [(1, 0, "t2")]
+
+    # Fragments saved to disk are found again by their contents, whatever the version.
+    cache = RenderCache(maxsize=8, cache_dir=str(tmp_path))
+    cache.render(template, "t1", 0, 0, {"text": "d"})
+    cache = RenderCache(maxsize=8, cache_dir=str(tmp_path))
+    assert cache.render(Template("unused"), "t1", 0, 3, {"text": "d"}) == "d"
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_render_cache_counters():
+    template = Template("{{ obj.text }}")
+    cache = RenderCache(maxsize=8)
+
+    def render():
+        for i in range(2000):
+            cache.render(template, "t1", i % 4, 0, {"text": str(i % 4)})
+
+    threads = [threading.Thread(target=render) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.hits + cache.misses == 8 * 2000 and cache.misses >= 4
+
+
+__all__ = ['RenderCache']
@@ -0,0 +1,165 @@
+"""
+JSON encoding and decoding through the fastest available backend.
+
+We prefer `orjson`, then `ujson`, and fall back to the standard library's `json` module. Values
+that a faster backend can't handle (e.g. `NaN` literals or integers beyond 64 bits) are retried
+with `json`, so every backend accepts and produces the same data. Every backend writes the same
+compact style (no spaces after separators, non-ASCII characters as is), so the files we save
+don't depend on which backend is installed.
+"""
+import json
+import logging
+import math
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union, cast
+
+logger = logging.getLogger(__name__)
+
+
+def _default(obj: Any) -> Any:
+    """
+    Encodes values that JSON backends don't know about, e.g. `fastex.compact.CompactRecord`s.
+    """
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _has_non_finite(obj: Any) -> bool:
+    """
+    Returns:
+        True iff `obj` holds a NaN or infinite float.
+    """
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, Mapping):
+        return any(_has_non_finite(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_non_finite(value) for value in obj)
+    return False
+
+
+def _json_dumps(obj: Any, sort_keys: bool) -> str:
+    return json.dumps(obj, sort_keys=sort_keys, default=_default, separators=(",", ":"),
+                      ensure_ascii=False)
+
+
+def _json_backend() -> Dict[str, Callable]:
+    return {"loads": json.loads, "dumps": _json_dumps}
+
+
+def _orjson_backend() -> Dict[str, Callable]:
+    import orjson
+
+    def dumps(obj, sort_keys):
+        ret = orjson.dumps(obj, default=_default, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+        # orjson silently writes NaN and infinities as null, which would lose data.
+        if b"null" in ret and _has_non_finite(obj):
+            raise ValueError("orjson can't encode non-finite floats")
+        return ret.decode("utf-8")
+    return {"loads": orjson.loads, "dumps": dumps}
+
+
+def _ujson_backend() -> Dict[str, Callable]:
+    import ujson
+    return {
+        "loads": ujson.loads,
+        "dumps": lambda obj, sort_keys: ujson.dumps(obj, sort_keys=sort_keys, ensure_ascii=False,
+                                                    escape_forward_slashes=False,
+                                                    default=_default),
+    }
+
+
+#: Backends in order of preference.
+BACKENDS = {
+    "orjson": _orjson_backend,
+    "ujson": _ujson_backend,
+    "json": _json_backend,
+}
+
+_backend: Dict[str, Callable] = {}
+#: The name of the backend in use.
+backend_name = ""
+
+
+def set_backend(name: Optional[str] = None):
+    """
+    Selects the JSON backend to use.
+
+    Args:
+        name: One of 'orjson', 'ujson' or 'json'. If not provided, we pick the first backend
+              that is installed.
+    """
+    global _backend, backend_name
+    for name_ in ([name] if name else BACKENDS):
+        try:
+            _backend = BACKENDS[name_]()
+            backend_name = name_
+            logger.debug(f"Using the {name_} JSON backend")
+            return
+        except ImportError:
+            if name:
+                raise
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """
+    Parses a single JSON value.
+    """
+    try:
+        return _backend["loads"](data)
+    except ValueError:
+        return json.loads(data)
+
+
+def dumps(obj: Any, sort_keys: bool = True) -> str:
+    """
+    Serializes `obj` as a single line of JSON.
+    """
+    try:
+        return _backend["dumps"](obj, sort_keys)
+    except (TypeError, ValueError, OverflowError):
+        return _json_dumps(obj, sort_keys)
+
+
+def decode_many(lines: Sequence[Union[str, bytes]]) -> List[Any]:
+    """
+    Parses a batch of JSON lines at once. This saves most of the per-call overhead of `loads`
+    by parsing the batch as a single JSON array.
+    """
+    if not lines:
+        return []
+    if isinstance(lines[0], bytes):
+        data: Union[str, bytes] = b"[" + b",".join(cast(Sequence[bytes], lines)) + b"]"
+    else:
+        data = "[" + ",".join(cast(Sequence[str], lines)) + "]"
+    try:
+        ret = loads(data)
+        if len(ret) == len(lines):
+            return ret
+    except ValueError:
+        pass
+    # Some line is malformed (or holds more than one value): parse them one by one so that the
+    # error points at the culprit.
+    return [loads(line) for line in lines]
+
+
+def test_backends_agree():
+    obj = {"b": [1, 2.5, None, True], "a": {"é": "x/y", "n": float("nan"), "i": -float("inf")}}
+    outputs = []
+    try:
+        for name in BACKENDS:
+            try:
+                set_backend(name)
+            except ImportError:
+                continue
+            outputs.append(dumps(obj))
+    finally:
+        set_backend()
+    assert outputs[0] == '{"a":{"i":-Infinity,"n":NaN,"é":"x/y"},"b":[1,2.5,null,true]}'
+    assert all(output == outputs[0] for output in outputs)
+
+
+set_backend()
+
+__all__ = ['loads', 'dumps', 'decode_many', 'set_backend']
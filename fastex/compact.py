@@ -0,0 +1,128 @@
+"""
+A compact in-memory representation of records.
+
+JSON parsers produce a dict (with its own hash table) for every object. In a fully loaded
+dataset most objects share a handful of layouts, e.g. every message has the keys `msg` and
+`user`. A `CompactRecord` only stores a tuple of values and a reference to a shared `Shape`
+that maps the (interned) keys to positions in that tuple. Records are read-only `Mapping`s, so
+templates and search filters can read them like dicts, and `expand` turns them back into dicts.
+"""
+import logging
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Shape:
+    """
+    The keys of a family of records, in order, and the position of each key.
+    """
+    __slots__ = ("keys", "positions")
+
+    def __init__(self, keys: Tuple[str, ...]):
+        self.keys = keys
+        self.positions = {key: i for i, key in enumerate(keys)}
+
+
+class CompactRecord(Mapping):
+    """
+    A read-only mapping whose keys are stored once in a shared `Shape` and whose values are
+    stored in a tuple.
+    """
+    __slots__ = ("_shape", "_values")
+
+    def __init__(self, shape: Shape, values: Tuple[Any, ...]):
+        self._shape = shape
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._shape.positions[key]]
+
+    def get(self, key, default=None):
+        i = self._shape.positions.get(key)
+        return default if i is None else self._values[i]
+
+    def __contains__(self, key):
+        return key in self._shape.positions
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._shape.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return repr(expand(self))
+
+
+class Compactor:
+    """
+    Converts parsed JSON values into `CompactRecord`s. Records with the same keys (in the same
+    order) share a `Shape`, and keys and strings of at most `max_interned_length` characters
+    (e.g. labels or speaker names) are stored once.
+    """
+    def __init__(self, max_interned_length: int = 32):
+        self.max_interned_length = max_interned_length
+        self._shapes: Dict[Tuple[str, ...], Shape] = {}
+        self._strings: Dict[str, str] = {}
+
+    def intern(self, value: str) -> str:
+        return self._strings.setdefault(value, value)
+
+    def shape(self, keys: Tuple[str, ...]) -> Shape:
+        ret = self._shapes.get(keys)
+        if ret is None:
+            ret = self._shapes[keys] = Shape(tuple(self.intern(key) for key in keys))
+        return ret
+
+    def compact(self, value: Any) -> Any:
+        """
+        Returns:
+            `value` with every dict replaced by a `CompactRecord`.
+        """
+        # Parsers only produce exact dicts, lists and strs, which are cheaper to check for.
+        type_ = type(value)
+        if type_ is dict:
+            keys = tuple(value)
+            shape = self._shapes.get(keys) or self.shape(keys)
+            compact = self.compact
+            return CompactRecord(shape, tuple([compact(v) for v in value.values()]))
+        if type_ is list:
+            compact = self.compact
+            return [compact(v) for v in value]
+        if type_ is str and len(value) <= self.max_interned_length:
+            return self._strings.setdefault(value, value)
+        return value
+
+
+def expand(value: Any) -> Any:
+    """
+    Returns:
+        `value` with every `CompactRecord` replaced by a dict.
+    """
+    if isinstance(value, CompactRecord):
+        return {key: expand(v) for key, v in zip(value._shape.keys, value._values)}
+    if isinstance(value, list):
+        return [expand(v) for v in value]
+    return value
+
+
+def test_compact():
+    from .codec import dumps, loads
+    compactor = Compactor()
+    objs = [compactor.compact({"id": i, "messages": [{"user": "A", "msg": f"Hi {i}"}],
+                               "_fex": {"label": "yes"}}) for i in range(2)]
+
+    assert objs[0]["messages"][0].get("user") == "A" and objs[0].get("title") is None
+    assert objs[0]._shape is objs[1]._shape
+    assert objs[0]["messages"][0]._shape is objs[1]["messages"][0]._shape
+    assert objs[0] == {"id": 0, "messages": [{"user": "A", "msg": "Hi 0"}],
+                       "_fex": {"label": "yes"}}
+    assert list(objs[1]) == ["id", "messages", "_fex"]
+    assert expand(objs[1]) == dict(objs[1]) and type(expand(objs[1])["_fex"]) is dict
+    assert loads(dumps(objs[1])) == expand(objs[1])
+    assert not hasattr(objs[0], "__dict__")
+
+
+__all__ = ['CompactRecord', 'Compactor', 'Shape', 'expand']
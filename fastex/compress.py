@@ -0,0 +1,150 @@
+"""
+Helpers to transparently read and write compressed (gzip or zstd) JSONL files, and to compress
+HTTP responses.
+"""
+import gzip
+import io
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    import zstandard
+else:
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#: Maps file extensions to the compression they imply.
+EXTENSIONS = {
+    ".gz": "gzip",
+    ".zst": "zstd",
+    ".zstd": "zstd",
+}
+
+
+def detect_compression(fname: str) -> Optional[str]:
+    """
+    Returns:
+        'gzip' or 'zstd' if `fname` has the extension of a compressed file, otherwise None.
+    """
+    for ext, compression in EXTENSIONS.items():
+        if fname.endswith(ext):
+            return compression
+    return None
+
+
+def require_zstandard():
+    if zstandard is None:
+        raise RuntimeError("Reading and writing .zst files requires the 'zstandard' package: "
+                           "pip install zstandard")
+    return zstandard
+
+
+def decompressor(compression: str):
+    """
+    Returns:
+        A new streaming decompressor object (with `decompress()`, `eof` and `unused_data`) for
+        a single gzip member or zstd frame.
+    """
+    if compression == "gzip":
+        import zlib
+        return zlib.decompressobj(wbits=31)
+    elif compression == "zstd":
+        return require_zstandard().ZstdDecompressor().decompressobj()
+    else:
+        raise ValueError(f"Unsupported compression: {compression}")
+
+
+def xopen(fname: str, mode: str = "r", compression: Optional[str] = None):
+    """
+    Opens `fname` like `open`, (de)compressing it on the fly if needed.
+
+    Args:
+        fname: The file to open.
+        mode: One of 'r', 'rb', 'w' or 'wb'.
+        compression: One of 'gzip' or 'zstd'; defaults to the compression implied by the file's
+                     extension (if any).
+    """
+    if compression is None:
+        compression = detect_compression(fname)
+
+    # We write UTF-8 (see `fastex.codec`) whatever the locale.
+    encoding = None if "b" in mode else "utf-8"
+    if compression is None:
+        return open(fname, mode, encoding=encoding)
+    elif compression == "gzip":
+        return gzip.open(fname, mode if "b" in mode else mode + "t", encoding=encoding)
+    elif compression == "zstd":
+        return require_zstandard().open(fname, mode, encoding=encoding)
+    else:
+        raise ValueError(f"Unsupported compression: {compression}")
+
+
+def content_encodings():
+    """
+    Returns:
+        The HTTP content codings we can produce, in order of preference.
+    """
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    Picks a content coding for a response.
+
+    Args:
+        accept_encoding: The request's `Accept-Encoding` header.
+
+    Returns:
+        The preferred coding the client accepts (with a non-zero q-value), or None.
+    """
+    accepted = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip().lower()] = q
+    for coding in content_encodings():
+        if accepted.get(coding, accepted.get("*", 0)) > 0:
+            return coding
+    return None
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """
+    Compresses a response body with the given content coding ('br' or 'gzip').
+    """
+    if encoding == "br":
+        return brotli.compress(data, quality=5)
+    elif encoding == "gzip":
+        # Without a timestamp, identical bodies compress to identical bytes. (gzip.compress only
+        # takes an mtime from Python 3.8 on.)
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=6, mtime=0) as f:
+            f.write(data)
+        return buf.getvalue()
+    else:
+        raise ValueError(f"Unsupported content coding: {encoding}")
+
+
+def test_negotiate_encoding():
+    assert negotiate_encoding("") is None
+    assert negotiate_encoding("gzip, deflate") == "gzip"
+    assert negotiate_encoding("gzip;q=0, identity") is None
+    assert negotiate_encoding("*") == content_encodings()[0]
+    assert negotiate_encoding("br;q=1.0, gzip;q=0.5") == content_encodings()[0]
+    assert gzip.decompress(compress(b"{}", "gzip")) == b"{}"
+    assert compress(b"{}", "gzip") == compress(b"{}", "gzip")
+
+
+__all__ = ['detect_compression', 'xopen', 'negotiate_encoding', 'compress']
@@ -1,15 +1,23 @@
 """
 FastEx configuration
 """
+import functools
+import hashlib
 import os
 import logging
 import re
-from typing import List, Union, TypeVar, Optional, Pattern, Dict, Type, cast, Any
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Union, TypeVar, Optional, Pattern, Dict, Type, cast, Any, Tuple, \
+    Callable, NamedTuple, TYPE_CHECKING
 
-import yamale
-import lark
-from jinja2 import Template
-from lark import Lark
+from . import codec
+from .compress import xopen
+from .util import imap_bounded
+
+# Lark is only imported (and grammars only compiled) for schemas that validate text with a grammar.
+if TYPE_CHECKING:
+    from jinja2 import Template
+    from lark import Lark
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +27,8 @@ _mypath = os.path.dirname(__file__)
 
 # region: schema
 class Schema:
+    __slots__ = ()
+
     def validate(self, obj: Any) -> bool:
         raise NotImplemented
 
@@ -40,7 +50,9 @@ class Schema:
 
 
 class ClassLabel:
-    def __init__(self, name: str, value: str = None):
+    __slots__ = ("name", "value")
+
+    def __init__(self, name: str, value: Optional[str] = None):
         self.name = name
         self.value = value or name
 
@@ -50,18 +62,21 @@ class ClassLabel:
 
 
 class ClassificationSchema(Schema):
+    __slots__ = ("values", "allow_multilabel", "_labels")
+
     def __init__(self, values: List[ClassLabel], allow_multilabel: bool = False):
         self.values = values
         self.allow_multilabel = allow_multilabel
+        self._labels = frozenset(value.value for value in values)
 
     def validate(self, obj: Union[List[str], str]) -> bool:
         if isinstance(obj, list):
             # Only allow list values if multilabel is true
             if not self.allow_multilabel:
                 return False
-            return all(any(lbl == value.value for value in self.values) for lbl in obj)
+            return all(isinstance(lbl, str) and lbl in self._labels for lbl in obj)
         else:
-            return any(obj == value.value for value in self.values)
+            return isinstance(obj, str) and obj in self._labels
 
     @classmethod
     def fromdict(cls: Type['ClassificationSchema'], obj: dict) -> 'ClassificationSchema':
@@ -79,17 +94,24 @@ class ClassificationSchema(Schema):
 
 
 class TextSchema(Schema):
+    __slots__ = ("regex_validation", "bnf_validation")
+
     def __init__(self, regex_validation: Optional[Pattern] = None,
-                 bnf_validation: Optional[Lark] = None):
+                 bnf_validation: Optional['Lark'] = None):
         self.regex_validation = regex_validation
         self.bnf_validation = bnf_validation
 
     def validate(self, obj: str) -> bool:
+        if not isinstance(obj, str):
+            return False
         if self.regex_validation:
             if not self.regex_validation.match(obj):
                 return False
         if self.bnf_validation:
-            if not self.bnf_validation.parse(obj):
+            from lark.exceptions import LarkError
+            try:
+                self.bnf_validation.parse(obj)
+            except LarkError:
                 return False
         return True
 
@@ -98,27 +120,111 @@ class TextSchema(Schema):
         # We assume that obj has been validated by our schema already, so don't repeat checks here.
         regex_validation = bnf_validation = None
         if 'regex-validation' in obj:
-            regex_validation = re.compile(obj['regex-validation'])
+            regex_validation = compile_regex(obj['regex-validation'])
         if 'bnf-validation' in obj:
-            bnf_validation = Lark(obj['bnf-validation'])
+            bnf_validation = compile_grammar(obj['bnf-validation'],
+                                             obj.get('bnf-parser', 'earley'))
 
         return cls(regex_validation, bnf_validation)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_regex(pattern: str) -> Pattern:
+    return re.compile(pattern)
+
+
+#: Parsers we have compiled, keyed by their algorithm and a hash of their grammar, so that they
+#: survive reloads.
+_parsers: Dict[Tuple[str, str], 'Lark'] = {}
+
+
+def compile_grammar(grammar: str, parser: str = 'earley') -> 'Lark':
+    """
+    Compiles a lark grammar into a parser, which is cached by grammar.
+
+    Args:
+        grammar: A lark grammar.
+        parser: 'earley' (the default) accepts any grammar. 'lalr' is much faster but only
+                accepts LALR(1) grammars (raising a `GrammarError` for others), and may reject
+                inputs that are ambiguous or need more lookahead.
+    """
+    from lark import Lark
+
+    key = (parser, hashlib.sha1(grammar.encode("utf-8")).hexdigest())
+    if key not in _parsers:
+        _parsers[key] = Lark(grammar, parser=cast(Any, parser))
+    return _parsers[key]
+
+
+#: Schemas used by `validate_many` worker processes.
+_worker_schemas: Dict[str, Schema] = {}
+
+
+def _init_validator(schema_cfg: dict):
+    global _worker_schemas
+    _worker_schemas = {name: Schema.fromdict(schema) for name, schema in schema_cfg.items()}
+
+
+def _validate_batch(batch: List[Tuple[int, bytes]]) -> List[Tuple[int, str, Any]]:
+    errors = []
+    for idx, obj in zip((i for i, _ in batch), codec.decode_many([line for _, line in batch])):
+        annotations = obj.get("_fex") or {}
+        for name, value in annotations.items():
+            schema = _worker_schemas.get(name)
+            if schema is not None and not schema.validate(value):
+                errors.append((idx, name, value))
+    return errors
 # endregion
 
 
+@functools.lru_cache(maxsize=None)
+def _config_schema():
+    """
+    Returns:
+        The Yamale schema that configuration files are validated against, which we only build
+        once rather than on every reload.
+    """
+    import yamale
+    return yamale.make_schema(os.path.join(_mypath, 'templates', 'fex.yamale'))
+
+
+class ConfigState(NamedTuple):
+    """
+    Everything derived from a configuration file. A `Config` swaps its state out as a whole, so
+    holding on to a `ConfigState` gives a consistent view even while the file is reloaded.
+    """
+    cfg: dict
+    template: 'Template'
+    template_hash: str
+    schemas: Dict[str, Schema]
+
+    @classmethod
+    def fromdict(cls, cfg: dict) -> 'ConfigState':
+        from jinja2 import Template
+
+        return cls(
+            cfg,
+            Template(cfg["template"]),
+            hashlib.sha1(cfg["template"].encode("utf-8")).hexdigest(),
+            {name: Schema.fromdict(schema) for name, schema in cfg.get("schema", {}).items()},
+        )
+
+
 class Config:
     """
     Stores the configuration of a FastEx server.
     """
     def __init__(self, cfg: dict, path=None):
-        self.cfg = cfg
         self._path = path
         #: If we have been provided a path, we track its last modified time so that we can reload
         # when it changes.
         self._last_mtime = self._path and os.stat(self._path).st_mtime
-        self._template = Template(self.cfg["template"])
-        self._schemas = {name: Schema.fromdict(schema)
-                         for name, schema in self.cfg.get("schema", {}).items()}
+        self._state = ConfigState.fromdict(cfg)
+        self._listeners: List[Callable[['Config'], None]] = []
+
+    @property
+    def path(self) -> Optional[str]:
+        return self._path
 
     @property
     def dirty(self) -> bool:
@@ -132,31 +238,100 @@ class Config:
     def reload(self):
         """
         Reloads our configuration from file, if one was provided at construction time.
+
+        The new configuration is built completely before it replaces the current one, so readers
+        see either the old or the new state, never a mix. Listeners registered with
+        `add_listener` are called afterwards.
         """
         if self._path:
             logger.info(f"Reloading configuration from {self._path}")
-            self.cfg = self._load(self._path)
-            self._template = Template(self.cfg["template"])
-            self._schemas = {name: Schema.fromdict(schema)
-                             for name, schema in self.cfg.get("schema", {}).items()}
+            self._last_mtime = os.stat(self._path).st_mtime
+            self._state = ConfigState.fromdict(self._load(self._path))
+            for listener in self._listeners:
+                listener(self)
+
+    def add_listener(self, listener: Callable[['Config'], None]):
+        """
+        Registers a function to call with this configuration whenever it is reloaded.
+        """
+        self._listeners.append(listener)
+
+    @property
+    def state(self) -> ConfigState:
+        return self._state
+
+    @property
+    def cfg(self) -> dict:
+        return self._state.cfg
 
     @property
     def template(self):
-        return self._template
+        return self._state.template
+
+    @property
+    def template_hash(self) -> str:
+        """
+        A digest of the template source, which changes whenever the template does.
+        """
+        return self._state.template_hash
 
     @property
     def schemas(self) -> Dict[str, Schema]:
-        return self._schemas
+        return self._state.schemas
+
+    def validate_many(self, fname: str, processes: Optional[int] = None,
+                      batch_size: int = 1024) -> List[Tuple[int, str, Any]]:
+        """
+        Checks every annotation (in the `_fex` field of each object) of a JSONL file against our
+        schemas, in parallel.
+
+        Args:
+            fname: Path to a (possibly compressed) JSONL file.
+            processes: The number of worker processes to use (defaults to the number of CPUs).
+            batch_size: The number of objects sent to a worker at a time.
+
+        Returns:
+            A list of `(idx, field, value)` for every annotation that does not validate, sorted
+            by `idx`.
+        """
+        schema_cfg = self.cfg.get("schema", {})
+        processes = processes or os.cpu_count() or 1
+
+        def batches():
+            batch, idx = [], 0
+            with xopen(fname, "rb") as f:
+                for line in f:
+                    if line.strip():
+                        batch.append((idx, line))
+                        idx += 1
+                        if len(batch) >= batch_size:
+                            yield batch
+                            batch = []
+            if batch:
+                yield batch
+
+        errors = []
+        if processes == 1:
+            _init_validator(schema_cfg)
+            for batch in batches():
+                errors.extend(_validate_batch(batch))
+        else:
+            with ProcessPoolExecutor(processes, initializer=_init_validator,
+                                     initargs=(schema_cfg,)) as pool:
+                for errors_ in imap_bounded(pool, _validate_batch, batches(), 2 * processes):
+                    errors.extend(errors_)
+        return sorted(errors, key=lambda error: error[0])
 
     @classmethod
     def _load(cls, path: str) -> dict:
         """
         See `Config.load`
         """
-        schema = yamale.make_schema(os.path.join(_mypath, 'templates', 'fex.yamale'))
+        import yamale
+
         logger.info(f"Loading configuration from {path}")
         config = yamale.make_data(path)
-        yamale.validate(schema, config)
+        yamale.validate(_config_schema(), config)
         logger.info(f"Configuration validated")
 
         # Yamale's make_data actually loads the data as a tuple of
@@ -178,7 +353,48 @@ class Config:
             This method throws a `SyntaxError` if the provided YAML file does not parse and a
             `ValueError` if the YAML does not validate against our schema.
         """
-        return cls(cls._load(path))
-
-
-__all__ = ['Config', 'Schema']
+        return cls(cls._load(path), path)
+
+
+def test_validate_many(tmp_path):
+    config = Config({
+        "template": "{{obj}}",
+        "schema": {
+            "intent": {"type": "classification", "values": [{"name": "A"}, {"name": "B"}]},
+            "notes": {"type": "text", "bnf-validation": 'start: "ok" | "fine"'},
+        },
+    })
+    fname = str(tmp_path / "data.jsonl")
+    with open(fname, "w") as f:
+        f.write('{"_fex": {"intent": "A", "notes": "ok"}}\n'
+                '{"_fex": {"intent": "C"}}\n'
+                '{}\n'
+                '{"_fex": {"intent": ["A"], "notes": "bad"}}\n')
+
+    expected = [(1, "intent", "C"), (3, "intent", ["A"]), (3, "notes", "bad")]
+    assert config.validate_many(fname, processes=1, batch_size=2) == expected
+    assert config.validate_many(fname, processes=2, batch_size=1) == expected
+
+
+def test_bnf_parser():
+    from lark.exceptions import GrammarError
+
+    # Earley (the default) handles any grammar; LALR only handles LALR(1) ones.
+    grammar = 'start: "a" "b" | "a" "c"\n'
+    for parser in ["earley", "lalr"]:
+        schema = TextSchema.fromdict({"type": "text", "bnf-validation": grammar,
+                                      "bnf-parser": parser})
+        assert [schema.validate(text) for text in ["ab", "ac", "ad", ""]] == \
+            [True, True, False, False]
+
+    grammar = 'start: a "x" "z" | b "x" "y"\na: "n"\nb: "n"\n'
+    schema = TextSchema.fromdict({"type": "text", "bnf-validation": grammar})
+    assert schema.validate("nxz") and schema.validate("nxy") and not schema.validate("nxx")
+    try:
+        compile_grammar(grammar, 'lalr')
+        assert False, "Expected a GrammarError"
+    except GrammarError:
+        pass
+
+
+__all__ = ['Config', 'ConfigState', 'Schema']
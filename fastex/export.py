@@ -0,0 +1,166 @@
+"""
+Renders the objects of a JSONL file to individual HTML files.
+
+The input is streamed and rendered in batches over a process pool. Every exported record is
+recorded in a manifest of digests (over the raw record and the template), so that incremental
+exports only re-render records whose output is out of date.
+"""
+import functools
+import hashlib
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+from jinja2 import Template
+
+from .codec import loads
+from .compress import xopen
+from .util import imap_bounded
+
+logger = logging.getLogger(__name__)
+
+#: Name of the manifest file kept in the output directory.
+MANIFEST = ".fexmanifest"
+#: Size (in bytes) of the digest stored for each record in the manifest.
+DIGEST_SIZE = 16
+
+#: The template used by this (worker) process; see `_init_worker`.
+_template: Optional[Template] = None
+
+
+def _init_worker(template_source: str):
+    """
+    Compiles the template once per worker process.
+    """
+    global _template
+    _template = Template(template_source)
+
+
+def _render_batch(output: str, batch: List[Tuple[int, bytes]]) -> int:
+    assert _template is not None, "_init_worker() must be called first"
+    for i, line in batch:
+        with open(os.path.join(output, "{}.html".format(i)), "w") as f:
+            f.write(_template.render(obj=loads(line)))
+    return len(batch)
+
+
+def _load_manifest(output: str) -> bytes:
+    path = os.path.join(output, MANIFEST)
+    if not os.path.exists(path):
+        return b""
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _save_manifest(output: str, digests: bytes):
+    path = os.path.join(output, MANIFEST)
+    with open(path + ".tmp", "wb") as f:
+        f.write(digests)
+    os.replace(path + ".tmp", path)
+
+
+def export(fname: str, template_source: str, output: str, processes: Optional[int] = None,
+           incremental: bool = False, batch_size: int = 256) -> Tuple[int, int]:
+    """
+    Renders every object in `fname` to `<output>/<i>.html`.
+
+    Args:
+        fname: Path to a JSONL file.
+        template_source: A Jinja2 template that is provided `obj`.
+        output: The directory to save HTML files to; it must already exist.
+        processes: The number of worker processes to render with (defaults to the number of
+                   CPUs). With a single process, we render in this process.
+        incremental: If true, skip records whose output is already current according to the
+                     manifest of a previous export.
+        batch_size: The number of records sent to a worker at a time.
+
+    Returns:
+        The number of records in `fname` and the number of records that were rendered.
+    """
+    processes = processes or os.cpu_count() or 1
+    key = hashlib.blake2b(template_source.encode("utf-8"), digest_size=DIGEST_SIZE).digest()
+    previous = _load_manifest(output) if incremental else b""
+    digests = bytearray()
+    count = rendered = 0
+
+    def batches():
+        nonlocal count
+        batch = []
+        with xopen(fname, "rb") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                i = count
+                count += 1
+                digest = hashlib.blake2b(line, key=key, digest_size=DIGEST_SIZE).digest()
+                digests.extend(digest)
+                if previous[i * DIGEST_SIZE: (i + 1) * DIGEST_SIZE] == digest and \
+                        os.path.exists(os.path.join(output, "{}.html".format(i))):
+                    continue
+                batch.append((i, line))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    if processes == 1:
+        _init_worker(template_source)
+        for batch in batches():
+            rendered += _render_batch(output, batch)
+    else:
+        with ProcessPoolExecutor(processes, initializer=_init_worker,
+                                 initargs=(template_source,)) as pool:
+            # Bound the number of batches in flight so that we never buffer the whole input.
+            rendered += sum(imap_bounded(pool, functools.partial(_render_batch, output),
+                                         batches(), 2 * processes))
+
+    # Remove the output of records that are no longer in the input.
+    for i in range(count, len(previous) // DIGEST_SIZE):
+        path = os.path.join(output, "{}.html".format(i))
+        if os.path.exists(path):
+            os.remove(path)
+    _save_manifest(output, bytes(digests))
+
+    return count, rendered
+
+
+def test_incremental_export(tmp_path):
+    fname = str(tmp_path / "data.jsonl")
+    output = str(tmp_path / "out")
+    os.mkdir(output)
+
+    def write(*objs):
+        with open(fname, "w") as f:
+            f.write("".join('{"text": "%s"}\n' % obj for obj in objs))
+
+    def read(i):
+        with open(os.path.join(output, f"{i}.html")) as f:
+            return f.read()
+
+    write("a", "b", "c")
+    assert export(fname, "{{ obj.text }}", output, processes=1, incremental=True) == (3, 3)
+    assert read(2) == "c"
+    assert os.path.getsize(os.path.join(output, MANIFEST)) == 3 * DIGEST_SIZE
+    assert export(fname, "{{ obj.text }}", output, processes=1, incremental=True) == (3, 0)
+
+    # Only changed records and those whose output is missing are rendered again.
+    write("a", "B", "c")
+    os.remove(os.path.join(output, "0.html"))
+    assert export(fname, "{{ obj.text }}", output, processes=2, incremental=True) == (3, 2)
+    assert read(0) == "a" and read(1) == "B"
+
+    # A new template invalidates every record, and the output of removed records is deleted.
+    write("a", "B")
+    assert export(fname, "<p>{{ obj.text }}</p>", output, processes=1, incremental=True) == (2, 2)
+    assert read(1) == "<p>B</p>"
+    assert sorted(os.listdir(output)) == [MANIFEST, "0.html", "1.html"]
+    assert os.path.getsize(os.path.join(output, MANIFEST)) == 2 * DIGEST_SIZE
+
+    # Non-incremental exports render everything.
+    assert export(fname, "<p>{{ obj.text }}</p>", output, processes=1) == (2, 2)
+
+
+__all__ = ['export']
@@ -0,0 +1,440 @@
+"""
+Byte-offset indices over JSONL files.
+
+A `LineIndex` records where every record of a JSONL file starts so that
+individual records can be read (and parsed) on demand instead of loading the
+whole file into memory. A `BlockIndex` does the same for compressed files.
+"""
+import bisect
+import json
+import logging
+import mmap
+import os
+import threading
+from array import array
+from typing import Any, BinaryIO, List, Optional, Tuple
+
+from .compress import decompressor, detect_compression
+
+logger = logging.getLogger(__name__)
+
+#: Suffix of the sidecar file an index is cached in.
+INDEX_SUFFIX = ".fexidx"
+#: Bumped whenever the on-disk layout of the sidecar file changes.
+INDEX_VERSION = 1
+
+
+class LineIndex:
+    """
+    Stores the byte offset of every non-empty line in a JSONL file.
+
+    Offsets are kept in a compact `array` with a trailing sentinel (the size of the file), so that
+    record `i` spans the bytes `[offsets[i], offsets[i+1])`. The span may include trailing blank
+    lines, which JSON parsers ignore.
+
+    Once `map()` is called, records are read as slices of a read-only memory map of the file
+    instead of through seeks and reads.
+    """
+    def __init__(self, fname: str, offsets: array, mtime_ns: int, size: int):
+        self.fname = fname
+        self.offsets = offsets
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self._fh: Optional[BinaryIO] = None
+        self._map: Optional[mmap.mmap] = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def span(self, idx: int) -> Tuple[int, int]:
+        """
+        Returns:
+            The `(start, end)` byte range of record `idx`.
+        """
+        return self.offsets[idx], self.offsets[idx + 1]
+
+    def read(self, idx: int) -> bytes:
+        """
+        Returns:
+            The raw bytes of record `idx`.
+        """
+        start, end = self.span(idx)
+        if self._map is not None:
+            return self._map[start:end]
+        with self._lock:
+            fh = self._file()
+            fh.seek(start)
+            return fh.read(end - start)
+
+    def _file(self) -> BinaryIO:
+        """
+        Returns:
+            The indexed file, opened on first use. The caller must hold the lock.
+        """
+        if self._fh is None:
+            self._fh = open(self.fname, "rb")
+        return self._fh
+
+    def view(self, idx: int) -> memoryview:
+        """
+        Returns:
+            The raw bytes of record `idx` without copying them out of the memory map (if the
+            file is mapped).
+        """
+        if self._map is None:
+            return memoryview(self.read(idx))
+        start, end = self.span(idx)
+        return memoryview(self._map)[start:end]
+
+    def map(self) -> bool:
+        """
+        Memory-maps the indexed file. The file must not be modified while it is mapped.
+
+        Returns:
+            True iff the file could be mapped.
+        """
+        with self._lock:
+            if self._map is None and self.size > 0:
+                with open(self.fname, "rb") as f:
+                    self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map is not None
+
+    @property
+    def mapped(self) -> bool:
+        return self._map is not None
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+            if self._map is not None:
+                try:
+                    self._map.close()
+                except BufferError:
+                    # A view of it is still in use: it is unmapped once that is released.
+                    pass
+                self._map = None
+
+    @property
+    def sidecar(self) -> str:
+        return self.fname + INDEX_SUFFIX
+
+    def is_current(self) -> bool:
+        """
+        Returns:
+            True iff the indexed file has not been modified since this index was built.
+        """
+        try:
+            stat = os.stat(self.fname)
+        except FileNotFoundError:
+            return False
+        return stat.st_mtime_ns == self.mtime_ns and stat.st_size == self.size
+
+    @classmethod
+    def build(cls, fname: str) -> 'LineIndex':
+        """
+        Indexes `fname` in a single pass over the file.
+        """
+        stat = os.stat(fname)
+        offsets = array('Q')
+        pos = 0
+        with open(fname, "rb") as f:
+            for line in f:
+                if line.strip():
+                    offsets.append(pos)
+                pos += len(line)
+        offsets.append(pos)
+        logger.info(f"Indexed {len(offsets) - 1} records in {fname}")
+        return cls(fname, offsets, stat.st_mtime_ns, stat.st_size)
+
+    def save(self):
+        """
+        Saves this index to its sidecar file. Failures (e.g. a read-only directory) are logged
+        but otherwise ignored: the index will simply be rebuilt next time.
+        """
+        tmp = self.sidecar + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(json.dumps(self._header()).encode("utf-8"))
+                f.write(b"\n")
+                self._write_arrays(f)
+            os.replace(tmp, self.sidecar)
+        except OSError as e:
+            logger.warning(f"Could not save index for {self.fname}: {e}")
+
+    def _header(self) -> dict:
+        return {
+            "version": INDEX_VERSION,
+            "mtime_ns": self.mtime_ns,
+            "size": self.size,
+            "count": len(self),
+            "typecode": self.offsets.typecode,
+        }
+
+    def _write_arrays(self, f: BinaryIO):
+        self.offsets.tofile(f)
+
+    @classmethod
+    def _read(cls, fname: str, header: dict, f: BinaryIO) -> 'LineIndex':
+        """
+        Reads the rest of a sidecar file after its header.
+        """
+        offsets = array(header["typecode"])
+        offsets.fromfile(f, header["count"] + 1)
+        return cls(fname, offsets, header["mtime_ns"], header["size"])
+
+    @classmethod
+    def load(cls, fname: str) -> Optional['LineIndex']:
+        """
+        Loads the sidecar index for `fname`.
+
+        Returns:
+            The saved index if one exists and is still current, otherwise None.
+        """
+        try:
+            with open(fname + INDEX_SUFFIX, "rb") as f:
+                header = json.loads(f.readline())
+                if header.get("version") != INDEX_VERSION:
+                    return None
+                ret = cls._read(fname, header, f)
+        except (OSError, ValueError, EOFError, KeyError):
+            return None
+        return ret if ret.is_current() else None
+
+    @classmethod
+    def open(cls, fname: str) -> 'LineIndex':
+        """
+        Loads the sidecar index for `fname` if it is current, or otherwise builds (and saves) a
+        new one.
+        """
+        ret = cls.load(fname)
+        if ret is None:
+            ret = cls.build(fname)
+            ret.save()
+        return ret
+
+
+class BlockIndex(LineIndex):
+    """
+    Indexes a gzip- or zstd-compressed JSONL file.
+
+    Offsets refer to the decompressed stream. While building the index we also record
+    checkpoints roughly every `block_size` decompressed bytes from which decompression can be
+    resumed: a copy of the decompressor's state (gzip) or the start of a new frame or member
+    (zstd and gzip). Reading a record then only decompresses the block it lives in, rather than
+    the whole prefix of the file.
+
+    Like a `LineIndex`, the index is saved to a sidecar file, unless it holds decompressor
+    states (which can't be serialized): gzip files that consist of a single large member are
+    re-indexed each time they are opened. Records of a zstd file can only be read from the
+    start of the frame they are in, so zstd files should be written in many small frames (e.g.
+    by `pzstd`); we warn about files whose frames are much larger than `block_size`.
+    """
+    #: Size of the compressed chunks we read at a time.
+    CHUNK_SIZE = 1 << 16
+    #: Blocks larger than this (e.g. single-frame zstd files) are streamed instead of cached.
+    MAX_CACHED_BLOCK = 64 << 20
+
+    def __init__(self, fname: str, offsets: array, mtime_ns: int, size: int, compression: str,
+                 checkpoints: List[Tuple[int, int, Any]]):
+        super().__init__(fname, offsets, mtime_ns, size)
+        self.compression = compression
+        self._cp_offsets = array('Q', [cp[0] for cp in checkpoints])
+        self._checkpoints = checkpoints
+        self._block: Tuple[int, bytes] = (-1, b"")
+
+    @classmethod
+    def build(cls, fname: str, block_size: int = 16 << 20) -> 'BlockIndex':
+        """
+        Indexes `fname` in a single pass of decompression.
+        """
+        compression = detect_compression(fname)
+        if compression is None:
+            raise ValueError(f"{fname} is not a compressed file")
+        stat = os.stat(fname)
+        offsets = array('Q')
+        # Checkpoints are (decompressed offset, compressed offset, decompressor state or None).
+        checkpoints: List[Tuple[int, int, Any]] = [(0, 0, None)]
+        upos = cpos = line_start = 0
+        nonblank = False
+
+        d = decompressor(compression)
+        with open(fname, "rb") as f:
+            while True:
+                chunk = f.read(cls.CHUNK_SIZE)
+                if not chunk:
+                    break
+                cpos += len(chunk)
+                while chunk:
+                    out = d.decompress(chunk)
+                    pos = 0
+                    while True:
+                        nl = out.find(b"\n", pos)
+                        if not nonblank and out[pos: nl if nl >= 0 else len(out)].strip():
+                            nonblank = True
+                        if nl < 0:
+                            break
+                        if nonblank:
+                            offsets.append(line_start)
+                        line_start, nonblank, pos = upos + nl + 1, False, nl + 1
+                    upos += len(out)
+
+                    if d.eof:
+                        # A new gzip member or zstd frame starts here.
+                        chunk = d.unused_data
+                        d = decompressor(compression)
+                        if upos - checkpoints[-1][0] >= block_size:
+                            checkpoints.append((upos, cpos - len(chunk), None))
+                    else:
+                        chunk = b""
+                if compression == "gzip" and upos - checkpoints[-1][0] >= block_size:
+                    checkpoints.append((upos, cpos, d.copy()))
+        if nonblank:
+            offsets.append(line_start)
+        offsets.append(upos)
+        if len(checkpoints) > 1 and checkpoints[-1][0] == upos:
+            # The last frame or member ended a block: there is nothing after it.
+            checkpoints.pop()
+        logger.info(f"Indexed {len(offsets) - 1} records in {fname} "
+                    f"({len(checkpoints)} blocks)")
+        if compression == "zstd":
+            starts = [cp[0] for cp in checkpoints] + [upos]
+            largest = max(end - start for start, end in zip(starts, starts[1:]))
+            if largest > 2 * block_size:
+                logger.warning(f"{fname} has zstd frames of up to {largest >> 20} MiB, which are "
+                               f"decompressed from their start to read any record in them; "
+                               f"compress it in smaller frames (e.g. with pzstd) to read "
+                               f"records faster")
+        return cls(fname, offsets, stat.st_mtime_ns, stat.st_size, compression, checkpoints)
+
+    def _stream(self, checkpoint: int):
+        """
+        Yields decompressed chunks starting from the given checkpoint.
+        """
+        _, cpos, state = self._checkpoints[checkpoint]
+        d = state.copy() if state is not None else decompressor(self.compression)
+        fh = self._file()
+        fh.seek(cpos)
+        while True:
+            chunk = fh.read(self.CHUNK_SIZE)
+            if not chunk:
+                return
+            while chunk:
+                out = d.decompress(chunk)
+                if out:
+                    yield out
+                if d.eof:
+                    chunk = d.unused_data
+                    d = decompressor(self.compression)
+                else:
+                    chunk = b""
+
+    def _read_range(self, checkpoint: int, start: int, end: int) -> bytes:
+        """
+        Decompresses bytes `[start, end)` of the stream, starting from a checkpoint before them.
+        """
+        pos = self._checkpoints[checkpoint][0]
+        ret = []
+        for out in self._stream(checkpoint):
+            if pos + len(out) > start:
+                ret.append(out[max(0, start - pos): end - pos])
+            pos += len(out)
+            if pos >= end:
+                break
+        return b"".join(ret)
+
+    def read(self, idx: int) -> bytes:
+        start, end = self.span(idx)
+        with self._lock:
+            b = bisect.bisect_right(self._cp_offsets, start) - 1
+            block_start = self._cp_offsets[b]
+            block_end = self._cp_offsets[b + 1] if b + 1 < len(self._cp_offsets) \
+                else self.offsets[-1]
+            if end > block_end or block_end - block_start > self.MAX_CACHED_BLOCK:
+                return self._read_range(b, start, end)
+            # Neighbouring records are usually read together, so keep the last block around.
+            if self._block[0] != b:
+                self._block = (b, self._read_range(b, block_start, block_end))
+            return self._block[1][start - block_start: end - block_start]
+
+    def map(self) -> bool:
+        """
+        Does nothing: offsets refer to the decompressed stream, which can't be mapped.
+        """
+        return False
+
+    def close(self):
+        super().close()
+        self._block = (-1, b"")
+
+    def save(self):
+        """
+        Saves this index to its sidecar file if all its checkpoints are the starts of zstd frames
+        or gzip members.
+        """
+        if any(state is not None for _, _, state in self._checkpoints):
+            logger.debug(f"Not saving the index of {self.fname}, which holds gzip states")
+            return
+        super().save()
+
+    def _header(self) -> dict:
+        header = super()._header()
+        header.update(compression=self.compression, checkpoints=len(self._checkpoints))
+        return header
+
+    def _write_arrays(self, f: BinaryIO):
+        super()._write_arrays(f)
+        self._cp_offsets.tofile(f)
+        array('Q', [cp[1] for cp in self._checkpoints]).tofile(f)
+
+    @classmethod
+    def _read(cls, fname: str, header: dict, f: BinaryIO) -> 'BlockIndex':
+        if header["compression"] != detect_compression(fname):
+            raise ValueError(f"The index of {fname} is for another compression")
+        offsets = array(header["typecode"])
+        offsets.fromfile(f, header["count"] + 1)
+        upos, cpos = array('Q'), array('Q')
+        upos.fromfile(f, header["checkpoints"])
+        cpos.fromfile(f, header["checkpoints"])
+        return cls(fname, offsets, header["mtime_ns"], header["size"], header["compression"],
+                   [(u, c, None) for u, c in zip(upos, cpos)])
+
+
+def open_index(fname: str) -> LineIndex:
+    """
+    Opens a `LineIndex` for `fname`, or a `BlockIndex` if the file is compressed.
+    """
+    if detect_compression(fname):
+        return BlockIndex.open(fname)
+    return LineIndex.open(fname)
+
+
+def test_block_index_sidecar(tmp_path, caplog):
+    import pytest
+    zstandard = pytest.importorskip("zstandard")
+
+    lines = [b'{"id": %d}\n' % i for i in range(1000)]
+    fname = str(tmp_path / "data.jsonl.zst")
+    with open(fname, "wb") as f:
+        for i in range(0, len(lines), 100):
+            f.write(zstandard.ZstdCompressor().compress(b"".join(lines[i:i + 100])))
+
+    index = BlockIndex.build(fname, block_size=1024)
+    assert len(index._checkpoints) == 10 and "frames" not in caplog.text
+    index.save()
+    loaded = BlockIndex.load(fname)
+    assert loaded is not None and loaded._checkpoints == index._checkpoints
+    assert [loaded.read(i) for i in (0, 555, 999)] == [lines[0], lines[555], lines[999]]
+    loaded.close()
+
+    # A single frame can't be indexed in blocks.
+    with open(fname, "wb") as f:
+        f.write(zstandard.ZstdCompressor().compress(b"".join(lines)))
+    assert BlockIndex.load(fname) is None
+    assert len(BlockIndex.build(fname, block_size=1024)._checkpoints) == 1
+    assert "zstd frames of up to" in caplog.text
+
+
+__all__ = ['LineIndex', 'BlockIndex', 'open_index']
@@ -17,18 +17,17 @@ arbitrary HTML. By default, we import Bootstrap4 to style the page.
 Finally, if you would like to label data, simply describe its schema in
 `fex.yaml`.
 """
+import json
 import logging
 import os
 import shutil
 import sys
+from typing import TYPE_CHECKING
 
-import yamale
-from bottle import abort
-from fastex.config import Config
-from fastex.server import serve
-from jinja2 import Template
-
-from .util import load_jsonl, FileBackedJsonList
+# Subcommands import what they need when they run, so that e.g. `fex init` or `fex --help` don't
+# pay for loading Bottle, Jinja2, Yamale or Lark.
+if TYPE_CHECKING:
+    from fastex.config import Config
 
 logger = logging.getLogger(__name__)
 
@@ -52,41 +51,103 @@ def do_init(args):
                 "template used to render objects and the annotation schema")
 
 
+def _load_config() -> 'Config':
+    """
+    Loads 'fex.yaml' from the current directory, or our default configuration if there is none.
+    """
+    from fastex.config import Config
+
+    if os.path.exists("fex.yaml"):
+        return Config.load("fex.yaml")
+    else:
+        return Config.load(os.path.join(_mypath, "templates", "fex.yaml"))
+
+
 def do_serve(args):
     """
     Start the FastEx webserver
     """
+    from fastex.cache import RenderCache
+    from fastex.metrics import Profiler
+    from fastex.scan import ParallelScanner
+    from fastex.search import QuerySchema, SearchIndex
+    from fastex.server import serve
+    from fastex.store import AnnotationStore
+    from fastex.util import open_dataset
+
     # 0. Find experiment dir.
-    if os.path.exists("fex.yaml"):
-        config = Config.load("fex.yaml")
-    else:
-        config = Config.load(os.path.join(_mypath, "templates", "fex.yaml"))
+    config = _load_config()
 
-    data = FileBackedJsonList(args.input, auto_save=False)
+    if args.read_only and (args.eager or args.journal):
+        logger.error("--read-only can't be combined with --eager or --journal")
+        sys.exit(1)
+    data = open_dataset(args.input, auto_save=False, lazy=not args.eager,
+                        cache_size=args.cache_size, journal=args.journal, keep_raw=args.keep_raw,
+                        mmap=args.read_only, compact=args.compact)
     # TODO: save a backup
     logger.info("Serving %d inputs ", len(data))
 
-    serve(data, config, port=args.port)
+    query_schema = search_index = None
+    if args.search_schema:
+        with open(args.search_schema) as f:
+            query_schema = QuerySchema(json.load(f))
+        if args.search_index:
+            search_index = SearchIndex.build(data, query_schema)
+    scanner = None
+    if args.search_processes and search_index is None:
+        scanner = ParallelScanner(args.search_processes if args.search_processes > 0 else None)
+
+    render_cache = None
+    if args.render_cache_size > 0:
+        render_cache = RenderCache(args.render_cache_size, cache_dir=args.render_cache_dir)
+
+    store = AnnotationStore(args.store) if args.store else None
+    profiler = Profiler(args.profile, keep=args.profile_keep) if args.profile else None
+
+    try:
+        serve(data, config, port=args.port, host=args.host, workers=args.workers,
+              query_schema=query_schema, search_index=search_index, render_cache=render_cache,
+              store=store, profiler=profiler, scanner=scanner, read_only=args.read_only,
+              engine=args.engine, lease_time=args.lease_time)
+    finally:
+        if scanner is not None:
+            scanner.close()
 
 
 def do_export(args):
     """
     Renders the provided input to individual HTML files
     """
+    from fastex.export import export
+
     # 0. Find experiment dir.
-    data = load_jsonl(args.input)
-    logger.info("Saving %d inputs ", len(data))
-    with open(args.template) as f:
-        template = Template(f.read())
+    if args.template:
+        with open(args.template) as f:
+            template_source = f.read()
+    else:
+        template_source = _load_config().cfg["template"]
 
     if not os.path.exists(args.output):
         os.makedirs(args.output)
     elif not os.path.isdir(args.output):
         raise RuntimeError("Expected {} to be directory but it is not".format(args.output))
 
-    for i, obj in enumerate(data):
-        with open(os.path.join(args.output, "{}.html".format(i)), "w") as f:
-            f.write(template.render(obj=obj))
+    count, rendered = export(args.input, template_source, args.output, processes=args.jobs,
+                             incremental=args.incremental)
+    logger.info("Saved %d inputs (%d were already up to date)", count, count - rendered)
+
+
+def do_validate(args):
+    """
+    Checks the annotations in the provided input against the schema in fex.yaml
+    """
+    config = _load_config()
+    errors = config.validate_many(args.input, processes=args.jobs)
+    for idx, field, value in errors:
+        logger.error("Object %d has an invalid value for '%s': %r", idx, field, value)
+    if errors:
+        sys.exit(1)
+    logger.info("All annotations are valid")
 
 
 def main():
@@ -106,12 +167,79 @@ def main():
     command_parser = subparsers.add_parser('export', help=do_export.__doc__)
     command_parser.add_argument('-o', '--output', type=str, default="rendered",
                                 help="Output directory to save the rendered HTML to.")
+    command_parser.add_argument('-t', '--template', type=str, default=None,
+                                help="An HTML (Jinja2) template to render objects with. Defaults "
+                                     "to the template in fex.yaml")
+    command_parser.add_argument('-j', '--jobs', type=int, default=None,
+                                help="Number of processes to render with (default: all CPUs)")
+    command_parser.add_argument('--incremental', action="store_true",
+                                help="If set, only re-render objects whose output is out of date")
     command_parser.add_argument('input', type=str, help="Path to the data file in JSONL format")
     command_parser.set_defaults(func=do_export)
 
+    command_parser = subparsers.add_parser('validate', help=do_validate.__doc__)
+    command_parser.add_argument('-j', '--jobs', type=int, default=None,
+                                help="Number of processes to validate with (default: all CPUs)")
+    command_parser.add_argument('input', type=str, help="Path to the data file in JSONL format")
+    command_parser.set_defaults(func=do_validate)
+
     command_parser = subparsers.add_parser('run', help=do_serve.__doc__)
     command_parser.add_argument('-p', '--port', type=int, default=8080, help="Port to use")
-    command_parser.add_argument('input', type=str, help="Path to the data file in JSONL format")
+    command_parser.add_argument('--host', type=str, default="localhost",
+                                help="Address to listen on (e.g. 0.0.0.0 to share the server)")
+    command_parser.add_argument('-w', '--workers', type=int, default=0,
+                                help="If set, serve this many requests concurrently with "
+                                     "debugging turned off")
+    command_parser.add_argument('--engine', choices=["threads", "asyncio"], default="threads",
+                                help="Serve requests on a pool of threads, or handle connections "
+                                     "on an event loop that also pushes updates to clients "
+                                     "(requires aiohttp)")
+    command_parser.add_argument('--eager', action="store_true",
+                                help="If set, load the whole input into memory instead of "
+                                     "reading records on demand through a line index")
+    command_parser.add_argument('--keep-raw', action="store_true",
+                                help="With --eager, write unmodified objects back exactly as "
+                                     "they were read")
+    command_parser.add_argument('--compact', action="store_true",
+                                help="With --eager, keep objects in a compact read-only form "
+                                     "that takes several times less memory")
+    command_parser.add_argument('--cache-size', type=int, default=1024,
+                                help="Number of parsed records to keep in memory")
+    command_parser.add_argument('--store', type=str, default=None,
+                                help="If provided, save annotations in this SQLite database "
+                                     "instead of in the input, which is left untouched")
+    command_parser.add_argument('--read-only', action="store_true",
+                                help="If set, memory-map the input and never modify it (updates "
+                                     "are rejected unless they go to a --store)")
+    command_parser.add_argument('--journal', action="store_true",
+                                help="If set, append updates to a '.fexlog' file next to the "
+                                     "input instead of rewriting the input")
+    command_parser.add_argument('--lease-time', type=float, default=600.0,
+                                help="How long (in seconds) objects assigned to an annotator "
+                                     "are held for them before they are handed out again")
+    command_parser.add_argument('--search-schema', type=str, default=None,
+                                help="A JSON file describing the fields and types of objects, "
+                                     "used to answer /search/ queries")
+    command_parser.add_argument('--search-index', action="store_true",
+                                help="If set, build an inverted index over the search schema's "
+                                     "fields at startup to speed up /search/")
+    command_parser.add_argument('--search-processes', type=int, default=0,
+                                help="If set, searches without --search-index scan the data on "
+                                     "this many processes (-1 for one per core)")
+    command_parser.add_argument('--render-cache-size', type=int, default=4096,
+                                help="Number of rendered objects to keep in memory (0 disables "
+                                     "the cache)")
+    command_parser.add_argument('--render-cache-dir', type=str, default=None,
+                                help="If provided, also cache rendered objects in this directory")
+    command_parser.add_argument('--profile', type=str, default=None,
+                                help="If provided, profile requests and save the profiles "
+                                     "(.prof files) of the slowest ones in this directory")
+    command_parser.add_argument('--profile-keep', type=int, default=20,
+                                help="Number of profiles to keep with --profile")
+    command_parser.add_argument('input', type=str,
+                                help="Path to the data file in JSONL format (optionally "
+                                     "compressed as .gz or .zst), or a directory or glob "
+                                     "pattern of JSONL shards")
     command_parser.set_defaults(func=do_serve)
 
     args = parser.parse_args()
@@ -0,0 +1,232 @@
+"""
+Request metrics and profiling for the FastEx server.
+
+`Metrics` keeps counters and latency histograms that are exported in Prometheus' text format,
+and `Profiler` saves cProfile statistics of the slowest requests.
+"""
+import bisect
+import cProfile
+import heapq
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Mapping, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+#: Upper bounds (in seconds) of the buckets of latency histograms.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _format_labels(labels: Labels, extra: str = "") -> str:
+    parts = ['{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')
+                              .replace("\n", "\\n")) for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """
+    Counts observations in cumulative buckets, as Prometheus histograms do.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name: str, labels: Labels) -> List[str]:
+        ret = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            le = 'le="{}"'.format("+Inf" if bound == float("inf") else repr(bound))
+            ret.append(f"{name}_bucket{_format_labels(labels, le)} {total}")
+        ret.append(f"{name}_sum{_format_labels(labels)} {_format_value(self.sum)}")
+        ret.append(f"{name}_count{_format_labels(labels)} {self.count}")
+        return ret
+
+
+class Metrics:
+    """
+    A thread-safe registry of counters and histograms, each identified by a name and a set of
+    labels.
+
+    Values that other components already count (e.g. cache hits) can be exported with
+    `add_collector`, which is called whenever the metrics are rendered.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._collectors: List[Callable[['Metrics'], None]] = []
+
+    def describe(self, name: str, type_: str, help_: str):
+        """
+        Sets the type ('counter' or 'histogram') and help text of a metric.
+        """
+        self._help[name] = (type_, help_)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """
+        Increments a counter.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counter = self._counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        """
+        Sets a counter that is maintained elsewhere (see `add_collector`).
+        """
+        with self._lock:
+            self._counters.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        """
+        Records an observation (e.g. a latency in seconds) in a histogram.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            histogram = self._histograms.setdefault(name, {}).get(key)
+            if histogram is None:
+                histogram = self._histograms[name][key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def time(self, name: str, **labels):
+        """
+        Records how long the body of a `with` statement takes in a histogram.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def add_collector(self, collector: Callable[['Metrics'], None]):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        """
+        Returns:
+            Every metric in Prometheus' text exposition format.
+        """
+        for collector in self._collectors:
+            collector(self)
+        lines = []
+        with self._lock:
+            families: List[Tuple[str, Mapping[str, Mapping[Labels, Union[float, Histogram]]]]] = \
+                [("counter", self._counters), ("histogram", self._histograms)]
+            for kind, metrics in families:
+                for name in sorted(metrics):
+                    type_, help_ = self._help.get(name, (kind, ""))
+                    if help_:
+                        lines.append(f"# HELP {name} {help_}")
+                    lines.append(f"# TYPE {name} {type_}")
+                    for labels, value in sorted(metrics[name].items()):
+                        if isinstance(value, Histogram):
+                            lines.extend(value.lines(name, labels))
+                        else:
+                            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Profiler:
+    """
+    Profiles requests with cProfile and keeps the statistics of the `keep` slowest ones in
+    `directory` (as `.prof` files that `pstats` or snakeviz can read).
+    """
+    def __init__(self, directory: str, keep: int = 20):
+        self.directory = directory
+        self.keep = keep
+        self._lock = threading.Lock()
+        #: A min-heap of (duration, path) of the profiles we keep.
+        self._slowest: List[Tuple[float, str]] = []
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def profile(self, name: str):
+        """
+        Profiles the body of a `with` statement, saving the result if it is among the slowest.
+        """
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active in this thread.
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._save(profile, name, time.perf_counter() - start)
+
+    def _save(self, profile: cProfile.Profile, name: str, duration: float):
+        with self._lock:
+            if len(self._slowest) >= self.keep and duration <= self._slowest[0][0]:
+                return
+            slug = re.sub(r"[^A-Za-z0-9]+", "_", name).strip("_") or "root"
+            path = os.path.join(self.directory,
+                                f"{slug}-{duration * 1000:.0f}ms-{time.time_ns()}.prof")
+            if len(self._slowest) >= self.keep:
+                _, evicted = heapq.heapreplace(self._slowest, (duration, path))
+                try:
+                    os.remove(evicted)
+                except OSError:
+                    pass
+            else:
+                heapq.heappush(self._slowest, (duration, path))
+        try:
+            profile.dump_stats(path)
+        except OSError as e:
+            logger.warning(f"Could not save profile to {path}: {e}")
+
+
+def test_metrics():
+    metrics = Metrics()
+    metrics.describe("requests_total", "counter", "Requests served")
+    metrics.inc("requests_total", endpoint="/render/")
+    metrics.inc("requests_total", endpoint="/render/")
+    metrics.observe("latency_seconds", 0.003, endpoint='a"b')
+    metrics.add_collector(lambda metrics_: metrics_.set("hits_total", 5))
+    text = metrics.render()
+
+    assert "# HELP requests_total Requests served\n# TYPE requests_total counter\n" in text
+    assert 'requests_total{endpoint="/render/"} 2\n' in text
+    assert 'latency_seconds_bucket{endpoint="a\\"b",le="0.0025"} 0\n' in text
+    assert 'latency_seconds_bucket{endpoint="a\\"b",le="0.005"} 1\n' in text
+    assert 'latency_seconds_bucket{endpoint="a\\"b",le="+Inf"} 1\n' in text
+    assert 'latency_seconds_count{endpoint="a\\"b"} 1\n' in text
+    assert "hits_total 5\n" in text
+
+
+def test_profiler(tmp_path):
+    profiler = Profiler(str(tmp_path), keep=2)
+    for delay in [0.0, 0.02, 0.01, 0.0]:
+        with profiler.profile("/render/"):
+            time.sleep(delay)
+    assert len(os.listdir(tmp_path)) == 2
+
+
+__all__ = ['Metrics', 'Profiler', 'Histogram']
@@ -0,0 +1,242 @@
+"""
+Scans JSONL files for search matches on several cores.
+
+Without a search index, answering a query means parsing and checking every record. A
+`ParallelScanner` splits the file into byte ranges of whole records (using its `LineIndex`) and
+has a pool of processes read, parse and filter one range each; the matching indices are merged
+back in order.
+"""
+import bisect
+import functools
+import logging
+import multiprocessing
+import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Deque, Iterator, List, Optional, Set, Tuple
+
+from .codec import dumps, loads
+from .index import BlockIndex
+from .search import QuerySchema, compile_query
+from .util import FileBackedJsonList, ShardedJsonList
+
+logger = logging.getLogger(__name__)
+
+#: Values made only of these characters are never escaped by JSON encoders, so records that
+# match them must contain them verbatim.
+_LITERAL = re.compile(r"^[A-Za-z0-9 _.,:;!?'()*+=@#%$-]+$")
+#: Values that `str()` of a non-string JSON value can produce.
+_NON_LITERAL = {"true", "false", "none", "inf", "-inf", "nan"}
+
+
+class StaleIndexError(Exception):
+    """
+    Raised when a file changed after the index used to split it was built.
+    """
+
+
+def _needles(terms) -> List[bytes]:
+    """
+    Returns:
+        Byte strings that every matching record must contain verbatim, which lets workers skip
+        parsing most records that can't match.
+    """
+    ret = []
+    for term in terms:
+        if term.negated or term.op != '=' or term.value == '*' or \
+                not _LITERAL.match(term.value):
+            continue
+        if term.field is None:
+            ret.append(term.value.encode("utf-8"))
+        elif term.value[0].isalpha() and term.value.lower() not in _NON_LITERAL:
+            # Only strings can match such a value, as it isn't the `str()` of a number.
+            ret.append(term.value.encode("utf-8"))
+    return ret
+
+
+@functools.lru_cache(maxsize=32)
+def _worker_query(query_str: str, schema_json: Optional[str]):
+    schema = QuerySchema(loads(schema_json)) if schema_json else None
+    terms, filter_record = compile_query(query_str, schema)
+    return filter_record, _needles(terms)
+
+
+def _scan_range(task: Tuple) -> List[int]:
+    """
+    Returns the indices of the records in a byte range of a file that match a query.
+    """
+    fname, mtime_ns, size, start, end, base, query_str, schema_json = task
+    filter_record, needles = _worker_query(query_str, schema_json)
+    with open(fname, "rb") as f:
+        stat = os.fstat(f.fileno())
+        if stat.st_mtime_ns != mtime_ns or stat.st_size != size:
+            raise StaleIndexError(f"{fname} changed while it was being searched")
+        f.seek(start)
+        data = f.read(end - start)
+
+    ret = []
+    idx = base
+    for line in data.split(b"\n"):
+        if not line.strip():
+            continue
+        if all(needle in line for needle in needles) and filter_record(loads(line)):
+            ret.append(idx)
+        idx += 1
+    return ret
+
+
+class ParallelScanner:
+    """
+    Finds the records of a lazily loaded `FileBackedJsonList` (or `ShardedJsonList`) that
+    match a query on a pool of `processes` worker processes, each handling about `chunk_size`
+    bytes at a time.
+
+    Workers read the file itself, so records that were updated or appended in memory (and not
+    saved yet) are checked in this process instead. Compressed files can't be split and are
+    scanned sequentially.
+    """
+    def __init__(self, processes: Optional[int] = None, chunk_size: int = 16 << 20):
+        self.processes = processes or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        # Forking a multi-threaded server could copy held locks into the workers.
+        self._executor = ProcessPoolExecutor(self.processes,
+                                             mp_context=multiprocessing.get_context("spawn"))
+        #: Submitted scans that may not have run yet, which `close` cancels.
+        self._lock = threading.Lock()
+        self._futures: Set[Future] = set()
+
+    def close(self):
+        # Executor.shutdown only takes cancel_futures from Python 3.9 on.
+        with self._lock:
+            futures, self._futures = self._futures, set()
+        for future in futures:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+
+    def _discard(self, future: Future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def supports(self, lst) -> bool:
+        """
+        Returns:
+            True iff we can scan `lst` in parallel.
+        """
+        if isinstance(lst, ShardedJsonList):
+            return lst.kwargs.get("lazy", True) and not any(
+                fname.endswith((".gz", ".zst", ".zstd")) for fname in lst.fnames)
+        return isinstance(lst, FileBackedJsonList) and lst.lazy
+
+    def iter_indices(self, lst, query_str: str, schema: Optional[QuerySchema] = None,
+                     start: int = 0) -> Iterator[int]:
+        """
+        Lazily yields (in order) the indices of records in `lst` that match `query_str`,
+        beginning with record `start`.
+        """
+        if isinstance(lst, ShardedJsonList):
+            for i, fname in enumerate(lst.fnames):
+                base, end = lst.offsets[i], lst.offsets[i + 1]
+                if end > start:
+                    for idx in self._iter_file(lst.shard(i), query_str, schema,
+                                               max(0, start - base)):
+                        yield base + idx
+        else:
+            yield from self._iter_file(lst, query_str, schema, start)
+
+    def _iter_file(self, lst: FileBackedJsonList, query_str: str,
+                   schema: Optional[QuerySchema], start: int) -> Iterator[int]:
+        _, filter_record = compile_query(query_str, schema)
+        index, edits, appended = lst._snapshot()
+        count = len(index) if index else 0
+
+        def sequential(begin):
+            for i in range(begin, len(lst)):
+                if filter_record(lst[i]):
+                    yield i
+
+        if index is None or isinstance(index, BlockIndex):
+            yield from sequential(start)
+            return
+
+        schema_json = dumps(schema.json) if schema is not None else None
+        ranges: Deque[Tuple[int, int, Future]] = deque()
+
+        def submit(begin):
+            """
+            Submits the range of records starting at `begin`, returning where the next starts.
+            """
+            end = bisect.bisect_left(index.offsets, index.offsets[begin] + self.chunk_size,
+                                     begin + 1, count)
+            task = (index.fname, index.mtime_ns, index.size, index.offsets[begin],
+                    index.offsets[end], begin, query_str, schema_json)
+            future = self._executor.submit(_scan_range, task)
+            with self._lock:
+                self._futures.add(future)
+            future.add_done_callback(self._discard)
+            ranges.append((begin, end, future))
+            return end
+
+        begin = start
+        try:
+            while begin < count and len(ranges) < 2 * self.processes:
+                begin = submit(begin)
+            while ranges:
+                lower, upper, future = ranges.popleft()
+                try:
+                    matches = future.result()
+                except StaleIndexError as e:
+                    logger.warning(f"{e}; searching the rest sequentially")
+                    yield from sequential(lower)
+                    return
+                if begin < count:
+                    begin = submit(begin)
+                # Records updated in memory replace those read from the file.
+                edited = sorted(i for i in edits if lower <= i < upper)
+                if edited:
+                    matches = sorted(set(matches).difference(edited).union(
+                        i for i in edited if filter_record(edits[i])))
+                yield from matches
+        finally:
+            for _, _, future in ranges:
+                future.cancel()
+
+        for i, obj in enumerate(appended):
+            if count + i >= start and filter_record(obj):
+                yield count + i
+
+
+def test_parallel_scanner(tmp_path):
+    from .util import save_jsonl
+    fname = str(tmp_path / "data.jsonl")
+    objs = [{"id": i, "title": "even" if i % 2 == 0 else "odd", "score": i / 100}
+            for i in range(500)]
+    save_jsonl(fname, objs)
+    with open(fname, "a") as f:
+        f.write("\n\n")
+    schema = QuerySchema({
+        "fields": [{"name": "id", "type": "int"}, {"name": "title", "type": "text"},
+                   {"name": "score", "type": "float"}],
+        "types": [],
+    })
+
+    data = FileBackedJsonList(fname, lazy=True, auto_save=False)
+    data[4] = {"id": 4, "title": "odd", "score": 0.04}
+    data[5] = {"id": 5, "title": "even", "score": 0.05}
+    data.extend([{"id": 500, "title": "even", "score": 5.0}])
+
+    scanner = ParallelScanner(processes=2, chunk_size=1000)
+    try:
+        assert scanner.supports(data)
+        for query in ["even", "title:odd score:>4.5", "!even id:>480", "id:7", "nothing"]:
+            expected = [i for i in range(len(data))
+                        if compile_query(query, schema)[1](data[i])]
+            assert list(scanner.iter_indices(data, query, schema)) == expected, query
+            assert list(scanner.iter_indices(data, query, schema, start=250)) == \
+                [i for i in expected if i >= 250], query
+    finally:
+        scanner.close()
+
+
+__all__ = ['ParallelScanner']
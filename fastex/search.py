@@ -1,5 +1,11 @@
+import functools
 import logging
 import re
+import threading
+from collections import defaultdict
+from typing import NamedTuple, Optional
+
+from .compact import CompactRecord
 
 logger = logging.getLogger(__name__)
 
@@ -38,38 +44,133 @@ class QuerySchema():
         return okay
 
 
-def or_filter(fieldnames, fieldvalue, check_value=None):
-    # print('filter {} {}'.format(fieldnames, fieldvalue))
-    if check_value is None:
-        check_value = lambda sv, tv: str(tv) == sv
-
-    def check_field(elem, path, searchvalue):
-        if len(path) == 0:
-            if searchvalue == '*':
-                if elem is not None:
-                    return True
-            elif check_value(searchvalue, elem):
+#: Types of the (nested) objects of records, which paths look keys up in.
+RECORD_TYPES = (dict, CompactRecord)
+#: Field types whose values are compared as numbers in range queries.
+NUMERIC_TYPES = frozenset(['int', 'float', 'number', 'counts'])
+#: Comparison operators of range queries (e.g. `score:>0.5`), longest first.
+OPERATORS = ('>=', '<=', '>', '<')
+
+
+def compile_path(path):
+    """
+    Returns a function that lists the values at `path` (a sequence of keys) in a record,
+    fanning out over lists at every level. Paths are resolved once, so that matching a record
+    is a flat loop instead of a recursive walk.
+    """
+    path = tuple(path)
+    if len(path) == 1:
+        key = path[0]
+
+        def access_one(elem):
+            if isinstance(elem, RECORD_TYPES):
+                value = elem.get(key)
+                if value is not None:
+                    return value if isinstance(value, list) else [value]
+            return []
+        return access_one
+
+    def access(elem):
+        values = [elem]
+        for key in path:
+            next_values = []
+            for value in values:
+                if isinstance(value, RECORD_TYPES):
+                    value = value.get(key)
+                    if value is not None:
+                        if isinstance(value, list):
+                            next_values.extend(value)
+                        else:
+                            next_values.append(value)
+            if not next_values:
+                return next_values
+            values = next_values
+        return values
+    return access
+
+
+def compile_matcher(path, predicate):
+    """
+    Returns a function that checks if any value at `path` in a record satisfies `predicate`.
+    This is equivalent to `any(map(predicate, compile_path(path)(elem)))`, but paths of one or
+    two keys are matched with nested loops that stop at the first match without building a
+    list of values.
+    """
+    path = tuple(path)
+    if len(path) == 1:
+        key = path[0]
+
+        def match_one(elem):
+            if isinstance(elem, RECORD_TYPES):
+                value = elem.get(key)
+                if value is not None:
+                    if isinstance(value, list):
+                        for v in value:
+                            if predicate(v):
+                                return True
+                        return False
+                    return predicate(value)
+            return False
+        return match_one
+
+    if len(path) == 2:
+        first, second = path
+        match_second = compile_matcher([second], predicate)
+
+        def match_two(elem):
+            if isinstance(elem, RECORD_TYPES):
+                value = elem.get(first)
+                if value is not None:
+                    if isinstance(value, list):
+                        for v in value:
+                            if match_second(v):
+                                return True
+                        return False
+                    return match_second(value)
+            return False
+        return match_two
+
+    access = compile_path(path)
+
+    def match(elem):
+        for value in access(elem):
+            if predicate(value):
                 return True
-        else:
-            fieldname = path[0]
-            if isinstance(elem, dict):
-                elem_value = elem.get(fieldname)
-                if elem_value is not None:
-                    if isinstance(elem_value, list):
-                        # check any of the values
-                        for v in elem_value:
-                          if check_field(v, path[1:], searchvalue):
-                            return True
-                    else:
-                        return check_field(elem_value, path[1:], searchvalue)
         return False
+    return match
+
+
+def or_filter(fieldnames, fieldvalue, check_value=None):
+    """
+    Returns a filter that matches records with a value at any of `fieldnames` (dotted paths)
+    for which `check_value(fieldvalue, value)` holds (by default, if its string is
+    `fieldvalue`), or with any value at all if `fieldvalue` is '*'.
+    """
+    return _any_match([name.split('.') for name in fieldnames],
+                      _value_predicate(fieldvalue, check_value))
+
+
+def _value_predicate(fieldvalue, check_value=None):
+    if fieldvalue == '*':
+        return lambda value: value is not None
+    if check_value is None:
+        return lambda value: (value if isinstance(value, str) else str(value)) == fieldvalue
+    return lambda value: check_value(fieldvalue, value)
+
+
+def _any_match(paths, predicate):
+    matchers = [compile_matcher(path, predicate) for path in paths]
+    if len(matchers) == 1:
+        return matchers[0]
+
     def f(elem):
-        for fieldname in fieldnames:
-            path = fieldname.split('.')
-            if check_field(elem, path, fieldvalue):
+        for match in matchers:
+            if match(elem):
                 return True
+        return False
     return f
 
+
 def neg_filter(f):
     return lambda elem: not f(elem)
 
@@ -79,41 +180,401 @@ def smart_split(text, delimiter, trim_quotes=False):
     parts = re.sub('".+?"', replacer, text).split(delimiter)
     parts = [p.replace("\x00", delimiter) for p in parts]
     if trim_quotes:
-        parts = [p[1:-1] if p.startswith('"') and p.endswith('"') else p for p in parts]
+        parts = [_trim_quotes(p) for p in parts]
     return parts
 
 
-def find_records(lst, query_str, schema=None):
-    conditions = smart_split(query_str, ' ')
-    filters = []
-    text_fields = schema.text_fields.keys() if schema else []
-    # logger.info('text_fields {}'.format(text_fields))
-    for condition in conditions:
+def _trim_quotes(text):
+    return text[1:-1] if len(text) >= 2 and text.startswith('"') and text.endswith('"') else text
+
+
+class Term(NamedTuple):
+    """
+    A single condition of a query: `value` (a substring of any text field) or `field:value`,
+    negated if prefixed by '!'. Field conditions may also compare values with `op` (one of
+    `OPERATORS`), as in `score:>0.5`.
+    """
+    field: Optional[str]
+    value: str
+    negated: bool
+    op: str = '='
+
+
+class QueryError(ValueError):
+    """
+    Raised when a query string can't be parsed.
+    """
+
+
+def parse_query(query_str):
+    terms = []
+    for condition in smart_split(query_str, ' '):
         isNot = False
         if condition.startswith('!'):
             condition = condition[1:]
             isNot = True
-        parts = smart_split(condition, ':', trim_quotes=True)
-        logger.info('Searching for {}'.format(parts))
+        parts = smart_split(condition, ':')
         if len(parts) == 1:
-            filt = or_filter(text_fields, parts[0], check_value = lambda sv, tv: sv in tv)
-            filt = neg_filter(filt) if isNot else filt
-            filters.append(filt)
+            terms.append(Term(None, _trim_quotes(parts[0]), isNot))
         elif len(parts) == 2:
-            if schema and not schema.has_field(parts[0]):
-                logger.warn('Unknown search field {}'.format(parts[0]))
-            filt = or_filter([parts[0]], parts[1])
-            filt = neg_filter(filt) if isNot else filt
-            filters.append(filt)
+            field, value, op = _trim_quotes(parts[0]), parts[1], '='
+            # Quoted values are always compared literally.
+            for op_ in OPERATORS:
+                if value.startswith(op_):
+                    op, value = op_, value[len(op_):]
+                    break
+            terms.append(Term(field, _trim_quotes(value), isNot, op))
+        else:
+            raise QueryError(f'Invalid query condition: {condition!r}')
+    logger.debug(f"Parsed query {query_str!r} into {terms}")
+    return terms
+
+
+def _as_number(value):
+    """
+    Returns:
+        `value` as a float, or None if it isn't a number.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+
+def _range_predicate(op, bound, numeric):
+    compare = {
+        '>': lambda a, b: a > b,
+        '>=': lambda a, b: a >= b,
+        '<': lambda a, b: a < b,
+        '<=': lambda a, b: a <= b,
+    }[op]
+    if numeric:
+        def check_number(value):
+            value = _as_number(value)
+            return value is not None and compare(value, bound)
+        return check_number
+    return lambda value: isinstance(value, str) and compare(value, bound)
+
+
+def _resolve_path(field, schema=None):
+    """
+    Returns:
+        The keys of `field` in records and its type according to `schema` (if known).
+    """
+    if schema is not None:
+        f = schema.all_fields.get(field)
+        if f is not None:
+            return f['path'], f['type']
+        if not schema.has_field(field):
+            logger.warning('Unknown search field {}'.format(field))
         else:
-            raise Exception('Invalid query string to find_records')
+            # A key of a `counts` field.
+            parent, key = field.rsplit('.', 1)
+            return schema.all_fields[parent]['path'] + [key], 'counts'
+    return field.split('.'), None
+
+
+def term_filter(term, schema=None):
+    """
+    Compiles a term into a filter over records.
+    """
+    if term.field is None:
+        paths = [f['path'] for f in (schema.text_fields.values() if schema else [])]
+        value = term.value
+        predicate = _value_predicate(value) if value == '*' else \
+            (lambda tv: isinstance(tv, str) and value in tv)
+    else:
+        path, type_ = _resolve_path(term.field, schema)
+        paths = [path]
+        if term.op == '=':
+            predicate = _value_predicate(term.value)
+        else:
+            bound = _as_number(term.value)
+            numeric = bound is not None and (type_ is None or type_ in NUMERIC_TYPES)
+            predicate = _range_predicate(term.op, bound if numeric else term.value, numeric)
+    filt = _any_match(paths, predicate)
+    return neg_filter(filt) if term.negated else filt
+
+
+def iter_values(elem, path):
+    """
+    Yields the values at `path` in `elem`, fanning out over lists, exactly as `or_filter` visits
+    them.
+    """
+    yield from compile_path(path)(elem)
+
+
+class SearchIndex():
+    """
+    An inverted index over a list of records that answers `find_records` queries without
+    scanning every record.
+
+    We keep n-gram posting lists over the values of `QuerySchema.text_fields` (for substring
+    terms) and exact-value posting lists over `QuerySchema.all_fields` (for `field:value` terms).
+    Terms that the index can't answer (e.g. substrings shorter than `n` or unknown fields) are
+    checked against the candidate records instead.
+    """
+    def __init__(self, schema, n=3):
+        self.schema = schema
+        self.n = n
+        self.count = 0
+        self.ngrams = defaultdict(set)
+        self.values = {name: defaultdict(set) for name in schema.all_fields}
+        self.present = {name: set() for name in schema.all_fields}
+        self._accessors = {name: compile_path(f['path']) for name, f in schema.all_fields.items()}
+        self._text_accessors = [compile_path(f['path']) for f in schema.text_fields.values()]
+        self._lock = threading.RLock()
+
+    @classmethod
+    def build(cls, lst, schema, n=3):
+        index = cls(schema, n)
+        for i, rec in enumerate(lst):
+            index.add(i, rec)
+        return index
+
+    def _ngrams(self, text):
+        return {text[j: j + self.n] for j in range(len(text) - self.n + 1)}
+
+    def _keys(self, rec):
+        ngrams = set()
+        for access in self._text_accessors:
+            for v in access(rec):
+                if isinstance(v, str):
+                    ngrams.update(self._ngrams(v))
+        values = {}
+        for name, access in self._accessors.items():
+            values[name] = access(rec)
+        return ngrams, values
+
+    def add(self, i, rec):
+        ngrams, values = self._keys(rec)
+        with self._lock:
+            self._add(i, ngrams, values)
+
+    def _add(self, i, ngrams, values):
+        for ngram in ngrams:
+            self.ngrams[ngram].add(i)
+        for name, vs in values.items():
+            for v in vs:
+                self.values[name][str(v)].add(i)
+            if any(v is not None for v in vs):
+                self.present[name].add(i)
+        self.count = max(self.count, i + 1)
+
+    def remove(self, i, rec):
+        ngrams, values = self._keys(rec)
+        with self._lock:
+            self._remove(i, ngrams, values)
+
+    def _remove(self, i, ngrams, values):
+        for ngram in ngrams:
+            self.ngrams[ngram].discard(i)
+        for name, vs in values.items():
+            for v in vs:
+                self.values[name][str(v)].discard(i)
+            self.present[name].discard(i)
+
+    def update(self, i, old, new):
+        """
+        Re-indexes record `i` after it changed from `old` to `new`.
+        """
+        self.remove(i, old)
+        self.add(i, new)
+
+    def lookup(self, term):
+        """
+        Returns:
+            A tuple `(ids, exact)` where `ids` is a superset of the records matching the
+            (non-negated) term, and `exact` is true if it is exactly that set. If the index
+            can't narrow down the term, `ids` is None.
+        """
+        if term.op != '=':
+            return None, False
+        if term.field is None:
+            if term.value == '*' or len(term.value) < self.n:
+                return None, False
+            postings = [self.ngrams.get(ngram, set()) for ngram in self._ngrams(term.value)]
+            return set.intersection(*sorted(postings, key=len)), len(term.value) == self.n
+        if term.field not in self.values:
+            return None, False
+        if term.value == '*':
+            return self.present[term.field], True
+        return self.values[term.field].get(term.value, set()), True
+
+    def find(self, lst, terms):
+        """
+        Returns the sorted indices of the records in `lst` that match every term. Records
+        appended to `lst` since they were last indexed are scanned.
+        """
+        with self._lock:
+            count = self.count
+            lookups = [(term, *self.lookup(term)) for term in terms]
+            # Intersect the smallest posting lists of positive terms first.
+            positive = sorted([(ids, exact, term) for term, ids, exact in lookups
+                               if not term.negated and ids is not None], key=lambda x: len(x[0]))
+            candidates = set(positive[0][0]) if positive else set(range(count))
+            for ids, _, _ in positive[1:]:
+                candidates &= ids
+            # Snapshot the postings we still need, as they may be updated concurrently.
+            lookups = [(term, None if ids is None else set(ids), exact)
+                       for term, ids, exact in lookups]
+
+        checks = []
+        for term, ids, exact in lookups:
+            if term.negated and ids is not None:
+                if exact:
+                    candidates -= ids
+                else:
+                    # Only records that may contain the value need to be checked.
+                    filt = term_filter(term, self.schema)
+                    candidates -= {i for i in candidates & ids if not filt(lst[i])}
+            elif ids is None or not exact:
+                checks.append(term_filter(term, self.schema))
+
+        ret = [i for i in sorted(candidates) if all(f(lst[i]) for f in checks)]
+        if len(lst) > count:
+            filter_record = record_filter(terms, self.schema)
+            ret.extend(i for i in range(count, len(lst)) if filter_record(lst[i]))
+        return ret
+
+
+def record_filter(terms, schema=None):
+    filters = [term_filter(term, schema) for term in terms]
+    if len(filters) == 1:
+        return filters[0]
     def filter_record(elem):
         for f in filters:
             if not f(elem):
                 return False
         return True
+    return filter_record
+
+
+@functools.lru_cache(maxsize=256)
+def compile_query(query_str, schema=None):
+    """
+    Parses and compiles a query once; repeated queries (e.g. successive pages of results) reuse
+    the compiled filter.
+
+    Returns:
+        The query's terms and a filter that matches records that satisfy all of them.
+    """
+    terms = parse_query(query_str)
+    return terms, record_filter(terms, schema)
+
+
+def find_records(lst, query_str, schema=None, index=None):
+    terms, filter_record = compile_query(query_str, schema)
+    if index is not None:
+        return [(i, lst[i]) for i in index.find(lst, terms)]
     return [(i,rec) for i,rec in enumerate(lst) if filter_record(rec)]
 
 
-def find_record_indices(lst, query_str, schema=None):
+def iter_record_indices(lst, query_str, schema=None, index=None, start=0, scanner=None):
+    """
+    Lazily yields the indices of records that match `query_str`, beginning with record `start`,
+    so that callers can stop scanning as soon as they have enough results.
+
+    Without an `index`, records are scanned with `scanner` (a `fastex.scan.ParallelScanner`)
+    if it supports `lst`, and one by one otherwise.
+    """
+    terms, filter_record = compile_query(query_str, schema)
+    if index is not None:
+        for i in index.find(lst, terms):
+            if i >= start:
+                yield i
+        return
+    if scanner is not None and scanner.supports(lst):
+        yield from scanner.iter_indices(lst, query_str, schema, start)
+        return
+
+    for i in range(start, len(lst)):
+        if filter_record(lst[i]):
+            yield i
+
+
+def find_record_indices(lst, query_str, schema=None, index=None):
+    if index is not None:
+        return index.find(lst, parse_query(query_str))
     return [i for i,rec in find_records(lst, query_str, schema)]
+
+
+def test_search_index():
+    schema = QuerySchema({
+        'fields': [
+            {'name': 'id', 'type': 'int'},
+            {'name': 'title', 'type': 'text'},
+            {'name': 'messages', 'type': 'message'},
+        ],
+        'types': [
+            {'name': 'message', 'fields': [
+                {'name': 'user', 'type': 'category'},
+                {'name': 'msg', 'type': 'text'},
+            ]},
+        ],
+    })
+    lst = [
+        {'id': 0, 'title': 'Test 1', 'messages': [{'user': 'A', 'msg': 'Hi'}]},
+        {'id': 1, 'title': 'Test 2', 'messages': [{'user': 'B', 'msg': 'I need help!'}]},
+        {'id': 2, 'title': 'Other', 'messages': [{'user': 'A', 'msg': 'Good!'},
+                                                 {'user': 'B', 'msg': 'help'}]},
+        {'id': 3},
+    ]
+    index = SearchIndex.build(lst, schema)
+    for query in ['Test', 'help', '!help', 'Hi', 'messages.user:B', '!messages.user:A',
+                  'title:*', 'help messages.user:A', '"I need" !id:0', 'es', 'unknown:x']:
+        assert find_record_indices(lst, query, schema, index) == \
+            find_record_indices(lst, query, schema), query
+
+    for query in ['id:>1', 'id:<=1', '!id:>=2', 'title:>T', 'messages.user:>A']:
+        assert find_record_indices(lst, query, schema, index) == \
+            find_record_indices(lst, query, schema), query
+
+    index.update(3, lst[3], {'id': 3, 'title': 'Help'})
+    lst[3] = {'id': 3, 'title': 'Help'}
+    assert find_record_indices(lst, 'title:Help', schema, index) == [3]
+
+    # Records appended since the index was built are found too.
+    lst.append({'id': 4, 'title': 'Test 4', 'messages': [{'user': 'A', 'msg': 'help'}]})
+    for query in ['', 'Test', '!id:0', '!help', 'title:*', 'help messages.user:A']:
+        assert find_record_indices(lst, query, schema, index) == \
+            find_record_indices(lst, query, schema), query
+
+
+def test_compiled_query():
+    schema = QuerySchema({
+        'fields': [
+            {'name': 'score', 'type': 'float'},
+            {'name': 'tags', 'type': 'counts'},
+            {'name': 'date', 'type': 'category'},
+            {'name': 'meta', 'type': 'meta'},
+        ],
+        'types': [
+            {'name': 'meta', 'fields': [{'name': 'level', 'type': 'int'}]},
+        ],
+    })
+    lst = [
+        {'score': 0.2, 'tags': {'a': 1}, 'date': '2020-01-01', 'meta': [{'level': 1}]},
+        {'score': 0.7, 'tags': {'a': 5, 'b': 2}, 'date': '2021-06-01',
+         'meta': [{'level': [2, 3]}, {'level': 0}]},
+        {'score': '0.9', 'date': None, 'meta': {'level': None}},
+        {'score': True},
+    ]
+    for query, expected in [
+            ('score:>0.5', [1, 2]), ('score:<=0.2', [0]), ('!score:>0.5', [0, 3]),
+            ('tags.a:>=2', [1]), ('tags.b:*', [1]), ('date:>2020-06', [1]),
+            ('meta.level:>2', [1]), ('meta.level:0', [1]), ('meta.level:*', [0, 1]),
+            ('score:">0.5"', []), ('score:>0.5 tags.a:<2', [])]:
+        assert find_record_indices(lst, query, schema) == expected, query
+    assert compile_query('score:>0.5', schema) is compile_query('score:>0.5', schema)
+    try:
+        compile_query('a:b:c', schema)
+        assert False, "Expected a QueryError"
+    except QueryError:
+        pass
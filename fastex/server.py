@@ -1,39 +1,403 @@
 """
 The FastEx webserver
 """
+import functools
+import hashlib
+import itertools
 import os
+import threading
+import time
 import webbrowser
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
 
 import bottle
 from bottle import Bottle, jinja2_view, static_file, abort
-from fastex.config import Config
-from fastex.util import FileBackedJsonList
+from fastex import codec
+from fastex.assign import Scheduler
+from fastex.cache import RenderCache
+from fastex.compress import compress, negotiate_encoding
+from fastex.config import ClassificationSchema, Config
+from fastex.metrics import Metrics, Profiler
+from fastex.scan import ParallelScanner
+from fastex.store import AnnotationStore
+from fastex.search import QueryError, QuerySchema, SearchIndex, compile_query, \
+    iter_record_indices
+from fastex.util import FileBackedJsonList, ShardedJsonList
+from fastex.watch import ConfigWatcher
 from jinja2 import Template
 
 #: The path to the fastex package directory
 _mypath = os.path.dirname(__file__)
 STATIC_DIR = os.path.join(_mypath, "static")
 TEMPLATE_DIR = os.path.join(_mypath, "templates")
+#: How long (in seconds) browsers may cache static files.
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+#: Responses smaller than this (in bytes) are not worth compressing.
+MIN_COMPRESS_SIZE = 1024
 
 
-def serve(data: FileBackedJsonList, config: Config, port=8080):
+def _static_version() -> str:
+    """
+    Returns:
+        A digest of the static files, which pages append to their URLs so that browsers can
+        cache them for long and still pick up changes.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for root, _, fnames in sorted(os.walk(STATIC_DIR)):
+        for fname in sorted(fnames):
+            stat = os.stat(os.path.join(root, fname))
+            digest.update(f"{root}/{fname}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+STATIC_VERSION = _static_version()
+
+
+def annotations_version(obj: dict) -> str:
+    """
+    Returns:
+        The version of `obj` that clients send back with their updates of it: a digest of its
+        annotations, so that it changes whenever they do (and only then), and stays the same
+        when the server restarts.
+    """
+    data = codec.dumps(obj.get("_fex") or {}).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=12).hexdigest()
+
+
+def merge_annotations(obj: dict, annotations: dict) -> dict:
+    """
+    Returns:
+        A copy of `obj` whose `_fex` field is updated with `annotations`.
+    """
+    return dict(obj, _fex=dict(obj.get("_fex") or {}, **annotations))
+
+
+def compress_response(body: bytes) -> bytes:
+    """
+    Compresses a response body with the best content coding the client accepts, if the body
+    is large enough. Any `ETag` is suffixed with the coding so that it stays strong.
+    """
+    bottle.response.add_header("Vary", "Accept-Encoding")
+    encoding = negotiate_encoding(bottle.request.headers.get("Accept-Encoding", ""))
+    if encoding is None or len(body) < MIN_COMPRESS_SIZE:
+        return body
+    bottle.response.set_header("Content-Encoding", encoding)
+    etag = bottle.response.get_header("ETag")
+    if etag:
+        bottle.response.set_header("ETag", f'{etag[:-1]}-{encoding}"')
+    return compress(body, encoding)
+
+
+def etag_matches(etag: str) -> Optional[str]:
+    """
+    Checks the request's `If-None-Match` header against `etag`, ignoring content coding
+    suffixes (every coding of a response has the same content).
+
+    Returns:
+        The matching tag the client holds, or None.
+    """
+    digest = etag.strip('"')
+    for tag in bottle.request.headers.get("If-None-Match", "").split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == "*" or tag.strip('"').split("-")[0] == digest:
+            return etag if tag == "*" else tag
+    return None
+
+
+def int_param(params, name: str, default: int, minimum: int = 0) -> int:
+    """
+    Returns:
+        The integer parameter `name` of a request (its query or JSON body), or `default` if it
+        is missing. Aborts with 400 if it isn't an integer of at least `minimum`.
+    """
+    value = params.get(name)
+    if value is None or value == "":
+        return default
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        abort(400, f"{name} must be an integer")
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400, f"{name} must be an integer")
+    if value < minimum:
+        abort(400, f"{name} must be at least {minimum}")
+    return value
+
+
+class RawJSON:
+    """
+    A value that is already encoded as JSON (e.g. records sliced out of the data file), which
+    `JSONPlugin` splices into responses as-is instead of decoding and re-encoding it.
+    """
+    def __init__(self, data: Union[bytes, memoryview]):
+        self.data = data
+
+    @classmethod
+    def array(cls, items: Iterable[Union[bytes, memoryview]]) -> 'RawJSON':
+        return cls(b"[" + b",".join(items) + b"]")
+
+
+class JSONPlugin(bottle.JSONPlugin):
+    """
+    Serializes dicts with `codec` and compresses the resulting JSON (see `compress_response`),
+    recording how long each step takes in `metrics`.
+    """
+    def __init__(self, metrics: Metrics):
+        super().__init__(json_dumps=lambda obj: codec.dumps(obj, sort_keys=False))
+        self.metrics = metrics
+
+    def encode(self, obj: dict) -> bytes:
+        """
+        Encodes a response, splicing in the values that are `RawJSON`.
+        """
+        raw = [(key, value) for key, value in obj.items() if isinstance(value, RawJSON)]
+        body = self.json_dumps({key: value for key, value in obj.items()
+                                if not isinstance(value, RawJSON)}).encode("utf-8")
+        if not raw:
+            return body
+        parts = [body[:-1]]
+        for key, value in raw:
+            if len(parts) > 1 or len(body) > 2:
+                parts.append(b",")
+            parts.extend([self.json_dumps(key).encode("utf-8"), b":", value.data])
+        parts.append(b"}")
+        return b"".join(parts)
+
+    def apply(self, callback, route):
+        dumps = self.json_dumps
+
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            try:
+                rv = callback(*args, **kwargs)
+            except bottle.HTTPResponse as resp:
+                rv = resp
+
+            if isinstance(rv, dict):
+                with self.metrics.time("fex_stage_duration_seconds", endpoint=route.rule,
+                                       stage="encode"):
+                    body = self.encode(rv)
+                bottle.response.content_type = 'application/json'
+                with self.metrics.time("fex_stage_duration_seconds", endpoint=route.rule,
+                                       stage="compress"):
+                    return compress_response(body)
+            elif isinstance(rv, bottle.HTTPResponse) and isinstance(rv.body, dict):
+                rv.body = dumps(rv.body)
+                rv.content_type = 'application/json'
+            return rv
+        return wrapper
+
+
+class MetricsPlugin:
+    """
+    Counts requests and records their latency for each route, and profiles them if a
+    `Profiler` is provided (except on routes declared with `profile=False`). Streamed responses
+    are only timed until they start streaming.
+    """
+    name = 'metrics'
+    api = 2
+
+    def __init__(self, metrics: Metrics, profiler: Optional[Profiler] = None):
+        self.metrics = metrics
+        self.profiler = profiler
+        metrics.describe("fex_requests_total", "counter", "Requests served, by endpoint")
+        metrics.describe("fex_request_duration_seconds", "histogram",
+                         "Time spent handling requests, by endpoint")
+        metrics.describe("fex_stage_duration_seconds", "histogram",
+                         "Time spent in each stage of handling requests")
+
+    def apply(self, callback, route):
+        endpoint = route.rule
+        profiler = self.profiler if route.config.get("profile", True) else None
+
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            status = 500
+            start = time.perf_counter()
+            try:
+                profile = profiler.profile(f"{route.method} {endpoint}") if profiler \
+                    else nullcontext()
+                with profile:
+                    rv = callback(*args, **kwargs)
+                status = rv.status_code if isinstance(rv, bottle.HTTPResponse) \
+                    else bottle.response.status_code
+                return rv
+            except bottle.HTTPResponse as resp:
+                status = resp.status_code
+                raise
+            finally:
+                self.metrics.observe("fex_request_duration_seconds", time.perf_counter() - start,
+                                     endpoint=endpoint)
+                self.metrics.inc("fex_requests_total", endpoint=endpoint, method=route.method,
+                                 status=str(status))
+        return wrapper
+
+
+class ThreadPoolServer(bottle.ServerAdapter):
+    """
+    Serves requests concurrently on a pool of `workers` threads using the standard library's
+    WSGI server (Bottle's default server handles one request at a time).
+    """
+    def run(self, handler):
+        from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+        pool = ThreadPoolExecutor(self.options.get("workers", 8))
+        quiet = self.quiet
+
+        class PooledWSGIServer(WSGIServer):
+            def process_request(self, request, client_address):
+                pool.submit(self.process_request_thread, request, client_address)
+
+            def process_request_thread(self, request, client_address):
+                try:
+                    self.finish_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                finally:
+                    self.shutdown_request(request)
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                if not quiet:
+                    return WSGIRequestHandler.log_request(self, *args, **kwargs)
+
+        server = make_server(self.host, self.port, handler, PooledWSGIServer, QuietHandler)
+        try:
+            server.serve_forever()
+        finally:
+            pool.shutdown()
+
+
+#: Called with each update: the object's index, its new version and the client (if any) that
+#: sent it.
+UpdateListener = Callable[[int, str, Optional[str]], None]
+
+
+def make_app(data: Union[FileBackedJsonList, ShardedJsonList], config: Config,
+             query_schema: Optional[QuerySchema] = None,
+             search_index: Optional[SearchIndex] = None,
+             render_cache: Optional[RenderCache] = None,
+             store: Optional[AnnotationStore] = None, profiler: Optional[Profiler] = None,
+             scanner: Optional[ParallelScanner] = None, read_only: bool = False,
+             lease_time: float = 600.0,
+             update_listeners: Optional[List[UpdateListener]] = None) -> Bottle:
+    """
+    Builds the Bottle application that serves `data`. See `serve` for its arguments.
+
+    Args:
+        update_listeners: Called with each update (the list may be added to later).
+    """
+    #: Exported on /metrics/.
+    metrics = Metrics()
+    for name, help_ in [
+            ("fex_rendered_objects_total", "Objects rendered by /render/"),
+            ("fex_render_cache_hits_total", "Rendered objects found in the render cache"),
+            ("fex_render_cache_misses_total", "Rendered objects not found in the render cache"),
+            ("fex_search_queries_total", "Search queries answered"),
+            ("fex_search_results_total", "Search results returned"),
+            ("fex_updated_objects_total", "Objects updated"),
+            ("fex_rejected_updates_total", "Updates rejected as invalid"),
+            ("fex_conflicting_updates_total", "Updates rejected as based on an old version"),
+            ("fex_assigned_objects_total", "Objects leased to annotators by /assign/")]:
+        metrics.describe(name, "counter", help_)
+
     # Initializes a bottle server.
     app = Bottle()
+    app.uninstall(bottle.JSONPlugin)
+    # Plugins installed first wrap those installed later, so requests are timed including the
+    # time it takes to encode their responses.
+    app.install(MetricsPlugin(metrics, profiler))
+    app.install(JSONPlugin(metrics))
+    #: Serializes updates so that concurrent requests can't interleave a check and a write.
+    update_lock = threading.Lock()
+    #: How many times each object has been updated while serving, which keys ETags and the
+    #: render cache. An object's version is bumped after the object itself is saved.
+    versions: Dict[int, int] = {}
+    #: Identifies this run of the server in ETags, since `versions` are not persisted.
+    epoch = os.urandom(8).hex()
+    if update_listeners is None:
+        update_listeners = []
+
+    def version_of(idx: int) -> str:
+        return annotations_version(get_objs(idx, idx + 1)[0])
+
+    def is_labeled(idx: int) -> bool:
+        # Objects may also have been labeled before annotations went to the store.
+        return bool(data[idx].get("_fex")) or (store is not None and bool(store.get(idx)))
+
+    def unlabeled(start: int):
+        if store is not None:
+            return (idx for idx in store.unlabeled(len(data), start=start)
+                    if not data[idx].get("_fex"))
+        return (idx for idx in range(start, len(data)) if not is_labeled(idx))
+    #: Hands out unlabeled objects to annotators on /assign/.
+    scheduler = Scheduler(unlabeled, is_labeled, lease_time)
+
+    if render_cache is not None:
+        config.add_listener(lambda config_: render_cache.retain(config_.template_hash))
+
+        def collect_cache_metrics(metrics_):
+            metrics_.set("fex_render_cache_hits_total", render_cache.hits)
+            metrics_.set("fex_render_cache_misses_total", render_cache.misses)
+        metrics.add_collector(collect_cache_metrics)
+    if store is not None:
+        store.add_fields(config.schemas)
+        config.add_listener(lambda config_: store.add_fields(config_.schemas))
 
-    @app.get('/static/<path:path>')
+    def get_objs(start, end):
+        """
+        Returns the objects in `[start, end)` with their annotations.
+        """
+        objs = data[start: end]
+        if store is None:
+            return objs
+        annotations = store.get_many(range(start, start + len(objs)))
+        return [merge_annotations(obj, annotations[start + i]) if start + i in annotations
+                else obj for i, obj in enumerate(objs)]
+
+    @app.get('/static/<path:path>', profile=False)
     def static(path):
-        return static_file(path, STATIC_DIR)
+        """
+        Serves static files. Pages request them with a `v` parameter that changes with their
+        contents, so browsers may keep those for long; others must be revalidated.
+        """
+        if "v" in bottle.request.query:
+            response = static_file(path, STATIC_DIR)
+            if response.status_code < 400:
+                response.set_header("Cache-Control", f"public, max-age={STATIC_MAX_AGE}, immutable")
+            return response
+
+        fname = os.path.abspath(os.path.join(STATIC_DIR, path))
+        if not fname.startswith(os.path.abspath(STATIC_DIR) + os.sep) or \
+                not os.path.isfile(fname):
+            # Lets Bottle answer with the right error.
+            return static_file(path, STATIC_DIR)
+        stat = os.stat(fname)
+        etag = '"{}"'.format(hashlib.blake2b(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode(
+            "utf-8"), digest_size=16).hexdigest())
+        if etag_matches(etag):
+            response = bottle.HTTPResponse(status=304)
+        else:
+            response = static_file(path, STATIC_DIR)
+        if response.status_code < 400:
+            response.set_header("Cache-Control", "no-cache")
+            response.set_header("ETag", etag)
+        return response
 
     @app.get('/view/')
     @app.get('/')
     @jinja2_view('view.html', template_lookup=[TEMPLATE_DIR])
     def view():
-        return {"url": bottle.request.url}
+        return {"url": bottle.request.url, "static_version": STATIC_VERSION}
 
     @app.get('/label/')
     @jinja2_view('label.html', template_lookup=[TEMPLATE_DIR])
     def label():
-        return {"url": bottle.request.url}
+        return {"url": bottle.request.url, "static_version": STATIC_VERSION}
 
     # API
     # @app.get('/autocomplete/')
@@ -52,49 +416,521 @@ def serve(data: FileBackedJsonList, config: Config, port=8080):
 
     @app.get('/schema/')
     def get_schema():
-        if config.dirty:
-            config.reload()
         return config.cfg.get("schema", {})
 
+    def render_obj(state, idx, version, obj):
+        if render_cache is None:
+            return state.template.render(obj=obj)
+        return render_cache.render(state.template, state.template_hash, idx, version, obj)
+
     @app.get('/render/')
     def render():
-        if config.dirty:
-            config.reload()
+        """
+        Renders `count` objects starting at `start`. The objects themselves (as `obj`) and
+        their versions (as `versions`) are only included if the `obj` parameter is true, e.g.
+        for clients that edit annotations. `template` identifies the template they were
+        rendered with, so that clients can tell when rendered objects they kept are outdated.
+        """
+        # Render the whole page with one template, even if the configuration is reloaded midway.
+        state = config.state
 
-        start = int(bottle.request.query.get("start", 0))
-        count_ = int(bottle.request.query.get("count", 10))
+        start = int_param(bottle.request.query, "start", 0)
+        count_ = int_param(bottle.request.query, "count", 10)
+        with_obj = bottle.request.query.get("obj", "").lower() in ("1", "true", "yes")
         if start > len(data):
             abort(400, "No more data")
-        return {
-            "html": [config.template.render(obj=obj) for obj in data[start: start + count_]],
-            "obj": data[start: start + count_],
+
+        # The response only depends on the template and the versions of the objects it holds.
+        # Versions are read before the objects, so that a concurrent update can't make us tag
+        # an outdated object with its new version.
+        end = min(start + count_, len(data))
+        object_versions = [versions.get(idx, 0) for idx in range(start, end)]
+        key = [epoch, state.template_hash, start, end, with_obj] + object_versions
+        etag = '"{}"'.format(hashlib.blake2b(codec.dumps(key).encode("utf-8"),
+                                             digest_size=16).hexdigest())
+        bottle.response.set_header("Cache-Control", "no-cache")
+        matched = etag_matches(etag)
+        if matched:
+            bottle.response.status = 304
+            bottle.response.set_header("ETag", matched)
+            return ""
+        bottle.response.set_header("ETag", etag)
+
+        with metrics.time("fex_stage_duration_seconds", endpoint="/render/", stage="data"):
+            objs = get_objs(start, end)
+        with metrics.time("fex_stage_duration_seconds", endpoint="/render/", stage="template"):
+            html = [render_obj(state, start + i, version, obj)
+                    for i, (version, obj) in enumerate(zip(object_versions, objs))]
+        metrics.inc("fex_rendered_objects_total", len(objs))
+        ret = {
+            "start": start,
+            "html": html,
+            "template": state.template_hash,
         }
+        if with_obj and store is None:
+            # Send objects as they are stored in the file, only encoding those modified since.
+            ret["obj"] = RawJSON.array(
+                raw if raw is not None else codec.dumps(obj).encode("utf-8")
+                for raw, obj in zip((data.raw(idx) for idx in range(start, end)), objs))
+        elif with_obj:
+            ret["obj"] = objs
+        if with_obj:
+            ret["versions"] = [annotations_version(obj) for obj in objs]
+        return ret
+
+    def check_update(idx, obj):
+        """
+        Returns:
+            Why `obj` is not a valid update of object `idx`, or None if it is.
+        """
+        if not isinstance(idx, int) or isinstance(idx, bool) or not 0 <= idx < len(data):
+            return f"{idx} is not a valid idx"
+        if not isinstance(obj, dict):
+            return "Provided response is not an object"
+        # Only annotations may change: the rest of the object must be sent back as it is.
+        current = data[idx]
+        if {key: value for key, value in obj.items() if key != "_fex"} != \
+                {key: value for key, value in current.items() if key != "_fex"}:
+            return "Provided response has an object that does not correspond to this idx"
+        schemas = config.schemas
+        for name, value in (obj.get("_fex") or {}).items():
+            if name in schemas and value is not None and not schemas[name].validate(value):
+                return f"Invalid value for {name}: {value!r}"
+        return None
+
+    def check_versions(items):
+        """
+        Aborts with 409 Conflict if any `(idx, version)` pair names a version of its object
+        other than the current one, i.e. if the object changed since the client read it. Updates
+        without a version overwrite the object regardless.
+        """
+        conflicts = [{"idx": idx, "version": version_of(idx)} for idx, version in items
+                     if version is not None and version != version_of(idx)]
+        if conflicts:
+            metrics.inc("fex_conflicting_updates_total", len(conflicts))
+            raise bottle.HTTPResponse({"conflicts": conflicts}, status=409)
+
+    def apply_updates(items):
+        """
+        Saves `(idx, obj)` pairs (that have been checked) with a single write.
+        """
+        metrics.inc("fex_updated_objects_total", len(items))
+        old = [get_objs(idx, idx + 1)[0] for idx, _ in items]
+        if store is not None:
+            store.upsert_many([(idx, obj.get("_fex") or {}) for idx, obj in items],
+                              annotator=bottle.request.query.get("annotator"))
+            items = [(idx, merge_annotations(data[idx], obj.get("_fex") or {}))
+                     for idx, obj in items]
+        else:
+            data.update_many(items)
+        client = bottle.request.query.get("client")
+        for (idx, obj), old_obj in zip(items, old):
+            versions[idx] = versions.get(idx, 0) + 1
+            if search_index is not None:
+                search_index.update(idx, old_obj, obj)
+            if render_cache is not None:
+                render_cache.invalidate(idx)
+            scheduler.complete(idx)
+            for listener in update_listeners:
+                listener(idx, version_of(idx), client)
 
     @app.post('/update/<idx:int>/')
     def update(idx):
+        """
+        Saves an object. If the `version` parameter is given, the object is only saved if that
+        is still its current version (see `check_versions`). Returns the object's new version.
+        """
+        if read_only and store is None:
+            abort(403, "The data is read-only")
         obj = bottle.request.json
 
-        # Some server-side validation
-        for key in obj:
-            if key == "_fex":
-                continue
-            if obj[key] != data[idx][key]:
-                abort(400, "Provided response has an object that does not correspond to this idx")
+        with update_lock:
+            # Some server-side validation
+            error = check_update(idx, obj)
+            if error:
+                metrics.inc("fex_rejected_updates_total")
+                abort(400, error)
+            check_versions([(idx, bottle.request.query.get("version"))])
+            with metrics.time("fex_stage_duration_seconds", endpoint="/update/", stage="write"):
+                apply_updates([(idx, obj)])
+            return {"version": version_of(idx)}
+
+    @app.post('/update/batch/')
+    def update_batch():
+        """
+        Saves many updates at once. The request is a JSON object whose `updates` field is a list
+        of `{"idx": ..., "obj": ..., "version": ...}` objects (`version` is optional, see
+        `check_versions`); either all of them are saved or (if any is invalid or conflicts)
+        none are. Returns the new version of each object.
+        """
+        if read_only and store is None:
+            abort(403, "The data is read-only")
+        body = bottle.request.json
+        updates = body.get("updates") if isinstance(body, dict) else None
+        if not isinstance(updates, list):
+            abort(400, "No updates provided")
 
-        data[idx] = obj
+        with update_lock:
+            items = []
+            for update_ in updates:
+                if not isinstance(update_, dict):
+                    abort(400, "Each update must be an object with an idx and obj")
+                idx, obj = update_.get("idx"), update_.get("obj")
+                error = check_update(idx, obj)
+                if error:
+                    metrics.inc("fex_rejected_updates_total")
+                    abort(400, f"Update of {idx}: {error}")
+                items.append((idx, obj))
+            # Only the first update of an object can name the version it read; later updates
+            # in the batch build on it.
+            check_versions(list({update_["idx"]: update_.get("version")
+                                 for update_ in reversed(updates)}.items()))
+            # Later updates of the same object win.
+            items = list(dict(items).items())
+            with metrics.time("fex_stage_duration_seconds", endpoint="/update/batch/",
+                              stage="write"):
+                apply_updates(items)
+            return {"count": len(items),
+                    "versions": {str(idx): version_of(idx) for idx, _ in items}}
+
+    @app.post('/assign/')
+    def assign():
+        """
+        Leases (at most) `count` unlabeled objects to the `session` (e.g. a browser tab) that
+        asks for them, so that annotators working in parallel never get the same objects, and
+        renews the leases the session already holds. Leases last `lease_time` seconds, and end
+        early when an object is updated or released on `/assign/release/`.
+        """
+        session = bottle.request.query.get("session")
+        if not session:
+            abort(400, "No session provided")
+        count_ = int_param(bottle.request.query, "count", 10)
+        indices = scheduler.acquire(session, count_)
+        metrics.inc("fex_assigned_objects_total", len(indices))
+        return {"indices": indices, "lease_time": lease_time}
+
+    @app.post('/assign/release/')
+    def assign_release():
+        """
+        Hands the objects leased to `session` (those in the request's `indices`, or all of
+        them) back to other annotators.
+        """
+        session = bottle.request.query.get("session")
+        if not session:
+            abort(400, "No session provided")
+        params = bottle.request.json or {}
+        indices = params.get("indices") if isinstance(params, dict) else ()
+        if indices is not None and not (isinstance(indices, list) and all(
+                isinstance(idx, int) and not isinstance(idx, bool) and 0 <= idx < len(data)
+                for idx in indices)):
+            abort(400, "indices must be a list of valid idxs")
+        scheduler.release(session, indices)
         return {}
 
-    # TODO: reimplement search
-    # @app.get('/search/<query>')
-    # @app.post('/search/')
-    # def search(query=None):
-    #     if query is None:
-    #         query_obj = bottle.request.json
-    #         query = query_obj.get('query')
-    #     results = find_record_indices(data, query, query_schema)
-    #     bottle.response.content_type = 'application/json'
-    #     return json.dumps(results)
-
-    webbrowser.open_new_tab(f"http://localhost:{port}")
-    app.run(reloader=False, port=port, debug=True)
-    data.save()
+    @app.get('/stats/')
+    def stats():
+        """
+        Summarizes annotation progress: label counts for each classification field, how many
+        objects are labeled, how many each annotator labeled and how many are assigned.
+        """
+        if store is None:
+            abort(404, "Statistics require an annotation store (fex run --store)")
+        return {
+            "count": len(data),
+            "labeled": len(store),
+            "labels": {name: store.label_counts(name) for name, schema in config.schemas.items()
+                       if isinstance(schema, ClassificationSchema)},
+            "annotators": store.progress(),
+            "assigned": scheduler.stats(),
+        }
+
+    def search_params(stream=False):
+        """
+        Returns:
+            The query, cursor and limit of a search request. Streams are only limited if they
+            ask to be.
+        """
+        if bottle.request.method == 'POST':
+            params = bottle.request.json
+            if not isinstance(params, dict):
+                abort(400, "The request must be a JSON object")
+        else:
+            params = bottle.request.query
+        query = params.get("query", params.get("q"))
+        if not query or not isinstance(query, str):
+            abort(400, "No query provided")
+        try:
+            compile_query(query, query_schema)
+        except QueryError as e:
+            abort(400, str(e))
+        cursor = int_param(params, "cursor", 0)
+        limit = None if stream and not params.get("limit") else \
+            int_param(params, "limit", 50, minimum=1)
+        return query, cursor, limit
+
+    @app.get('/search/')
+    @app.post('/search/')
+    def search():
+        """
+        Returns a page of at most `limit` matching indices, starting at record `cursor`, and the
+        cursor to continue from (null once there are no more results).
+        """
+        query, cursor, limit = search_params()
+        metrics.inc("fex_search_queries_total", indexed=str(search_index is not None).lower())
+        with metrics.time("fex_stage_duration_seconds", endpoint="/search/", stage="search"):
+            matches = iter_record_indices(data, query, query_schema, search_index,
+                                          start=cursor, scanner=scanner)
+            results = list(itertools.islice(matches, limit))
+        metrics.inc("fex_search_results_total", len(results))
+        return {
+            "results": results,
+            "cursor": results[-1] + 1 if len(results) == limit else None,
+        }
+
+    @app.get('/search/stream/')
+    @app.post('/search/stream/')
+    def search_stream():
+        """
+        Streams matching indices as newline-delimited JSON while we scan, stopping after `limit`
+        of them if it is given.
+        """
+        query, cursor, limit = search_params(stream=True)
+        matches = iter_record_indices(data, query, query_schema, search_index, start=cursor,
+                                      scanner=scanner)
+        bottle.response.content_type = 'application/x-ndjson'
+        return (codec.dumps({"idx": i}) + "\n" for i in itertools.islice(matches, limit))
+
+    @app.get('/metrics/', profile=False)
+    def get_metrics():
+        """
+        Exports request counts, latencies and cache statistics in Prometheus' text format.
+        """
+        bottle.response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        return metrics.render()
+
+    return app
+
+
+def serve(data: Union[FileBackedJsonList, ShardedJsonList], config: Config, port=8080,
+          host="localhost", workers=0, query_schema: Optional[QuerySchema] = None,
+          search_index: Optional[SearchIndex] = None, render_cache: Optional[RenderCache] = None,
+          store: Optional[AnnotationStore] = None, profiler: Optional[Profiler] = None,
+          scanner: Optional[ParallelScanner] = None, read_only: bool = False,
+          engine: str = "threads", lease_time: float = 600.0):
+    """
+    Serves `data` until interrupted.
+
+    Args:
+        workers: If positive, serve requests concurrently on this many threads with debugging
+                 turned off. Otherwise, we run Bottle's (single-threaded) debug server and open
+                 a browser tab.
+        store: If provided, annotations (the `_fex` field of objects) are saved in this store
+               instead of in `data`, which is then never modified.
+        profiler: If provided, requests are profiled and the slowest profiles are saved.
+        scanner: If provided (and there is no `search_index`), searches scan `data` on its
+                 pool of processes.
+        read_only: If set, `data` is never modified: updates are rejected unless they go to a
+                   `store`.
+        engine: 'threads' to serve requests on a pool of `workers` threads, or 'asyncio' to
+                handle connections on an event loop (see `fastex.aserver`), which also pushes
+                updates and configuration changes to clients on `/events/`.
+        lease_time: How long (in seconds) unlabeled objects handed out by `/assign/` are
+                    reserved for the annotator that asked for them.
+    """
+    update_listeners: List[UpdateListener] = []
+    app = make_app(data, config, query_schema=query_schema, search_index=search_index,
+                   render_cache=render_cache, store=store, profiler=profiler, scanner=scanner,
+                   read_only=read_only, lease_time=lease_time,
+                   update_listeners=update_listeners)
+
+    # The configuration is reloaded in the background whenever its file changes.
+    watcher = ConfigWatcher(config)
+    watcher.start()
+    try:
+        if engine == "asyncio":
+            from fastex.aserver import AsyncioServer
+            server = AsyncioServer(host=host, port=port, workers=workers)
+            update_listeners.append(lambda idx, version, client: server.publish(
+                "update", {"idx": idx, "version": version, "client": client}))
+            config.add_listener(lambda config_: server.publish(
+                "config", {"template": config_.template_hash}))
+            app.run(server=server, quiet=True, reloader=False, debug=False)
+        elif workers > 0:
+            app.run(server=ThreadPoolServer(host=host, port=port, workers=workers), quiet=True,
+                    reloader=False, debug=False)
+        else:
+            webbrowser.open_new_tab(f"http://localhost:{port}")
+            app.run(reloader=False, host=host, port=port, debug=True)
+    finally:
+        watcher.stop()
+        if store is None:
+            data.save()
+
+
+def _request(app: Bottle, method: str, path: str, body=None):
+    """
+    Runs a request through `app` for tests.
+
+    Returns:
+        The response's status code and its body, decoded if it is JSON.
+    """
+    import io
+    from wsgiref.util import setup_testing_defaults
+
+    path, _, query = path.partition("?")
+    payload = codec.dumps(body).encode("utf-8") if body is not None else b""
+    environ = {"REQUEST_METHOD": method, "PATH_INFO": path, "QUERY_STRING": query,
+               "CONTENT_TYPE": "application/json", "CONTENT_LENGTH": str(len(payload)),
+               "wsgi.input": io.BytesIO(payload)}
+    setup_testing_defaults(environ)
+    started: Dict[str, Any] = {}
+
+    def start_response(status, headers, exc_info=None):
+        started.update(status=int(status.split()[0]), headers=dict(headers))
+
+    content = b"".join(app(environ, start_response))
+    if started["headers"].get("Content-Type", "").startswith("application/json"):
+        return started["status"], codec.loads(content)
+    return started["status"], content
+
+
+def _test_app(tmp_path, count: int = 5, **kwargs):
+    """
+    Returns:
+        An app that serves `count` records saved in `tmp_path`, and those records.
+    """
+    fname = str(tmp_path / "data.jsonl")
+    FileBackedJsonList(fname).extend({"id": i, "text": f"record {i}"} for i in range(count))
+    data = FileBackedJsonList(fname)
+    config = Config({"template": "<p>{{ obj.text }}{% if obj._fex %} ({{ obj._fex.intent }})"
+                                 "{% endif %}</p>", "schema": {
+        "intent": {"type": "classification", "values": [{"name": "A"}, {"name": "B"}]},
+    }})
+    return make_app(data, config, **kwargs), data
+
+
+def test_update_batch(tmp_path):
+    from fastex.util import load_jsonl
+
+    app, data = _test_app(tmp_path)
+
+    def labeled(idx, intent):
+        return {"id": idx, "text": f"record {idx}", "_fex": {"intent": intent}}
+
+    status, ret = _request(app, "POST", "/update/batch/", {"updates": [
+        {"idx": 0, "obj": labeled(0, "A")}, {"idx": 2, "obj": labeled(2, "B")}]})
+    assert status == 200 and ret["count"] == 2 and sorted(ret["versions"]) == ["0", "2"]
+    assert data[0] == labeled(0, "A") and data[2] == labeled(2, "B")
+    assert load_jsonl(data.fname)[2] == labeled(2, "B")
+
+    for body in [[1], "updates", {"updates": 3}, {"updates": [1]}]:
+        assert _request(app, "POST", "/update/batch/", body)[0] == 400
+    # Invalid indices (including booleans) and objects that don't match the record are refused.
+    for update_ in [{"idx": True, "obj": labeled(1, "A")}, {"idx": 5, "obj": labeled(5, "A")},
+                    {"idx": 1, "obj": {"id": 1}}, {"idx": 1, "obj": labeled(3, "A")}]:
+        assert _request(app, "POST", "/update/batch/", {"updates": [update_]})[0] == 400
+    assert data[1] == {"id": 1, "text": "record 1"}
+
+    # Either every update of a batch is saved or none is.
+    status, _ = _request(app, "POST", "/update/batch/", {"updates": [
+        {"idx": 3, "obj": labeled(3, "A")}, {"idx": 4, "obj": labeled(4, "C")}]})
+    assert status == 400 and "_fex" not in data[3]
+
+    # Updates based on an old version of an object conflict with the current one.
+    version = ret["versions"]["0"]
+    status, ret = _request(app, "POST", "/update/batch/", {"updates": [
+        {"idx": 0, "obj": labeled(0, "B"), "version": version}]})
+    assert status == 200 and ret["versions"]["0"] != version
+    status, ret = _request(app, "POST", "/update/batch/", {"updates": [
+        {"idx": 0, "obj": labeled(0, "A"), "version": version},
+        {"idx": 3, "obj": labeled(3, "A")}]})
+    assert status == 409 and ret["conflicts"] == [{"idx": 0, "version": annotations_version(
+        labeled(0, "B"))}]
+    assert data[0] == labeled(0, "B") and "_fex" not in data[3]
+
+
+def test_render(tmp_path):
+    app, data = _test_app(tmp_path, render_cache=RenderCache(16))
+    status, ret = _request(app, "GET", "/render/?start=1&count=2&obj=1")
+    assert status == 200 and ret["start"] == 1
+    assert ret["html"] == ["<p>record 1</p>", "<p>record 2</p>"] and ret["obj"] == data[1:3]
+    assert ret["versions"] == [annotations_version(obj) for obj in data[1:3]]
+    assert "obj" not in _request(app, "GET", "/render/?start=4")[1]
+
+    for query in ["start=abc", "start=-3", "count=-1", "count=x", "start=6"]:
+        assert _request(app, "GET", f"/render/?{query}")[0] == 400
+
+    # Updated objects are rendered again rather than served from the cache.
+    status, _ = _request(app, "POST", "/update/2/", {"id": 2, "text": "record 2",
+                                                     "_fex": {"intent": "A"}})
+    assert status == 200
+    assert _request(app, "GET", "/render/?start=1&count=2")[1]["html"] == \
+        ["<p>record 1</p>", "<p>record 2 (A)</p>"]
+
+
+def test_versions_and_assignments(tmp_path):
+    app, data = _test_app(tmp_path, count=10, lease_time=1.0)
+
+    def labeled(idx, intent):
+        return {"id": idx, "text": f"record {idx}", "_fex": {"intent": intent}}
+
+    # Updates must name the version of the object they are based on, if any.
+    version = _request(app, "GET", "/render/?start=0&count=1&obj=1")[1]["versions"][0]
+    status, ret = _request(app, "POST", f"/update/0/?version={version}", labeled(0, "A"))
+    assert status == 200 and ret["version"] == annotations_version(labeled(0, "A"))
+    status, ret = _request(app, "POST", f"/update/0/?version={version}", labeled(0, "B"))
+    assert status == 409
+    assert ret["conflicts"] == [{"idx": 0, "version": annotations_version(labeled(0, "A"))}]
+    assert data[0] == labeled(0, "A")
+
+    # Sessions get disjoint batches of unlabeled objects.
+    assert _request(app, "POST", "/assign/")[0] == 400
+    assert _request(app, "POST", "/assign/?session=a&count=-1")[0] == 400
+    assert _request(app, "POST", "/assign/?session=a&count=3")[1]["indices"] == [1, 2, 3]
+    assert _request(app, "POST", "/assign/?session=b&count=3")[1]["indices"] == [4, 5, 6]
+
+    # Labeling ends a lease and releasing hands objects back.
+    assert _request(app, "POST", "/update/1/", labeled(1, "A"))[0] == 200
+    assert _request(app, "POST", "/assign/release/?session=b", {"indices": [5, True]})[0] == 400
+    assert _request(app, "POST", "/assign/release/?session=b", {"indices": [5]})[0] == 200
+    assert _request(app, "POST", "/assign/?session=c&count=3")[1]["indices"] == [5, 7, 8]
+
+    # Leases that aren't renewed expire.
+    time.sleep(0.6)
+    assert _request(app, "POST", "/assign/?session=a&count=0")[1]["indices"] == []
+    time.sleep(0.6)
+    assert _request(app, "POST", "/assign/?session=d&count=10")[1]["indices"] == [4, 5, 6, 7, 8, 9]
+
+
+def test_search(tmp_path):
+    schema = QuerySchema({"fields": [{"name": "id", "type": "int"},
+                                     {"name": "text", "type": "text"}], "types": []})
+    for indexed in [False, True]:
+        directory = tmp_path / str(indexed)
+        directory.mkdir()
+        search_index = SearchIndex.build([{"id": i, "text": f"record {i}"} for i in range(12)],
+                                         schema) if indexed else None
+        app, _ = _test_app(directory, count=12, query_schema=schema, search_index=search_index)
+
+        # Page through the results with the returned cursor.
+        results, cursor = [], 0
+        while cursor is not None:
+            status, ret = _request(app, "GET", f"/search/?q=record&limit=5&cursor={cursor}")
+            assert status == 200 and len(ret["results"]) <= 5
+            results += ret["results"]
+            cursor = ret["cursor"]
+        assert results == list(range(12))
+        status, ret = _request(app, "POST", "/search/", {"query": "id:>=3", "limit": 2})
+        assert ret == {"results": [3, 4], "cursor": 5}
+        assert _request(app, "GET", "/search/?q=id:>=3&cursor=11")[1] == \
+            {"results": [11], "cursor": None}
+        for query in ["q=", "q=a:b:c", "q=x&limit=0", "q=x&cursor=-1"]:
+            assert _request(app, "GET", f"/search/?{query}")[0] == 400
+
+        # Streams hold one JSON object per line, and are only limited when asked to be.
+        status, ret = _request(app, "GET", "/search/stream/?q=record&cursor=2")
+        assert status == 200 and ret.endswith(b"\n")
+        assert [codec.loads(line)["idx"] for line in ret.splitlines()] == list(range(2, 12))
+        status, ret = _request(app, "POST", "/search/stream/", {"q": "record", "limit": 3})
+        assert ret == b'{"idx":0}\n{"idx":1}\n{"idx":2}\n'
+        assert _request(app, "GET", "/search/stream/?q=record&limit=-1")[0] == 400
@@ -19,6 +19,138 @@ function addInputGroup(label, input) {
 }
 // endregion
 
+/**
+ * RenderBuffer keeps a bounded, least-recently-used cache of rendered objects and
+ * fetches missing ones from the server. Windows are prefetched ahead of time so
+ * that navigating to them does not wait on the network. Objects that change must
+ * be dropped with `invalidate`; the whole buffer is cleared once the server
+ * renders with a different template.
+ */
+class RenderBuffer {
+  /**
+   * @param withObj - if true, also fetch the raw objects (not just their HTML)
+   * @param maxSize - the maximum number of objects to keep
+   */
+  constructor(withObj, maxSize) {
+    this.withObj = withObj || false;
+    this.maxSize = maxSize || 500;
+    // Maps an index to its {html, obj}, in order of use.
+    this._items = new Map();
+    // Requests in flight, keyed by range, so that we never fetch a range twice.
+    this._requests = new Map();
+    // The template that the buffered objects were rendered with.
+    this.template = null;
+    // Bumped whenever buffered objects are dropped, so that requests that were in
+    // flight at the time don't add outdated objects back.
+    this._generation = 0;
+  }
+
+  /**
+   * Returns a promise of the (up to) `count` items starting at `start`; fewer
+   * are returned at the end of the data.
+   */
+  get(start, count) {
+    const missing = [];
+    for (let i = start; i < start + count; i++) {
+      if (!this._items.has(i)) missing.push(i);
+    }
+    if (missing.length === 0) return Promise.resolve(this._collect(start, count, {}));
+
+    const lower = missing[0];
+    const upper = missing[missing.length - 1] + 1;
+    const generation = this._generation;
+    return this._fetch(lower, upper - lower).then(fetched => {
+      // Items we meant to reuse may have been dropped in the meantime.
+      if (this._generation !== generation) return this.get(start, count);
+      return this._collect(start, count, fetched);
+    });
+  }
+
+  /**
+   * Fetches a window in the background, ignoring errors.
+   */
+  prefetch(start, count) {
+    if (start < 0) {
+      count += start;
+      start = 0;
+    }
+    if (count > 0) this.get(start, count).catch(() => {});
+  }
+
+  /**
+   * Drops the object at `idx` (e.g. after it has been updated).
+   */
+  invalidate(idx) {
+    this._items.delete(idx);
+    this._generation++;
+  }
+
+  /**
+   * Drops every object, e.g. after the template changed.
+   */
+  clear() {
+    this._items.clear();
+    this._generation++;
+  }
+
+  /**
+   * Notes the template that the server renders with, and clears the buffer if it
+   * differs from the one buffered objects were rendered with.
+   */
+  setTemplate(template) {
+    if (this.template !== null && template !== this.template) this.clear();
+    this.template = template;
+  }
+
+  _collect(start, count, fetched) {
+    const ret = [];
+    for (let i = start; i < start + count; i++) {
+      const item = this._items.has(i) ? this._items.get(i) : fetched[i];
+      if (item == null) break;
+      // Mark the item as recently used.
+      this._items.delete(i);
+      this._items.set(i, item);
+      ret.push(item);
+    }
+    return ret;
+  }
+
+  _fetch(start, count) {
+    const key = start + "-" + count;
+    if (this._requests.has(key)) return this._requests.get(key);
+
+    const self = this;
+    const generation = this._generation;
+    const request = Promise.resolve($.ajax({
+      url: "/render/",
+      contentType: "application/json",
+      method: "GET",
+      data: {start: start, count: count, obj: self.withObj},
+    })).then(data => {
+      self._requests.delete(key);
+      // Objects may have changed while they were being fetched.
+      const current = self._generation === generation;
+      self.setTemplate(data.template);
+      const fetched = {};
+      for (let i = 0; i < data.html.length; i++) {
+        const item = {html: data.html[i], obj: data.obj ? data.obj[i] : null};
+        fetched[start + i] = item;
+        if (current) self._items.set(start + i, item);
+      }
+      // Evict the least recently used items.
+      while (self._items.size > self.maxSize) {
+        self._items.delete(self._items.keys().next().value);
+      }
+      return fetched;
+    }, err => {
+      self._requests.delete(key);
+      throw err;
+    });
+    this._requests.set(key, request);
+    return request;
+  }
+}
+
 /**
  * ViewInterface renders multiple widgets in the main block and allows users to
  * select which range of widgets to render through the nav-bar
@@ -28,8 +160,10 @@ class ViewInterface {
    * Constructs a view interface
    * @param elem - the root element to draw the interface in
    * @param nav - the navbar element
+   * @param rangeCount - the number of elements to show at a time
+   * @param withObj - if true, also fetch the raw objects being rendered
    */
-  constructor(elem, nav, rangeCount) {
+  constructor(elem, nav, rangeCount, withObj) {
     if (rangeCount == null) rangeCount = 10;
 
     this.elem = $(elem);
@@ -38,11 +172,14 @@ class ViewInterface {
     this.range = [0, rangeCount];
     // The total number of elements.
     this.count = 0;
+    // Rendered elements, including prefetched ones.
+    this.buffer = new RenderBuffer(withObj, Math.max(500, 10 * rangeCount));
   }
 
   init() {
     // Hook up callbacks.
     this._setupCallbacks();
+    this._subscribe();
     this.updateCount();
 
     const [lower, upper] = this.range;
@@ -70,6 +207,30 @@ class ViewInterface {
     });
   }
 
+  // Drops objects from the buffer when they are updated or the template changes, and
+  // redraws the current range if it is affected. Only the asyncio server engine sends
+  // events; with the threaded engine /events/ is not found and the browser gives up.
+  _subscribe() {
+    if (typeof EventSource === "undefined") return;
+    const self = this;
+    const source = new EventSource("/events/");
+    source.addEventListener("update", (evt) => {
+      const idx = JSON.parse(evt.data).idx;
+      self.buffer.invalidate(idx);
+      if (self.range[0] <= idx && idx < self.range[1]) self.refresh();
+    });
+    source.addEventListener("config", (evt) => {
+      if (JSON.parse(evt.data).template === self.buffer.template) return;
+      self.buffer.clear();
+      self.refresh();
+    });
+  }
+
+  refresh() {
+    const [lower, upper] = this.range;
+    this.updateRange(lower, upper - lower);
+  }
+
   next() {
     const self = this;
     const [lower, upper] = self.range;
@@ -116,23 +277,28 @@ class ViewInterface {
     if (count == null) count = 10;
     if (start == null) start = 0;
 
-    // Get renderables from the server.
-    $.ajax({
-      url: "/render/",
-      contentType: "application/json",
-      method: "GET",
-      data: {start: start, count: count},
-      success: function(data) {
-        // Clear root.
-        self.elem.empty();
-        for (let i = 0; i < data.html.length; i++)  {
-          const html = self.renderTemplate(start + i, data.html[i]);
-          self.elem.append(html);
-        }
-        self.nav.find("#nav-range").val((start+1) + "-" + (start+count));
-        self.range = [start, start+count];
+    // Move right away so that repeated navigation doesn't wait on the server.
+    self.range = [start, start+count];
+    self.nav.find("#nav-range").val((start+1) + "-" + (start+count));
+
+    self.buffer.get(start, count).then(items => {
+      // Ignore responses for ranges we have since navigated away from.
+      if (self.range[0] !== start || self.range[1] !== start + count) return;
+
+      // Clear root.
+      self.elem.empty();
+      for (let i = 0; i < items.length; i++)  {
+        const html = self.renderTemplate(start + i, items[i].html);
+        self.elem.append(html);
       }
-    });
+      self.items = items;
+
+      // Fetch the neighbouring windows in the background.
+      if (self.count === 0 || start + count < self.count) {
+        self.buffer.prefetch(start + count, count);
+      }
+      self.buffer.prefetch(start - count, count);
+    }, console.log);
   }
 }
 
@@ -395,7 +561,7 @@ class LabelInterface extends ViewInterface {
    * @param nav - the navbar element
    */
   constructor(elem, annotations, nav) {
-    super(elem, nav, 1);
+    super(elem, nav, 1, true);
     this.annotations = $(annotations);
   }
 
@@ -462,6 +628,7 @@ class LabelInterface extends ViewInterface {
         data: JSON.stringify(blob),
         dataType: "json",
         success: function(data) {
+          self.buffer.invalidate(blob["_idx"]);
           self.widgets.forEach(w => w.dirty());
           self.setIdx(self.progress.value() + 1);
         }
@@ -4,20 +4,55 @@ class LabelInterface {
     this.nav = $(nav);
     this.index = 0;
     this.count = 0;
+    // The annotation schema from /schema/; objects are rendered once it has loaded.
     this.schema = null;
+    this._schemaLoaded = null;
 
     this.value = null;
     this._bindings = {};
     this._dirty = false;
+
+    // Updates are buffered and sent to the server in batches.
+    this.flushInterval = 2000;
+    this._pending = {};
+    this._inflight = {};
+    this._flushing = false;
+    // The version of each object that our changes to it are based on; the server rejects
+    // changes to objects that others changed since.
+    this._versions = {};
+    // Identifies our updates in the events the server sends about every update, and our
+    // session when the server assigns us objects.
+    this.clientId = Math.random().toString(36).slice(2);
+
+    // With /label/?assign, we only label the unlabeled objects that the server assigns us, in
+    // batches, so that annotators working at the same time never label the same objects.
+    this.assign = new URLSearchParams(window.location.search).has("assign");
+    this.batchSize = 20;
+    this.prefetchCount = 3;
+    // Assigned objects that we haven't shown yet, and those we have (to go back to).
+    this._work = [];
+    this._visited = [];
+    this._assigning = null;
+    this._exhausted = false;
+    // Requests for /render/ of objects that we'll show soon, by index.
+    this._prefetched = new Map();
   }
   init() {
-    this.updateSchema();
+    this._schemaLoaded = this.updateSchema();
     this.updateCount();
 
     // Hook up callbacks.
     this._setupCallbacks();
+    setInterval(() => this.flush(), this.flushInterval);
+    this._subscribe();
 
-    this.updateIndex();
+    if (this.assign) {
+      // Keeps the server from handing our objects to others while we work on them.
+      setInterval(() => this._requestWork(0), 60000);
+      this.next();
+    } else {
+      this.updateIndex();
+    }
   }
 
   _setupCallbacks() {
@@ -26,7 +61,7 @@ class LabelInterface {
     $("#nav-next").on("click", () => self.next());
     $("#nav-range").on("change", (evt) => {
       const value = Number.parseInt(evt.target.value);
-      self.updateIndex(value);
+      if (value >= 1 && value <= self.count) self.updateIndex(value - 1);
     });
 
     // Construct mappings to field change
@@ -35,30 +70,213 @@ class LabelInterface {
       else if (evt.key === "ArrowRight") self.next();
       else if (self._bindings[evt.key] != null) self._bindings[evt.key]();
     });
+
+    // Don't lose buffered updates when the page is closed, and let others label the objects
+    // assigned to us that we haven't seen.
+    $(window).on("pagehide", () => {
+      self.flush(true);
+      if (self.assign && self._work.length > 0 && navigator.sendBeacon) {
+        navigator.sendBeacon("/assign/release/?session=" + self.clientId,
+          new Blob([JSON.stringify({indices: self._work})], {type: "application/json"}));
+      }
+    });
+    $(document).on("visibilitychange", () => {
+      if (document.visibilityState === "hidden") self.flush(true);
+    });
+  }
+
+  // Reloads the object being labeled when another annotator updates it. Only the asyncio server
+  // engine sends events; with the threaded engine /events/ is not found and the browser gives up.
+  _subscribe() {
+    if (typeof EventSource === "undefined") return;
+    const self = this;
+    const source = new EventSource("/events/");
+    source.addEventListener("update", (evt) => {
+      const update = JSON.parse(evt.data);
+      if (update.client === self.clientId || update.idx !== self.index) return;
+      // Don't throw away changes that we haven't saved yet.
+      if (self._dirty || self._unsaved(update.idx) != null ||
+          $(document.activeElement).is("textarea")) return;
+      self.updateIndex(self.index);
+    });
+  }
+
+  // Queues the current value to be saved if it has been changed.
+  _queue() {
+    if (this._dirty) {
+      this._pending[this.index] = JSON.parse(JSON.stringify(this.value));
+      this._dirty = false;
+    }
+  }
+
+  // Sends all buffered updates to the server in one request. When the page is being closed
+  // (`unloading`) we use a beacon, which the browser delivers even after the page is gone.
+  flush(unloading) {
+    this._queue();
+    const indices = Object.keys(this._pending);
+    // Wait for the versions of our last batch before sending the next.
+    if (indices.length === 0 || (this._flushing && !unloading)) return;
+
+    const batch = this._pending;
+    this._pending = {};
+    const self = this;
+    const body = JSON.stringify({
+      updates: indices.map(idx => ({
+        idx: Number.parseInt(idx), obj: batch[idx], version: self._versions[idx],
+      })),
+    });
+    const url = "/update/batch/?client=" + this.clientId;
+    if (unloading && navigator.sendBeacon) {
+      navigator.sendBeacon(url, new Blob([body], {type: "application/json"}));
+      return;
+    }
+
+    Object.assign(this._inflight, batch);
+    this._flushing = true;
+    const done = () => {
+      self._flushing = false;
+      for (let idx of indices) {
+        if (self._inflight[idx] === batch[idx]) delete self._inflight[idx];
+      }
+    };
+    $.ajax({
+      url: url,
+      contentType: "application/json",
+      method: "POST",
+      data: body,
+      success: (data) => {
+        Object.assign(self._versions, data.versions);
+        done();
+      },
+      error: (xhr) => {
+        console.log(xhr);
+        done();
+        // Others changed these objects since we read them: keep their changes, not ours.
+        const conflicts = new Set();
+        if (xhr.status === 409) {
+          for (let conflict of xhr.responseJSON.conflicts) {
+            console.warn("Discarded our changes to " + conflict.idx + ", which were based " +
+                         "on an old version");
+            conflicts.add(String(conflict.idx));
+            delete self._versions[conflict.idx];
+            delete self._pending[conflict.idx];
+            if (conflict.idx === self.index) {
+              self._dirty = false;
+              self.updateIndex(self.index);
+            }
+          }
+        }
+        // Retry later, unless the server rejected the batch or the objects were changed since.
+        if (xhr.status !== 400) {
+          for (let idx of indices) {
+            if (self._pending[idx] == null && !conflicts.has(idx)) {
+              self._pending[idx] = batch[idx];
+            }
+          }
+        }
+      },
+    });
+  }
+
+  // Asks the server to assign us `count` more objects (which also renews our hold on those
+  // it already assigned us), and prefetches the first few.
+  _requestWork(count) {
+    if (count > 0 && this._assigning != null) return this._assigning;
+    const self = this;
+    const request = Promise.resolve($.ajax({
+      url: "/assign/?session=" + this.clientId + "&count=" + count,
+      method: "POST",
+    })).then(data => {
+      if (count > 0 && data.indices.length === 0) self._exhausted = true;
+      self._work.push(...data.indices);
+      self._prefetch();
+    });
+    if (count > 0) {
+      this._assigning = request;
+      request.finally(() => { self._assigning = null; }).catch(console.log);
+    }
+    return request;
+  }
+
+  _prefetch() {
+    for (let idx of this._work.slice(0, this.prefetchCount)) this._render(idx);
+  }
+
+  // Returns a promise of the rendered object `idx` (with its value and version).
+  _render(idx) {
+    if (this._prefetched.has(idx)) return this._prefetched.get(idx);
+    const request = Promise.resolve($.ajax({
+      url: "/render/",
+      contentType: "application/json",
+      method: "GET",
+      data: {start: idx, count: 1, obj: true},
+    }));
+    this._prefetched.set(idx, request);
+    request.catch(() => this._prefetched.delete(idx));
+    return request;
+  }
+
+  // The latest (possibly not yet saved) value of object `idx`, if it has been changed.
+  _unsaved(idx) {
+    if (this._pending[idx] != null) return this._pending[idx];
+    return this._inflight[idx];
   }
 
   next() {
-    if (this.index < this.count-1) {
+    if (this.assign) {
+      this._nextAssigned();
+    } else if (this.index < this.count-1) {
       this.updateIndex(this.index + 1);
     }
   }
   prev() {
-    if (this.index > 0) {
+    if (this.assign) {
+      // Go back to the object we labeled before this one.
+      const current = this._visited.indexOf(this.index);
+      if (current > 0) this.updateIndex(this._visited[current - 1]);
+    } else if (this.index > 0) {
       this.updateIndex(this.index - 1);
     }
   }
 
+  _nextAssigned() {
+    const self = this;
+    const current = this._visited.indexOf(this.index);
+    if (current >= 0 && current < this._visited.length - 1) {
+      this.updateIndex(this._visited[current + 1]);
+      return;
+    }
+    // Ask for more work before we run out.
+    if (this._work.length <= this.batchSize / 2 && !this._exhausted) {
+      this._requestWork(this.batchSize);
+    }
+    if (this._work.length === 0) {
+      if (this._exhausted) {
+        // Ask again next time, in case objects were handed back.
+        this._exhausted = false;
+        this._queue();
+        this.elem.empty().append($("<div class='alert alert-success'>")
+          .text("Every object has been labeled or assigned to another annotator."));
+      } else if (this._assigning != null) {
+        this._assigning.then(() => self._nextAssigned());
+      }
+      return;
+    }
+    const index = this._work.shift();
+    this._visited.push(index);
+    this._prefetch();
+    this.updateIndex(index);
+  }
+
+  // Returns a promise that resolves once the schema has loaded.
   updateSchema() {
-    // Set up schema in nav interface.
     const self = this;
-    $.ajax({
+    return Promise.resolve($.ajax({
       url: "/schema/",
       contentType: "application/json",
       method: "GET",
-      success: function(data) {
-        // Clear root.
-        self.schema = data;
-      }
+    })).then(data => {
+      self.schema = data || {};
     });
   }
 
@@ -78,14 +296,19 @@ class LabelInterface {
     });
   }
 
+  // Whether every classification has been made; text fields are optional. We never consider
+  // objects with multilabel fields complete, since we can't tell when their annotator is done.
   isComplete() {
     const anns = this.value._fex;
-    for (let field in this.schema.fields) {
-      if (this.schema.fields[field].optional !== true && anns[field] == null) {
-        return false;
-      }
+    let required = 0;
+    for (let field in this.schema) {
+      const desc = this.schema[field];
+      if (desc.type !== "classification") continue;
+      if (desc.mode === "multilabel") return false;
+      if (anns[field] == null) return false;
+      required++;
     }
-    return true;
+    return required > 0;
   }
 
   handleChange(change) {
@@ -110,56 +333,58 @@ class LabelInterface {
     ret.find("div.card-body").html(body);
 
     // Per template field.
-    const annotations = ret.find("ul.list-group.annotations");
+    this._bindings = {};
+    const annotations = ret.find("ul.annotations");
     const ann = this.value._fex;
-    for (let field in this.schema.fields) {
-      const desc = this.schema.fields[field];
+    for (let field in this.schema) {
+      const desc = this.schema[field];
       let elem;
       switch (desc.type) {
         case "text": {
           elem = $("#templates").find("#text").clone();
-          if (ann != null && ann[field] != null) {
-            elem.find("textarea").val(ann[field]);
-          }
-          elem.on("change", (evt) => {
+          const input = elem.find("textarea");
+          if (desc.mode !== "long") input.attr("rows", 1);
+          if (ann[field] != null) input.val(ann[field]);
+          input.on("change", (evt) => {
             self.handleChange({field: field, value: evt.target.value});
           });
-          elem.on("keypress keydown keyup", (evt) => {
+          input.on("keypress keydown keyup", (evt) => {
             evt.stopPropagation();
           });
           break;
         }
-        case "multiclass": {
-          elem = $("#templates").find("#multiclass").clone();
-          const bindings = desc.bindings;
-
-          for (let value of desc.values) {
-            const btn = $("<button type='button' class='btn btn-outline-primary'>").text(value);
-            // Check selected.
-            if (ann != null &&
-                ann[field] != null) {
-                if (ann[field] == value) {
-                  btn.addClass("active");
-                }
-            }
-            if (bindings && bindings[value]) {
-              let shortcut = bindings[value];
-              if (shortcut == " ") {
-                shortcut = "<S>";
-              }
-              btn.append($("<span class='badge badge-primary'>").text(shortcut));
+        case "classification": {
+          elem = $("#templates").find("#classification").clone();
+          const multilabel = desc.mode === "multilabel";
+          const selected = (value) => multilabel ?
+            (ann[field] || []).includes(value) : ann[field] === value;
+
+          for (let label of desc.values) {
+            // The value stored for a label defaults to its name.
+            const value = label.value != null ? label.value : label.name;
+            const btn = $("<button type='button' class='btn btn-outline-primary'>")
+              .text(label.name);
+            if (selected(value)) btn.addClass("active");
+            if (label.hotkey != null) {
+              const shortcut = label.hotkey === " " ? "<S>" : label.hotkey;
+              btn.append(" ").append($("<span class='badge badge-primary'>").text(shortcut));
             }
-            elem.find("div").append(btn);
+            elem.find("div.labels").append(btn);
 
             const handler = () => {
-              elem.find("button").removeClass("active");
-              btn.addClass("active");
-              self.handleChange({field: field, value: value});
+              if (!multilabel) {
+                elem.find("button").removeClass("active");
+                btn.addClass("active");
+                self.handleChange({field: field, value: value});
+                return;
+              }
+              btn.toggleClass("active");
+              const values = (self.value._fex[field] || []).filter(v => v !== value);
+              if (btn.hasClass("active")) values.push(value);
+              self.handleChange({field: field, value: values});
             };
             btn.on("click", handler);
-            if (bindings && bindings[value]) {
-              self._bindings[bindings[value]] = handler;
-            }
+            if (label.hotkey != null) self._bindings[label.hotkey] = handler;
           }
           break;
         }
@@ -182,44 +407,26 @@ class LabelInterface {
 
     const doGet = () => {
       // Get renderables from the server.
-      $.ajax({
-        url: "/render/",
-        contentType: "application/json",
-        method: "GET",
-        data: {start: index, count: 1},
-        error: console.log,
-        success: (data) => {
-          // Clear root.
-          self.value = data.obj[0];
-          self.elem.empty();
-          if (self.value._fex == null) self.value._fex = {};
-
-          self.elem.append(self.renderTemplate(index, data.html[0]));
-          self.index = index;
-          self._dirty = false;
-
-          $("#nav-range").val(index+1);
-        }
-      });
-    };
+      Promise.all([self._render(index), self._schemaLoaded]).then(([data]) => {
+        self._prefetched.delete(index);
+        // Clear root.
+        const unsaved = self._unsaved(index);
+        self.value = unsaved != null ? JSON.parse(JSON.stringify(unsaved)) : data.obj[0];
+        // Our unsaved changes are based on the version we read before.
+        if (unsaved == null) self._versions[index] = data.versions[0];
+        self.elem.empty();
+        if (self.value._fex == null) self.value._fex = {};
 
-    // First update if needed.
-    if (self._dirty) {
-      $.ajax({
-        url: `/update/${self.index}/`,
-        contentType: "application/json",
-        method: "POST",
-        data: JSON.stringify(self.value),
-        error: console.log,
-        success: () => doGet(),
-      })
-    } else {
-      doGet();
-    }
+        self.elem.append(self.renderTemplate(index, data.html[0]));
+        self.index = index;
+        self._dirty = false;
+
+        $("#nav-range").val(index+1);
+      }, console.log);
+    };
 
+    // Buffer the current update (if any); it is saved with the next flush.
+    self._queue();
+    doGet();
   }
 }
-
-// Only global variable -- for console debugging.
-var ui = new LabelInterface(document.getElementById('root'));
-ui.init();
@@ -0,0 +1,202 @@
+"""
+Stores annotations separately from the data they annotate.
+"""
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from . import codec
+
+logger = logging.getLogger(__name__)
+
+
+def _column(field: str) -> str:
+    """
+    Returns:
+        The (quoted) name of the column that stores `field`.
+    """
+    return '"f_{}"'.format(field.replace('"', '""'))
+
+
+class AnnotationStore:
+    """
+    A SQLite table of annotations keyed by record index, with one (JSON-encoded) column per
+    schema field.
+
+    Keeping annotations out of the data file means that the data file can stay read-only, that
+    an update only touches one row and that statistics such as label counts don't need to parse
+    the dataset. Columns are added as new fields are annotated.
+    """
+    def __init__(self, path: str, fields: Iterable[str] = ()):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS annotations ("
+                           "idx INTEGER PRIMARY KEY, annotator TEXT, updated REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS annotations_annotator "
+                           "ON annotations (annotator)")
+        self.fields: List[str] = [name[2:] for _, name, *_ in
+                                  self._conn.execute("PRAGMA table_info(annotations)")
+                                  if name.startswith("f_")]
+        self.add_fields(fields)
+
+    def add_fields(self, fields: Iterable[str]):
+        """
+        Adds a column for each new field.
+        """
+        with self._lock:
+            for field in fields:
+                if field not in self.fields:
+                    self._conn.execute(f"ALTER TABLE annotations ADD COLUMN {_column(field)} TEXT")
+                    self.fields.append(field)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _decode(self, row) -> dict:
+        return {field: codec.loads(value) for field, value in zip(self.fields, row)
+                if value is not None}
+
+    def _select(self) -> str:
+        return ", ".join(["idx"] + [_column(field) for field in self.fields])
+
+    def get(self, idx: int) -> dict:
+        """
+        Returns:
+            The annotations of record `idx` (empty if it has none).
+        """
+        with self._lock:
+            row = self._conn.execute(f"SELECT {self._select()} FROM annotations WHERE idx = ?",
+                                     (idx,)).fetchone()
+        return self._decode(row[1:]) if row else {}
+
+    def get_many(self, idxs: Iterable[int]) -> Dict[int, dict]:
+        """
+        Returns:
+            The annotations of every record in `idxs` that has any.
+        """
+        idxs = list(idxs)
+        if not idxs:
+            return {}
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {self._select()} FROM annotations "
+                f"WHERE idx IN ({', '.join('?' * len(idxs))})", idxs).fetchall()
+        return {row[0]: self._decode(row[1:]) for row in rows}
+
+    def upsert(self, idx: int, annotations: dict, annotator: Optional[str] = None):
+        """
+        Replaces the annotations of record `idx`.
+        """
+        self.upsert_many([(idx, annotations)], annotator)
+
+    def upsert_many(self, items: Iterable[Any], annotator: Optional[str] = None):
+        """
+        Replaces the annotations of several records in a single transaction.
+
+        Args:
+            items: `(idx, annotations)` pairs.
+            annotator: Who made these annotations, if known.
+        """
+        items = list(items)
+        with self._lock:
+            self.add_fields(field for _, annotations in items for field in annotations)
+            columns = [_column(field) for field in self.fields]
+            sql = (f"INSERT INTO annotations (idx, annotator, updated, {', '.join(columns)}) "
+                   f"VALUES ({', '.join('?' * (len(columns) + 3))}) "
+                   f"ON CONFLICT(idx) DO UPDATE SET annotator = excluded.annotator, "
+                   f"updated = excluded.updated" +
+                   "".join(f", {column} = excluded.{column}" for column in columns))
+            now = time.time()
+            rows = []
+            for idx, annotations in items:
+                values = [None if annotations.get(field) is None
+                          else codec.dumps(annotations[field]) for field in self.fields]
+                rows.append([idx, annotator, now] + values)
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(sql, rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM annotations").fetchone()[0]
+
+    def label_counts(self, field: str) -> Dict[Any, int]:
+        """
+        Returns:
+            The number of records annotated with each value of `field`. Each label of a
+            multilabel annotation is counted separately.
+        """
+        if field not in self.fields:
+            return {}
+        column = _column(field)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT value.value, COUNT(*) FROM annotations, json_each(annotations.{column}) "
+                f"AS value WHERE {column} IS NOT NULL GROUP BY value.value").fetchall()
+        return dict(rows)
+
+    def labeled(self, field: Optional[str] = None, start: int = 0) -> Iterator[int]:
+        """
+        Yields (in order) the indices from `start` on of records that have an annotation for
+        `field`, or any annotation at all if `field` is None.
+        """
+        if field is not None and field not in self.fields:
+            return
+        where = f"AND {_column(field)} IS NOT NULL" if field is not None else ""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT idx FROM annotations WHERE idx >= ? {where} ORDER BY idx",
+                (start,)).fetchall()
+        for row in rows:
+            yield row[0]
+
+    def unlabeled(self, count: int, field: Optional[str] = None, start: int = 0) -> Iterator[int]:
+        """
+        Yields (in order) the indices in `[start, count)` of records that have no annotation for
+        `field`, or no annotation at all if `field` is None.
+        """
+        idx = start
+        for labeled in self.labeled(field, start):
+            yield from range(idx, min(labeled, count))
+            idx = labeled + 1
+        yield from range(idx, count)
+
+    def progress(self) -> Dict[Optional[str], int]:
+        """
+        Returns:
+            The number of records annotated by each annotator.
+        """
+        with self._lock:
+            return dict(self._conn.execute(
+                "SELECT annotator, COUNT(*) FROM annotations GROUP BY annotator").fetchall())
+
+
+def test_annotation_store(tmp_path):
+    store = AnnotationStore(str(tmp_path / "annotations.sqlite"), ["intent"])
+    store.upsert(1, {"intent": "A"}, annotator="alice")
+    store.upsert_many([(3, {"intent": ["A", "B"], "notes": "hi"}), (4, {"notes": "x"})],
+                      annotator="bob")
+    store.upsert(1, {"intent": "B", "other": 1}, annotator="alice")
+
+    assert store.get(1) == {"intent": "B", "other": 1}
+    assert store.get(2) == {}
+    assert store.get_many([3, 5]) == {3: {"intent": ["A", "B"], "notes": "hi"}}
+    assert store.label_counts("intent") == {"A": 1, "B": 2}
+    assert list(store.unlabeled(6, "intent")) == [0, 2, 4, 5]
+    assert list(store.unlabeled(6)) == [0, 2, 5]
+    assert store.progress() == {"alice": 1, "bob": 2}
+    # Fields are remembered when the store is reopened.
+    assert AnnotationStore(store.path).fields == ["intent", "notes", "other"]
+
+
+__all__ = ['AnnotationStore']
@@ -1,32 +1,63 @@
 """
 Common utilities for FastEx
 """
+import bisect
+import glob
 import os
 import json
+import logging
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor, FIRST_COMPLETED, as_completed, wait
 from io import StringIO
 
 
 # region: io
-from typing import List, TextIO, Union, TypeVar
+from typing import List, TextIO, Union, TypeVar, Optional, Any, Hashable, Tuple, Callable, \
+    Iterable, Iterator, Dict
+
+from .codec import decode_many, dumps, loads
+from .compact import Compactor
+from .compress import detect_compression, xopen
+from .index import BlockIndex, LineIndex, open_index
+
+logger = logging.getLogger(__name__)
+
+#: Number of lines we decode at a time with `decode_many`.
+DECODE_BATCH_SIZE = 1024
+#: Suffix of the sidecar file that journaled updates are appended to.
+JOURNAL_SUFFIX = ".fexlog"
 
 T = TypeVar('T')
 
 
-def load_jsonl(fstream: Union[TextIO, str]) -> List[dict]:
+def load_jsonl(fstream: Union[TextIO, str], compact: bool = False) -> List[dict]:
     """
     Parses a JSONL file into a list of objects.
 
     Args:
         fstream: a filename or `TextIO` handle.
+        compact: If set, objects are loaded as (much smaller) read-only `CompactRecord`s.
 
     Returns:
         A list of objects parsed from the file
     """
     if isinstance(fstream, str):
-        with open(fstream) as fstream_:
-            return load_jsonl(fstream_)
-
-    return [json.loads(line) for line in fstream]
+        with xopen(fstream) as fstream_:
+            return load_jsonl(fstream_, compact)
+
+    ret: List[dict] = []
+    batch = []
+    decode = Compactor().compact if compact else None
+    for line in fstream:
+        if line.strip():
+            batch.append(line)
+            if len(batch) >= DECODE_BATCH_SIZE:
+                ret.extend(map(decode, decode_many(batch)) if decode else decode_many(batch))
+                batch = []
+    ret.extend(map(decode, decode_many(batch)) if decode else decode_many(batch))
+    return ret
 
 
 def test_load_jsonl():
@@ -43,12 +74,12 @@ def test_load_jsonl():
 
 def save_jsonl(fstream, objs):
     if isinstance(fstream, str):
-        with open(fstream, "w") as fstream_:
+        with xopen(fstream, "w") as fstream_:
             save_jsonl(fstream_, objs)
         return
 
     for obj in objs:
-        fstream.write(json.dumps(obj, sort_keys=True))
+        fstream.write(dumps(obj))
         fstream.write("\n")
 
 
@@ -57,12 +88,16 @@ def test_save_jsonl():
     objs = [
         {"str": "a value", "int": 1, "bool": True},
         {"str": "another value", "int": 2, "bool": False},
+        {"str": "caf\u00e9"},
     ]
     save_jsonl(fstream, objs)
-    assert fstream.getvalue() == """
-{"str": "a value", "int": 1, "bool": true}
-{"str": "another value", "int": 2, "bool": false}
-    """
+    # Records are written in `fastex.codec`'s compact style: sorted keys, no spaces after
+    # separators and non-ASCII characters as is.
+    assert fstream.getvalue() == """\
+{"bool":true,"int":1,"str":"a value"}
+{"bool":false,"int":2,"str":"another value"}
+{"str":"caf\u00e9"}
+"""
 
 
 class FileBackedJson:
@@ -107,38 +142,614 @@ class FileBackedJson:
         return iter(self.obj)
 
 
+class LRUCache:
+    """
+    A small bounded, thread-safe mapping that evicts its least recently used entries.
+    """
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
 class FileBackedJsonList:
-    def __init__(self, fname, auto_save=True):
+    """
+    A list of objects backed by a JSONL file.
+
+    By default the whole file is parsed into memory. In `lazy` mode we instead build a
+    `LineIndex` of byte offsets and only read and parse the records that are accessed, keeping
+    the most recent `cache_size` of them in memory. Modified records are held in memory until
+    `save()` streams them back into the file.
+
+    Records that were not modified are written back verbatim in lazy mode, or in eager mode if
+    `keep_raw` is set (at the cost of keeping their original bytes in memory).
+
+    Files compressed with gzip or zstd (detected from their extension) are read and written
+    transparently; in lazy mode they are indexed by a `BlockIndex`.
+
+    In `journal` mode, updates are not written into the file itself but appended to a sidecar
+    log of `[idx, obj]` records (fsynced every `sync_every` updates) that is replayed over the
+    file on `reload()`. Once the log grows past `compact_threshold` bytes, a background thread
+    rewrites the file with the merged records and discards the log.
+
+    In lazy mode, `mmap` maps an uncompressed file into memory so that records are read as
+    slices of the mapping, and processes that serve the same file share one copy of it in the
+    page cache. The file must then not be modified by anyone else while it is open.
+
+    In eager mode, `compact` stores records as read-only `CompactRecord`s, which share their
+    keys (and short strings) and take several times less memory than dicts.
+    """
+    def __init__(self, fname, auto_save=True, lazy=False, cache_size=1024, journal=False,
+                 sync_every=32, compact_threshold=64 * 1024 * 1024, keep_raw=False, mmap=False,
+                 compact=False):
         self.fname = fname
+        self.lazy = lazy
+        self.mmap = mmap
+        self._record_compactor = Compactor() if compact and not lazy else None
+        self.keep_raw = keep_raw
+        self.cache_size = cache_size
+        self.journal = journal
+        self.sync_every = sync_every
+        self.compact_threshold = compact_threshold
+        self._lock = threading.RLock()
+        self._log = None
+        self._compactor: Optional[threading.Thread] = None
         self.reload()
         self.auto_save = auto_save
 
+    @property
+    def journal_fname(self) -> str:
+        return self.fname + JOURNAL_SUFFIX
+
     def save(self):
-        with open(self.fname, "w") as f:
-            save_jsonl(f, self.objs)
+        """
+        Persists any modifications. In journal mode this only flushes the log to disk; use
+        `compact()` to fold the log into the file.
+        """
+        if self.journal:
+            self._sync_log()
+            return
+        with self._lock:
+            if self.lazy:
+                unmodified = not self._edits and not self._appended
+            else:
+                unmodified = not self._unsaved
+            if unmodified and os.path.exists(self.fname):
+                return
+            self._write(self._snapshot())
+            if self.lazy:
+                self.reload()
+            else:
+                self._unsaved = False
+
+    def compact(self, wait=True):
+        """
+        Rewrites the file with all journaled updates and removes the log.
+
+        Args:
+            wait: If false, the file is rewritten on a background thread and this method returns
+                  immediately.
+        """
+        running = self._compactor
+        if running is not None:
+            if not wait:
+                return
+            # Updates made since that compaction started still need to be folded in.
+            running.join()
+
+        with self._lock:
+            if self._compactor is None:
+                old = self.journal_fname + ".old"
+                self._close_log()
+                if os.path.exists(old) and os.path.exists(self.journal_fname):
+                    # A previous compaction was interrupted: fold the log into its leftovers.
+                    with open(old, "ab") as dst, open(self.journal_fname, "rb") as src:
+                        shutil.copyfileobj(src, dst)
+                    os.remove(self.journal_fname)
+                elif os.path.exists(self.journal_fname):
+                    # Rotate the log so that updates made during the rewrite go to a fresh one.
+                    os.replace(self.journal_fname, old)
+                elif not os.path.exists(old):
+                    return
+                self._compactor = threading.Thread(target=self._compact,
+                                                   args=(self._snapshot(),), daemon=True)
+                self._compactor.start()
+            running = self._compactor
+        if wait:
+            running.join()
+
+    def _compact(self, snapshot):
+        try:
+            self._write(snapshot)
+            with self._lock:
+                if self.lazy:
+                    # Only updates made after the snapshot still need to live in memory.
+                    index, edits, appended = snapshot
+                    base = len(index) if index else 0
+                    self._edits = {i: obj for i, obj in self._edits.items()
+                                   if edits.get(i) is not obj}
+                    for i, obj in enumerate(self._appended[:len(appended)]):
+                        if obj is not appended[i]:
+                            self._edits[base + i] = obj
+                    self._appended = self._appended[len(appended):]
+                    self._close()
+                    self._index = self._open_index()
+                    self._cache.clear()
+                os.remove(self.journal_fname + ".old")
+            logger.info(f"Compacted the update log of {self.fname}")
+        except OSError:
+            logger.exception(f"Could not compact the update log of {self.fname}")
+        finally:
+            with self._lock:
+                self._compactor = None
+
+    def _snapshot(self):
+        if not self.lazy:
+            return list(self.objs), self._raw, set(self._dirty)
+        return self._index, dict(self._edits), list(self._appended)
+
+    def _write(self, snapshot):
+        """
+        Atomically replaces the file with the records in `snapshot`.
+        """
+        tmp = self.fname + ".tmp"
+        compression = detect_compression(self.fname)
+        if not self.lazy:
+            objs, raw, dirty = snapshot
+            with xopen(tmp, "wb", compression) as out:
+                for i, obj in enumerate(objs):
+                    if raw is not None and i < len(raw) and i not in dirty:
+                        out.write(raw[i])
+                    else:
+                        out.write(dumps(obj).encode("utf-8"))
+                    out.write(b"\n")
+        else:
+            index, edits, appended = snapshot
+            with xopen(tmp, "wb", compression) as out:
+                for i in range(len(index) if index else 0):
+                    if i in edits:
+                        out.write(dumps(edits[i]).encode("utf-8"))
+                    else:
+                        out.write(index.read(i).rstrip())
+                    out.write(b"\n")
+                for obj in appended:
+                    out.write(dumps(obj).encode("utf-8"))
+                    out.write(b"\n")
+        os.replace(tmp, self.fname)
 
     def reload(self):
-        if os.path.exists(self.fname):
-            with open(self.fname) as f:
-                self.objs = load_jsonl(f)
+        with self._lock:
+            self._close_log()
+            if not self.lazy:
+                self.objs, self._raw, self._dirty = [], None, set()
+                #: Whether records were modified since the file was last written.
+                self._unsaved = False
+                if os.path.exists(self.fname):
+                    with xopen(self.fname, "rb") as f:
+                        raw = [line.rstrip() for line in f if line.strip()]
+                    for i in range(0, len(raw), DECODE_BATCH_SIZE):
+                        objs = decode_many(raw[i: i + DECODE_BATCH_SIZE])
+                        self.objs.extend(map(self._record_compactor.compact, objs)
+                                         if self._record_compactor is not None else objs)
+                    if self.keep_raw:
+                        self._raw = raw
+            else:
+                self._close()
+                self._index: Optional[LineIndex] = None
+                if os.path.exists(self.fname):
+                    self._index = self._open_index()
+                self._cache = LRUCache(self.cache_size)
+                self._edits: dict = {}
+                self._appended: list = []
+
+            # Replay any journaled updates, including those of an interrupted compaction.
+            for log in [self.journal_fname + ".old", self.journal_fname]:
+                if os.path.exists(log):
+                    with open(log, encoding="utf-8") as f:
+                        for idx, obj in load_jsonl(f):
+                            self._apply(idx, obj)
+
+    def _open_index(self) -> LineIndex:
+        index = open_index(self.fname)
+        if self.mmap:
+            index.map()
+        return index
+
+    def _close(self):
+        if getattr(self, "_index", None) is not None:
+            self._index.close()
+
+    def _close_log(self):
+        if self._log is not None:
+            self._sync_log()
+            self._log.close()
+            self._log = None
+
+    def _sync_log(self):
+        with self._lock:
+            if self._log is not None and self._pending:
+                self._log.flush()
+                os.fsync(self._log.fileno())
+                self._pending = 0
+
+    def _append_log(self, idx: int, obj):
+        with self._lock:
+            if self._log is None:
+                self._log = open(self.journal_fname, "a", encoding="utf-8")
+                self._pending = 0
+            self._log.write(dumps([idx, obj]))
+            self._log.write("\n")
+            self._pending += 1
+            if self._pending >= self.sync_every:
+                self._sync_log()
+            needs_compaction = self._log.tell() >= self.compact_threshold
+        if needs_compaction:
+            self.compact(wait=False)
+
+    def _normalize(self, idx: int) -> int:
+        length = len(self)
+        if idx < 0:
+            idx += length
+        if not 0 <= idx < length:
+            raise IndexError("list index out of range")
+        return idx
+
+    def _apply(self, idx: int, obj):
+        """
+        Updates (or, if `idx == len(self)`, appends) a record in memory.
+        """
+        if not self.lazy:
+            if self._record_compactor is not None:
+                obj = self._record_compactor.compact(obj)
+            if idx == len(self.objs):
+                self.objs.append(obj)
+            else:
+                self.objs[idx] = obj
+            self._dirty.add(idx)
+            self._unsaved = True
+            return
+        base = len(self._index) if self._index else 0
+        if idx >= base:
+            if idx - base == len(self._appended):
+                self._appended.append(obj)
+            else:
+                self._appended[idx - base] = obj
         else:
-            self.objs = []
+            self._edits[idx] = obj
+            self._cache.pop(idx)
 
     def __len__(self):
-        return len(self.objs)
+        if not self.lazy:
+            return len(self.objs)
+        return (len(self._index) if self._index else 0) + len(self._appended)
 
     def extend(self, iterables):
-        self.objs.extend(iterables)
-        if self.auto_save:
-            self.save()
+        with self._lock:
+            for obj in iterables:
+                idx = len(self)
+                self._apply(idx, obj)
+                if self.journal:
+                    self._append_log(idx, obj)
+            if self.auto_save and not self.journal:
+                self.save()
 
     def __getitem__(self, idx):
-        return self.objs[idx]
+        if not self.lazy:
+            return self.objs[idx]
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        with self._lock:
+            idx = self._normalize(idx)
+            if idx in self._edits:
+                return self._edits[idx]
+            base = len(self._index) if self._index else 0
+            if idx >= base:
+                return self._appended[idx - base]
+            obj = self._cache.get(idx)
+            if obj is None:
+                obj = loads(self._index.read(idx))
+                self._cache.put(idx, obj)
+            return obj
+
+    def raw(self, idx: int) -> Optional[Union[bytes, memoryview]]:
+        """
+        Returns:
+            The JSON encoding of record `idx` as it is stored in the file (a view of the memory
+            map in `mmap` mode), or None if the record has been modified since or its encoding
+            isn't kept (in eager mode without `keep_raw`).
+        """
+        with self._lock:
+            idx = self._normalize(idx)
+            if not self.lazy:
+                if self._raw is None or idx >= len(self._raw) or idx in self._dirty:
+                    return None
+                return self._raw[idx]
+            if idx in self._edits or idx >= (len(self._index) if self._index else 0):
+                return None
+            return self._index.view(idx) if self._index.mapped else self._index.read(idx)
 
     def __setitem__(self, idx, obj):
-        self.objs[idx] = obj
-        if self.auto_save:
-            self.save()
+        with self._lock:
+            idx = self._normalize(idx)
+            self._apply(idx, obj)
+            if self.journal:
+                self._append_log(idx, obj)
+            elif self.auto_save:
+                self.save()
+
+    def update_many(self, items: Iterable[Tuple[int, Any]]):
+        """
+        Updates several records at once: the file is saved (or, in journal mode, the log is
+        synced) once for the whole batch rather than once per record.
+
+        Args:
+            items: `(idx, obj)` pairs.
+        """
+        with self._lock:
+            for idx, obj in items:
+                idx = self._normalize(idx)
+                self._apply(idx, obj)
+                if self.journal:
+                    self._append_log(idx, obj)
+            if self.journal:
+                self._sync_log()
+            elif self.auto_save:
+                self.save()
+
+
+def test_keep_raw_file_backed_json_list(tmp_path):
+    fname = str(tmp_path / "data.jsonl")
+    with open(fname, "w") as f:
+        f.write('{ "id" : 0 }\n{ "id" : 1 }\n')
+
+    # Without modifications, the file isn't rewritten (even in its original formatting).
+    data = FileBackedJsonList(fname, auto_save=False)
+    data.save()
+    with open(fname) as f:
+        assert f.readline() == '{ "id" : 0 }\n'
+
+    data = FileBackedJsonList(fname, keep_raw=True)
+    data[1] = {"id": 1, "_fex": {}}
+    with open(fname) as f:
+        assert f.readline() == '{ "id" : 0 }\n'
+    assert load_jsonl(fname) == [{"id": 0}, {"id": 1, "_fex": {}}]
+
+
+def test_lazy_file_backed_json_list(tmp_path):
+    fname = str(tmp_path / "data.jsonl")
+    with open(fname, "w") as f:
+        f.write('{"id": 0}\n\n{"id": 1}\n{"id": 2}\n')
+
+    data = FileBackedJsonList(fname, auto_save=False, lazy=True, cache_size=1)
+    assert len(data) == 3
+    assert data[1] == {"id": 1}
+    assert data[-1] == {"id": 2}
+    assert data[0:2] == [{"id": 0}, {"id": 1}]
+    assert os.path.exists(fname + ".fexidx")
+
+    data[1] = {"id": 1, "_fex": {"label": "A"}}
+    data.save()
+    assert load_jsonl(fname) == [{"id": 0}, {"id": 1, "_fex": {"label": "A"}}, {"id": 2}]
+    assert FileBackedJsonList(fname, lazy=True)[1] == {"id": 1, "_fex": {"label": "A"}}
+
+    data = FileBackedJsonList(fname, auto_save=False, lazy=True, mmap=True)
+    assert data._index.mapped
+    assert data[2] == {"id": 2}
+    assert loads(bytes(data.raw(0))) == {"id": 0}
+    data[0] = {"id": 0, "_fex": {}}
+    assert data.raw(0) is None and data.raw(1) is not None
+    data._close()
+
+
+def test_journaled_file_backed_json_list(tmp_path):
+    fname = str(tmp_path / "data.jsonl")
+    save_jsonl(fname, [{"id": 0}, {"id": 1}])
+
+    for lazy in [False, True]:
+        data = FileBackedJsonList(fname, lazy=lazy, journal=True, sync_every=1)
+        data[0] = {"id": 0, "_fex": {"lazy": lazy}}
+        data.extend([{"id": 2}])
+        # Updates only go to the log until we compact it.
+        assert len(load_jsonl(fname)) == 2
+        assert FileBackedJsonList(fname, lazy=lazy, journal=True)[0] == data[0]
+
+        data.update_many([(1, {"id": 1, "_fex": {}}), (-1, {"id": 2, "_fex": {}})])
+        assert FileBackedJsonList(fname, lazy=lazy, journal=True)[2] == {"id": 2, "_fex": {}}
+
+        data.compact()
+        assert not os.path.exists(fname + JOURNAL_SUFFIX)
+        assert load_jsonl(fname) == [{"id": 0, "_fex": {"lazy": lazy}}, {"id": 1, "_fex": {}},
+                                     {"id": 2, "_fex": {}}]
+        assert data[2] == {"id": 2, "_fex": {}}
+        save_jsonl(fname, [{"id": 0}, {"id": 1}])
+
+
+class ShardedJsonList:
+    """
+    A list of objects spread over several JSONL files ("shards").
+
+    We only read each shard's `LineIndex` up front to compute cumulative record counts, which
+    map a global index to a `(shard, offset)` pair with a binary search. Shards are opened (as
+    lazy `FileBackedJsonList`s) when a record in them is first accessed, and only those are
+    saved.
+    """
+    def __init__(self, fnames: List[str], auto_save=True, **kwargs):
+        self.fnames = fnames
+        self.auto_save = auto_save
+        self.kwargs = kwargs
+        self.kwargs.setdefault("lazy", True)
+        self._lock = threading.RLock()
+        self.reload()
+
+    def reload(self):
+        with self._lock:
+            self._shards: List[Optional[FileBackedJsonList]] = [None] * len(self.fnames)
+            self.offsets = [0]
+            for fname in self.fnames:
+                self.offsets.append(self.offsets[-1] + len(open_index(fname)))
+
+    def save(self):
+        with self._lock:
+            for shard in self._shards:
+                if shard is not None:
+                    shard.save()
+
+    def shard(self, i: int) -> FileBackedJsonList:
+        with self._lock:
+            shard = self._shards[i]
+            if shard is None:
+                shard = self._shards[i] = FileBackedJsonList(self.fnames[i],
+                                                             auto_save=self.auto_save,
+                                                             **self.kwargs)
+            return shard
+
+    def locate(self, idx: int) -> Tuple[int, int]:
+        """
+        Returns:
+            The shard that contains the record with global index `idx` and its offset within it.
+        """
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("list index out of range")
+        i = bisect.bisect_right(self.offsets, idx) - 1
+        return i, idx - self.offsets[i]
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def extend(self, iterables):
+        with self._lock:
+            shard = self.shard(len(self.fnames) - 1)
+            shard.extend(iterables)
+            self.offsets[-1] = self.offsets[-2] + len(shard)
+
+    def __getitem__(self, idx):
+        with self._lock:
+            if isinstance(idx, slice):
+                return [self[i] for i in range(*idx.indices(len(self)))]
+            i, offset = self.locate(idx)
+            return self.shard(i)[offset]
+
+    def raw(self, idx: int) -> Optional[Union[bytes, memoryview]]:
+        with self._lock:
+            i, offset = self.locate(idx)
+            return self.shard(i).raw(offset)
+
+    def __setitem__(self, idx, obj):
+        with self._lock:
+            i, offset = self.locate(idx)
+            self.shard(i)[offset] = obj
+
+    def update_many(self, items: Iterable[Tuple[int, Any]]):
+        """
+        Updates several records, writing each affected shard once.
+        """
+        by_shard: Dict[int, List[Tuple[int, Any]]] = {}
+        with self._lock:
+            for idx, obj in items:
+                i, offset = self.locate(idx)
+                by_shard.setdefault(i, []).append((offset, obj))
+            for i, shard_items in by_shard.items():
+                self.shard(i).update_many(shard_items)
+
+
+def test_compressed_file_backed_json_list(tmp_path, monkeypatch):
+    monkeypatch.setattr(BlockIndex, "CHUNK_SIZE", 256)
+    fname = str(tmp_path / "data.jsonl.gz")
+    objs = [{"id": i, "text": "x" * (i % 7)} for i in range(1000)]
+    save_jsonl(fname, objs)
+    assert load_jsonl(fname) == objs
+
+    data = FileBackedJsonList(fname, lazy=True)
+    data._index = BlockIndex.build(fname, block_size=1024)
+    assert len(data._index._checkpoints) > 10
+    assert data[500] == objs[500] and data[999] == objs[999] and data[0] == objs[0]
+    data[1] = {"id": 1}
+    assert load_jsonl(fname)[:3] == [objs[0], {"id": 1}, objs[2]]
+
+
+def test_sharded_json_list(tmp_path):
+    for i in range(3):
+        save_jsonl(str(tmp_path / "part-{}.jsonl".format(i)), [{"id": i * 10 + j} for j in range(i)])
+
+    data = open_dataset(str(tmp_path), auto_save=False)
+    assert len(data) == 3
+    assert data.locate(2) == (2, 1)
+    assert data[0:3] == [{"id": 10}, {"id": 20}, {"id": 21}]
+    data[0] = {"id": 10, "_fex": {}}
+    data.save()
+    assert load_jsonl(str(tmp_path / "part-1.jsonl")) == [{"id": 10, "_fex": {}}]
+    # The empty first shard is never opened.
+    assert data._shards[0] is None
+
+
+def open_dataset(path: str, **kwargs) -> Union[FileBackedJsonList, ShardedJsonList]:
+    """
+    Opens the dataset at `path`, which may be a JSONL file, a directory of JSONL files or a glob
+    pattern that matches several of them.
+    """
+    if os.path.isdir(path):
+        fnames = sorted(fname for pattern in ["*.jsonl", "*.jsonl.gz", "*.jsonl.zst"]
+                        for fname in glob.glob(os.path.join(path, pattern)))
+    elif glob.has_magic(path):
+        fnames = sorted(glob.glob(path))
+    else:
+        return FileBackedJsonList(path, **kwargs)
+
+    if not fnames:
+        raise FileNotFoundError(f"No JSONL files found at {path}")
+    return ShardedJsonList(fnames, **kwargs)
+
+
+def imap_bounded(executor: Executor, fn: Callable, iterable: Iterable,
+                 max_pending: int) -> Iterator:
+    """
+    Like `executor.map(fn, iterable)`, but only consumes `iterable` as results come in, keeping
+    at most `max_pending` tasks in flight. Results are yielded in the order they complete.
+    """
+    pending: set = set()
+    for item in iterable:
+        if len(pending) >= max_pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+        pending.add(executor.submit(fn, item))
+    for future in as_completed(pending):
+        yield future.result()
 
 
 def prune_empty(lst: List[T]) -> List[T]:
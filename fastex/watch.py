@@ -0,0 +1,187 @@
+"""
+Watches configuration files and reloads them in the background.
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+from typing import List, Optional
+
+from .config import Config
+
+logger = logging.getLogger(__name__)
+
+# Constants from <sys/inotify.h>.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+#: struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+_EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    """
+    A minimal binding of Linux's inotify API that watches a single directory.
+
+    Throws:
+        `OSError` (or `AttributeError` on platforms without inotify) if we can't watch the
+        directory.
+    """
+    def __init__(self, directory: str):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # Editors often save by writing a new file and renaming it over the old one, so watch
+        # the directory rather than the file.
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"Could not watch {directory}")
+
+    def wait(self, timeout: float) -> List[str]:
+        """
+        Returns:
+            The names of the files that changed within `timeout` seconds (possibly none).
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        names, pos = [], 0
+        while pos < len(data):
+            _, _, _, length = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            names.append(os.fsdecode(data[pos: pos + length].rstrip(b"\0")))
+            pos += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ConfigWatcher:
+    """
+    Reloads a `Config` on a background thread whenever its file changes.
+
+    We use inotify where available and otherwise poll the file's modification time every
+    `interval` seconds; either way, requests never have to check the file themselves. If the
+    new file fails to load, we log the error and keep the current configuration.
+    """
+    def __init__(self, config: Config, interval: float = 1.0, debounce: float = 0.1):
+        self.config = config
+        self.interval = interval
+        self.debounce = debounce
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self.config.path is None:
+            return
+        self._thread = threading.Thread(target=self._run, name="fex-config-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        directory, name = os.path.split(os.path.abspath(self.config.path))
+        try:
+            inotify: Optional[Inotify] = Inotify(directory)
+        except (OSError, AttributeError) as e:
+            logger.info(f"Polling {self.config.path} for changes (inotify is unavailable: {e})")
+            inotify = None
+
+        try:
+            while not self._stop.is_set():
+                if inotify is not None:
+                    changed = name in inotify.wait(self.interval)
+                    if changed:
+                        # Let the writer finish and coalesce the burst of events it causes.
+                        while inotify.wait(self.debounce):
+                            pass
+                else:
+                    self._stop.wait(self.interval)
+                    changed = self._is_dirty()
+                if changed and not self._stop.is_set():
+                    self._reload()
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+    def _is_dirty(self) -> bool:
+        try:
+            return self.config.dirty
+        except OSError:
+            # The file may be briefly missing while it is being replaced.
+            return False
+
+    def _reload(self):
+        try:
+            self.config.reload()
+        except Exception:
+            logger.exception(f"Could not reload {self.config.path}; keeping the previous "
+                             f"configuration")
+
+
+def test_config_watcher(tmp_path, monkeypatch, caplog):
+    import time
+    import pytest
+
+    caplog.set_level(logging.INFO)
+    path = str(tmp_path / "fex.yaml")
+
+    def write(content: str, mtime: float):
+        # Save like editors do: write a new file and rename it over the old one.
+        with open(path + ".swp", "w") as f:
+            f.write(content)
+        os.utime(path + ".swp", (mtime, mtime))
+        os.replace(path + ".swp", path)
+
+    def unavailable(self, directory: str):
+        raise OSError("inotify is disabled")
+
+    def wait_for(condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            assert time.monotonic() < deadline, "Timed out"
+            time.sleep(0.01)
+
+    for polling in [False, True]:
+        if polling:
+            monkeypatch.setattr(Inotify, "__init__", unavailable)
+        elif not hasattr(ctypes.CDLL(ctypes.util.find_library("c")), "inotify_init1"):
+            pytest.skip("inotify is unavailable")
+        write("template: one\n", 1000)
+        config = Config.load(path)
+        reloads: List[str] = []
+        config.add_listener(lambda config_: reloads.append(config_.cfg["template"]))
+        watcher = ConfigWatcher(config, interval=0.05, debounce=0.01)
+        watcher.start()
+        try:
+            time.sleep(0.1)
+            write("template: two\n", 2000)
+            wait_for(lambda: reloads == ["two"])
+
+            # Broken files are reported and the current configuration is kept.
+            write("template: [three\n", 3000)
+            wait_for(lambda: "Could not reload" in caplog.text)
+            assert config.cfg["template"] == "two"
+            assert ("Polling" in caplog.text) == polling
+            caplog.clear()
+        finally:
+            watcher.stop()
+
+
+__all__ = ['ConfigWatcher']